@@ -0,0 +1,470 @@
+"""
+Offline extraction accuracy and latency benchmark.
+
+Runs a labelled corpus (benchmarks/fixtures/extraction_cases.json) of text expenses, receipt
+images and analytics questions through the bot's own entry points - process_expense_text,
+process_expense_image and the analyser agent - and reports field-level accuracy, latency and
+token usage (and cost, given a price list) per model and prompt version, so that prompt and model
+changes can be compared on numbers.
+
+Modes:
+    replay (default)  serve the LLM responses from a recordings file; no network or API keys needed
+    record            call the real APIs and save their responses (and latencies) to the recordings
+    live              call the real APIs without saving anything
+
+Gemini responses are recorded per exact request (model, instructions and prompt), so changing a
+prompt means the affected cases have to be recorded again - they are reported as "not recorded"
+until then, and the run exits with status 1 (as it does when any kind/model runs no cases). Analyser turns are recorded per question, model, prompt version and turn.
+Today's date is fixed by the corpus, so expected dates don't drift. Receipt cases are skipped
+when their image (relative to benchmarks/fixtures/) isn't present. The analyser runs its queries
+against a temporary SQLite database seeded with the corpus's expenses; record analytics against a
+local Postgres (--database-url), as the agent writes Postgres SQL.
+
+Run from the project root:
+
+    python -m benchmarks.extraction --mode record --gemini-models gemini-3.1-flash-lite-preview
+    python -m benchmarks.extraction --min-accuracy 0.9
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import date, datetime
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+DEFAULT_CASES = os.path.join(FIXTURES, "extraction_cases.json")
+DEFAULT_RECORDINGS = os.path.join(FIXTURES, "extraction_recordings.json")
+FIELDS = ("currency", "price", "category", "description", "date")
+BENCH_TELEGRAM_ID = 990_000_001
+
+
+class NotRecorded(Exception):
+    """Raised in replay mode for a request that has no recorded response"""
+
+
+def percentile(values: list, pct: float) -> float:
+    """nearest-rank percentile"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def short_hash(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+    return digest.hexdigest()[:12]
+
+
+class Recorder:
+    """Records, replays or just measures LLM calls, keeping the latency and usage of each call
+    made for the current case"""
+
+    def __init__(self, mode: str, path: str):
+        self.mode = mode
+        self.path = path
+        self.recordings = {}
+        if mode != "live" and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self.recordings = json.load(file)
+        self.case_calls = []
+
+    async def call(self, key: str, live_call, to_record, from_record):
+        """
+        Args:
+            key (str) : identifies the request in the recordings
+            live_call (coroutine function) : makes the real request
+            to_record (callable) : turns the response into a JSON-serialisable dict with its usage
+            from_record (callable) : turns a recorded dict back into a response
+        """
+        if self.mode == "replay":
+            recorded = self.recordings.get(key)
+            if recorded is None:
+                raise NotRecorded(key)
+            self.case_calls.append(recorded)
+            return from_record(recorded)
+
+        started_at = time.perf_counter()
+        response = await live_call()
+        recorded = {"latency": time.perf_counter() - started_at, **to_record(response)}
+        self.case_calls.append(recorded)
+        if self.mode == "record":
+            self.recordings[key] = recorded
+        return response
+
+    def save(self):
+        if self.mode == "record":
+            with open(self.path, "w", encoding="utf-8") as file:
+                json.dump(self.recordings, file, indent=1, sort_keys=True)
+
+#---------------------------------------------------------------------------------------------------
+# LLM stand-ins #
+
+class BenchGeminiClient:
+    """Wraps genai.Client's `aio.models.generate_content` for the recorder, sending every request
+    to the model being benchmarked"""
+
+    def __init__(self, recorder: Recorder, model: str, real_client_factory):
+        self.recorder = recorder
+        self.model = model
+        self._real_client_factory = real_client_factory
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self.generate_content))
+
+    @staticmethod
+    def _request_hash(config, contents) -> str:
+        parts = [config.system_instruction or ""]
+        for content in contents if isinstance(contents, list) else [contents]:
+            inline_data = getattr(content, "inline_data", None)
+            parts.append(inline_data.data if inline_data else content)
+        return short_hash(*parts)
+
+    async def generate_content(self, model=None, contents=None, config=None):  # pylint: disable=unused-argument
+        key = f"gemini/{self.model}/{self._request_hash(config, contents)}"
+
+        def to_record(response):
+            usage = response.usage_metadata
+            return {"text": response.text, "usage": {
+                "input_tokens": usage.prompt_token_count or 0,
+                "cached_tokens": usage.cached_content_token_count or 0,
+                "output_tokens": usage.candidates_token_count or 0,
+            }}
+
+        def from_record(recorded):
+            usage = recorded["usage"]
+            return SimpleNamespace(text=recorded["text"], usage_metadata=SimpleNamespace(
+                prompt_token_count=usage["input_tokens"], cached_content_token_count=usage["cached_tokens"],
+                candidates_token_count=usage["output_tokens"],
+            ))
+
+        return await self.recorder.call(
+            key,
+            lambda: self._real_client_factory().aio.models.generate_content(
+                model=self.model, contents=contents, config=config),
+            to_record,
+            from_record,
+        )
+
+
+class BenchAnalystLLM:
+    """Stands in for the analyst's ChatOpenAI model, passing each turn through the recorder"""
+
+    def __init__(self, recorder: Recorder, model: str, prompt_version: str, real_llm_factory):
+        self.recorder = recorder
+        self.model = model
+        self.prompt_version = prompt_version
+        self._real_llm_factory = real_llm_factory
+        self.case_id = None
+        self.turn = 0
+
+    def bind_tools(self, tools, **kwargs):
+        # pylint: disable=import-outside-toplevel
+        from langchain_core.messages import messages_from_dict, message_to_dict
+        from langchain_core.runnables import RunnableLambda
+
+        async def respond(prompt_value):
+            self.turn += 1
+            key = f"openai/{self.model}/{self.prompt_version}/{self.case_id}/{self.turn}"
+
+            def to_record(message):
+                usage = message.usage_metadata or {}
+                return {"message": message_to_dict(message), "usage": {
+                    "input_tokens": usage.get("input_tokens", 0),
+                    "cached_tokens": (usage.get("input_token_details") or {}).get("cache_read", 0) or 0,
+                    "output_tokens": usage.get("output_tokens", 0),
+                }}
+
+            return await self.recorder.call(
+                key,
+                lambda: self._real_llm_factory(self.model).bind_tools(tools, **kwargs).ainvoke(prompt_value),
+                to_record,
+                lambda recorded: messages_from_dict([recorded["message"]])[0],
+            )
+        return RunnableLambda(respond)
+
+#---------------------------------------------------------------------------------------------------
+# Scoring #
+
+def score_expense(parsed: dict, expected: dict) -> dict:
+    """Field name -> whether the parsed field matches the label"""
+    def text(value):
+        return " ".join(str(value or "").lower().split())
+
+    try:
+        price_ok = abs(float(parsed.get("price")) - float(expected["price"])) < 0.005
+    except (TypeError, ValueError):
+        price_ok = False
+    description, expected_description = text(parsed.get("description")), text(expected["description"])
+    return {
+        "currency": text(parsed.get("currency")) == text(expected["currency"]),
+        "price": price_ok,
+        "category": text(parsed.get("category")) in {text(category) for category in expected["category"]},
+        "description": bool(description) and (expected_description in description or description in expected_description),
+        "date": text(parsed.get("date")) == text(expected["date"]),
+    }
+
+
+def case_cost(result: dict, price: dict) -> float:
+    """USD cost of a case given the model's price per million tokens"""
+    uncached = result["input_tokens"] - result["cached_tokens"]
+    return (uncached * price["input"] + result["cached_tokens"] * price.get("cached_input", price["input"])
+            + result["output_tokens"] * price["output"]) / 1e6
+
+
+def score_answer(answer: str, expected_numbers: list) -> bool:
+    """Whether every expected amount appears in the answer"""
+    answer = (answer or "").replace(",", "")
+    return all(number in answer for number in expected_numbers)
+
+#---------------------------------------------------------------------------------------------------
+# Runs #
+
+class ExtractionBenchmark:
+    """Runs the corpus for each model and collects results per (kind, model, prompt version)"""
+
+    def __init__(self, args, cases: dict, recorder: Recorder):
+        self.args = args
+        self.cases = cases
+        self.recorder = recorder
+        self.results = defaultdict(list)   # (kind, model, prompt version) -> case results
+
+    def _finish_case(self, group: tuple, case_id: str, **result):
+        calls = self.recorder.case_calls
+        self.recorder.case_calls = []
+        result.update(
+            id=case_id,
+            latency=sum(call["latency"] for call in calls),
+            **{name: sum(call["usage"][name] for call in calls)
+               for name in ("input_tokens", "cached_tokens", "output_tokens")},
+        )
+        self.results[group].append(result)
+
+    async def run_expenses(self, gemini_svc, model: str):
+        from utils import str_to_json  # pylint: disable=import-outside-toplevel
+        from tenacity import stop_after_attempt  # pylint: disable=import-outside-toplevel
+
+        # a single attempt per case - replay misses and live errors are reported, not retried
+        process_text = gemini_svc.process_expense_text.retry_with(stop=stop_after_attempt(1), reraise=True)
+        process_image = gemini_svc.process_expense_image.retry_with(stop=stop_after_attempt(1), reraise=True)
+        common = {
+            "preferred_currency": self.cases["preferred_currency"],
+            "existing_categories": self.cases["existing_categories"],
+        }
+
+        versions = {
+            "text": short_hash(gemini_svc.EXPENSE_TEXT_INSTRUCTIONS)[:8],
+            "image": short_hash(gemini_svc.EXPENSE_IMAGE_INSTRUCTIONS)[:8],
+        }
+
+        runs = [("text", case, lambda case=case: process_text(case["input"], **common))
+                for case in self.cases["text_expenses"]]
+        for case in self.cases["receipt_images"]:
+            image_path = os.path.join(FIXTURES, case["image"])
+            if os.path.exists(image_path):
+                runs.append(("image", case, lambda case=case, image_path=image_path: process_image(
+                    image_path, case["caption"], **common)))
+            else:
+                self.results[("image", model, versions["image"])].append({"id": case["id"], "skipped": True})
+
+        for kind, case, run in runs:
+            group = (kind, model, versions[kind])
+            try:
+                parsed = str_to_json(await run())
+            except NotRecorded:
+                self.recorder.case_calls = []
+                self.results[group].append({"id": case["id"], "not_recorded": True})
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                self._finish_case(group, case["id"], error=str(e))
+                continue
+            self._finish_case(group, case["id"], fields=score_expense(parsed or {}, case["expected"]))
+
+    async def run_analytics(self, sql_agent_svc, bench_llm: BenchAnalystLLM, user_id, categories: list):
+        agent = sql_agent_svc.get_analyser_agent()
+        group = ("analytics", bench_llm.model, bench_llm.prompt_version)
+        for case in self.cases["analytics_questions"]:
+            bench_llm.case_id, bench_llm.turn = case["id"], 0
+            prompt = sql_agent_svc.format_query_prompt(case["question"], user_id, categories)
+            try:
+                state = await agent.ainvoke({"messages": [("user", prompt)]}, {"recursion_limit": 25})
+            except NotRecorded:
+                self.recorder.case_calls = []
+                self.results[group].append({"id": case["id"], "not_recorded": True})
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                self._finish_case(group, case["id"], error=str(e))
+                continue
+            last_message = state["messages"][-1]
+            final_call = sql_agent_svc.get_final_answer_call(last_message)
+            answer = final_call["args"]["final_answer"] if final_call else str(last_message.content)
+            self._finish_case(group, case["id"], correct=score_answer(answer, case["expected_numbers"]),
+                              answer=answer)
+
+    #-----------------------------------------------------------------------------------------------
+    # Reporting #
+
+    def report(self, prices: dict):
+        """Print the results
+        Returns:
+            tuple : (the lowest accuracy of any group, or None if nothing ran; the groups that didn't run
+                     every case)"""
+        lowest, incomplete = None, []
+        print(f"\n{'kind':<10}{'model':<32}{'prompt':<14}{'cases':>6}{'accuracy':>10}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'in tok':>9}{'cached':>8}{'out tok':>9}{'cost $':>10}")
+        for (kind, model, version), results in sorted(self.results.items()):
+            scored = [r for r in results if "fields" in r or "correct" in r or "error" in r]
+            skipped = sum(1 for r in results if r.get("skipped"))
+            not_recorded = sum(1 for r in results if r.get("not_recorded"))
+            notes = ", ".join(note for note in (
+                f"{skipped} skipped (no image)" if skipped else "",
+                f"{not_recorded} not recorded" if not_recorded else "",
+                f"{sum(1 for r in scored if 'error' in r)} errors" if any("error" in r for r in scored) else "",
+            ) if note)
+            if not scored or not_recorded:
+                incomplete.append(f"{kind} {model} {version} ({notes or 'no cases'})")
+            if not scored:
+                print(f"{kind:<10}{model:<32}{version:<14}{0:>6}{'-':>10}   {notes}")
+                continue
+
+            if kind == "analytics":
+                accuracy = sum(1 for r in scored if r.get("correct")) / len(scored)
+            else:
+                accuracy = sum(sum(r.get("fields", {}).values()) for r in scored) / (len(scored) * len(FIELDS))
+            lowest = accuracy if lowest is None else min(lowest, accuracy)
+            latencies = [r["latency"] * 1000 for r in scored]
+            tokens = {name: sum(r[name] for r in scored) / len(scored)
+                      for name in ("input_tokens", "cached_tokens", "output_tokens")}
+            cost = f"{sum(case_cost(r, prices[model]) for r in scored):.4f}" if model in prices else "-"
+            print(f"{kind:<10}{model:<32}{version:<14}{len(scored):>6}{accuracy:>10.1%}"
+                  f"{percentile(latencies, 50):>9.0f}{percentile(latencies, 95):>9.0f}{max(latencies):>9.0f}"
+                  f"{tokens['input_tokens']:>9.0f}{tokens['cached_tokens']:>8.0f}{tokens['output_tokens']:>9.0f}"
+                  f"{cost:>10}   {notes}")
+
+            if kind != "analytics":
+                per_field = "   ".join(
+                    f"{field} {sum(1 for r in scored if r.get('fields', {}).get(field)) / len(scored):.0%}" for field in FIELDS
+                )
+                print(f"{'':<10}fields: {per_field}")
+            if self.args.verbose:
+                for r in scored:
+                    misses = [field for field, ok in r.get("fields", {}).items() if not ok]
+                    if "error" in r or misses or r.get("correct") is False:
+                        print(f"{'':<10}  {r['id']}: {r.get('error') or misses or r.get('answer')}")
+        print("\n(tokens are per case; cost is the total for the cases run)")
+        return lowest, incomplete
+
+#---------------------------------------------------------------------------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("replay", "record", "live"), default="replay")
+    parser.add_argument("--kinds", default="text,image,analytics", help="comma-separated kinds of cases to run")
+    parser.add_argument("--gemini-models", default="", help="comma-separated models for expenses (default: MODEL_NAME)")
+    parser.add_argument("--openai-models", default="", help="comma-separated models for analytics (default: ANALYST_MODEL)")
+    parser.add_argument("--cases", default=DEFAULT_CASES, help="labelled corpus JSON")
+    parser.add_argument("--recordings", default=DEFAULT_RECORDINGS, help="recorded responses JSON")
+    parser.add_argument("--prices", default="", help="JSON of model -> USD per million tokens "
+                                                     "({\"input\": .., \"cached_input\": .., \"output\": ..})")
+    parser.add_argument("--database-url", default="", help="database for analytics (default: temporary SQLite file)")
+    parser.add_argument("--min-accuracy", type=float, default=0.0,
+                        help="exit with status 1 if any model/prompt scores below this (0-1)")
+    parser.add_argument("--verbose", action="store_true", help="list the cases each model got wrong")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+    kinds = set(args.kinds.split(","))
+    with open(args.cases, encoding="utf-8") as file:
+        cases = json.load(file)
+
+    if args.mode == "replay":
+        from benchmarks.load_test import DUMMY_SECRETS  # pylint: disable=import-outside-toplevel
+        for name, value in DUMMY_SECRETS.items():
+            os.environ.setdefault(name, value)
+    workdir = tempfile.mkdtemp(prefix="expense-bot-extraction-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'extraction.db')}"
+    os.environ["LANGSMITH_TRACING"] = "false"
+    # one plain request per case: no context caching, hedging or failover to another provider
+    os.environ["GEMINI_CACHE_TTL"] = "0"
+    os.environ["GEMINI_HEDGE_BUDGET"] = "0"
+
+    # the app reads its configuration at import, so only import it once the environment is set
+    # pylint: disable=import-outside-toplevel
+    import config
+    import database
+    import utils
+    from sqlalchemy import delete
+    from services import gemini_svc, sql_agent_svc
+
+    today = datetime.strptime(cases["today"], "%Y-%m-%d")
+
+    def fixed_date():
+        return today.strftime("%Y-%m-%d"), today.strftime("%A")
+    utils.get_current_date = gemini_svc.get_current_date = sql_agent_svc.get_current_date = fixed_date
+
+    async def primary_only(route, primary, fallback, slo):  # pylint: disable=unused-argument
+        return await primary()
+    gemini_svc.call_with_failover = sql_agent_svc.call_with_failover = primary_only
+
+    recorder = Recorder(args.mode, args.recordings)
+    benchmark = ExtractionBenchmark(args, cases, recorder)
+    real_client, real_llm = gemini_svc.get_client, sql_agent_svc.get_llm
+
+    if kinds & {"text", "image"}:
+        if "image" not in kinds:
+            cases["receipt_images"] = []
+        if "text" not in kinds:
+            cases["text_expenses"] = []
+        for model in (args.gemini_models or config.MODEL_NAME).split(","):
+            client = BenchGeminiClient(recorder, model, real_client)
+            gemini_svc.get_client = lambda client=client: client
+            await benchmark.run_expenses(gemini_svc, model)
+
+    if "analytics" in kinds:
+        database.init_db()
+        user_id = uuid.uuid5(uuid.NAMESPACE_URL, "expense-bot-extraction-benchmark")
+        with database.SessionLocal.begin() as session:
+            # reseed from scratch, in case --database-url points at a database used by an earlier run
+            session.execute(delete(database.Expenses).where(database.Expenses.user_id == user_id))
+            session.merge(database.Users(id=user_id, telegram_id=BENCH_TELEGRAM_ID, preferred_currency="GBP"))
+            session.flush()
+            session.add_all(database.Expenses(user_id=user_id, date=date.fromisoformat(row["date"]),
+                                              category=row["category"], description=row["description"],
+                                              price=row["price"], currency=row["currency"])
+                            for row in cases["analytics_expenses"])
+        categories = sorted({row["category"] for row in cases["analytics_expenses"]})
+        prompt_version = short_hash(sql_agent_svc.ANALYST_SYSTEM, sql_agent_svc.format_query_prompt("", "", []))[:8]
+        for model in (args.openai_models or config.ANALYST_MODEL).split(","):
+            bench_llm = BenchAnalystLLM(recorder, model, prompt_version, real_llm)
+            sql_agent_svc.get_llm = lambda model=None, bench_llm=bench_llm: bench_llm
+            await benchmark.run_analytics(sql_agent_svc, bench_llm, user_id, categories)
+
+    recorder.save()
+    prices = {}
+    if args.prices:
+        with open(args.prices, encoding="utf-8") as file:
+            prices = json.load(file)
+    lowest, incomplete = benchmark.report(prices)
+    # a case that didn't run can't pass, so a replay with missing recordings (e.g. after a prompt
+    # change) fails instead of passing on the cases that are left
+    if lowest is None or incomplete:
+        print("\nNot every case ran - record them with --mode record, or narrow --kinds:")
+        for group in incomplete or ["no cases"]:
+            print(f"  {group}")
+        sys.exit(1)
+    if lowest < args.min_accuracy:
+        print(f"\nAccuracy {lowest:.1%} is below --min-accuracy {args.min_accuracy:.1%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,196 @@
+"""Local stand-ins for Gemini, OpenAI and the Telegram Bot API used by the benchmarks"""
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+import uvicorn
+from fastapi import FastAPI, Request
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from utils import get_current_date
+
+#---------------------------------------------------------------------------------------------------
+# Gemini #
+
+class FakeGeminiClient:
+    """
+    Mimics genai.Client's `aio.models.generate_content` (and `generate_content_stream`), returning
+    canned expense JSON after a fixed latency, and `aio.caches.create` for cached instructions
+    (requests using a cached content report its tokens as cached).
+    """
+    INSTRUCTION_TOKENS = 400
+    PROMPT_TOKENS = 80
+
+    def __init__(self, latency: float = 0.5, response: dict = None):
+        self.latency = latency
+        self.response = response or {
+            "currency": "GBP",
+            "price": 4.5,
+            "category": "Food",
+            "description": "starbucks",
+            "date": get_current_date()[0],
+        }
+        self.calls = 0
+        self.caches_created = 0
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(
+                generate_content=self.generate_content,
+                generate_content_stream=self.generate_content_stream,
+            ),
+            caches=SimpleNamespace(create=self.create_cache),
+        )
+
+    async def create_cache(self, model=None, config=None):
+        self.caches_created += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(name=f"cachedContents/fake-{self.caches_created}")
+
+    def _usage(self, config):
+        cached = self.INSTRUCTION_TOKENS if config is not None and config.cached_content else 0
+        return SimpleNamespace(prompt_token_count=self.INSTRUCTION_TOKENS + self.PROMPT_TOKENS,
+                               cached_content_token_count=cached)
+
+    async def generate_content(self, model=None, contents=None, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(text=json.dumps(self.response), usage_metadata=self._usage(config))
+
+    async def generate_content_stream(self, model=None, contents=None, config=None):
+        self.calls += 1
+        text = json.dumps(self.response)
+        chunk_size = max(1, len(text) // 4)
+
+        async def stream():
+            for i in range(0, len(text), chunk_size):
+                await asyncio.sleep(self.latency / 4)
+                last = i + chunk_size >= len(text)
+                yield SimpleNamespace(text=text[i:i + chunk_size],
+                                      usage_metadata=self._usage(config) if last else None)
+        return stream()
+
+#---------------------------------------------------------------------------------------------------
+# OpenAI (analyst agent) #
+
+class FakeAnalystLLM:
+    """
+    Stands in for the analyst's ChatOpenAI model. The bound model first asks for two SQL queries
+    over the user's expenses in one turn (run in parallel), then submits a canned final answer once
+    it has seen the results.
+    """
+
+    def __init__(self, latency: float = 1.0):
+        self.latency = latency
+        self.calls = 0
+
+    PREFIX_TOKENS = 1800   # system prompt and tool definitions, cached after the first request
+    PROMPT_TOKENS = 200
+
+    def _usage(self) -> dict:
+        cached = self.PREFIX_TOKENS if self.calls > 1 else 0
+        return {"input_tokens": self.PREFIX_TOKENS + self.PROMPT_TOKENS, "output_tokens": 50,
+                "total_tokens": self.PREFIX_TOKENS + self.PROMPT_TOKENS + 50,
+                "input_token_details": {"cache_read": cached}}
+
+    def bind_tools(self, tools, **kwargs):  # pylint: disable=unused-argument
+        return RunnableLambda(self._respond)
+
+    async def _respond(self, prompt_value):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        messages = prompt_value.to_messages()
+        call_id = f"call_{self.calls}"
+
+        if not any(getattr(msg, "type", None) == "tool" for msg in messages):
+            prompt_text = " ".join(str(msg.content) for msg in messages)
+            match = re.search(r"UUID is ([0-9a-f-]{36})", prompt_text)
+            user_id = match.group(1) if match else ""
+            queries = [
+                "SELECT category, SUM(price) AS total, currency FROM expenses "
+                f"WHERE user_id = '{user_id}' GROUP BY category, currency",
+                "SELECT date, SUM(price) AS total, currency FROM expenses "
+                f"WHERE user_id = '{user_id}' GROUP BY date, currency",
+            ]
+            return AIMessage(content="", usage_metadata=self._usage(), tool_calls=[
+                {"name": "db_query_tool", "args": {"query": query}, "id": f"{call_id}_{i}", "type": "tool_call"}
+                for i, query in enumerate(queries)
+            ])
+
+        return AIMessage(content="", usage_metadata=self._usage(), tool_calls=[
+            {"name": "SubmitFinalAnswer", "args": {"final_answer": "**Summary**\nYou spent 4.50 GBP on Food."},
+             "id": call_id, "type": "tool_call"}
+        ])
+
+#---------------------------------------------------------------------------------------------------
+# Telegram Bot API #
+
+class FakeTelegramServer:
+    """
+    Minimal Telegram Bot API server answering the methods the bot uses, run by uvicorn in a
+    background thread. Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>/bot.
+    """
+
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark Bot", "username": "benchmark_bot"}
+
+    def __init__(self, port: int, latency: float = 0.05):
+        self.port = port
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(100000)
+        self._server = None
+        self._thread = None
+
+        self.app = FastAPI()
+        self.app.post("/bot{token}/{method}")(self._handle)
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def _handle(self, token: str, method: str, request: Request):  # pylint: disable=unused-argument
+        # PTB posts url-encoded parameters with JSON values (multipart uploads are answered without parsing)
+        params = {}
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            for key, value in parse_qsl((await request.body()).decode()):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = self.BOT_USER
+        elif method in ("sendMessage", "sendDocument", "sendPhoto", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    def start(self):
+        """Start serving in a background thread and wait until the server is up"""
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join()
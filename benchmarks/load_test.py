@@ -0,0 +1,273 @@
+"""
+Webhook load test against local stand-ins.
+
+Replays recorded update sessions (benchmarks/fixtures/updates.json) against main.py's FastAPI app
+for a number of virtual users at a configurable concurrency. Gemini and OpenAI are replaced by
+fake clients returning canned JSON after a configurable latency, Telegram by a local fake Bot API
+server, and the database by a SQLite file (or any DATABASE_URL, e.g. a local Postgres).
+
+Each virtual user sends its session's updates one at a time, waiting for the previous one to be
+processed, like a real user waiting for the bot's reply. Reports p50/p95/p99 latency (webhook
+request until the update has been processed), throughput, and per-handler latency and database
+query counts.
+
+Run from the project root:
+
+    python -m benchmarks.load_test --users 50 --concurrency 20 --sessions insert_expense,analyse_expenses
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_UPDATES = os.path.join(ROOT, "benchmarks", "fixtures", "updates.json")
+
+DUMMY_SECRETS = {
+    "GCP_PROJECT_ID": "benchmark-project",
+    "TELE_BOT_TOKEN": "123456:benchmark-token",
+    "REGION": "local",
+    "REGION2": "local",
+    "DB_USER": "bench",
+    "DB_PASSWORD": "bench",
+    "DB_NAME": "bench",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "OPENAI_API_KEY": "sk-benchmark",
+    "LANGSMITH_API_KEY": "ls-benchmark",
+}
+
+# which handler callback is running, used to attribute database queries
+current_handler = contextvars.ContextVar("current_handler", default="(outside handlers)")
+
+
+def percentile(values: list, pct: float) -> float:
+    """nearest-rank percentile"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def fill_placeholders(value, fields: dict):
+    """Recursively replace "{name}" placeholders in a recorded update with this user's values"""
+    if isinstance(value, dict):
+        return {key: fill_placeholders(item, fields) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill_placeholders(item, fields) for item in value]
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}") and value[1:-1] in fields:
+        return fields[value[1:-1]]
+    return value
+
+
+class LoadTest:
+    """Sets up the stand-ins, instruments the app and replays sessions"""
+
+    def __init__(self, args):
+        self.args = args
+        self.latencies = defaultdict(list)      # session step label -> seconds
+        self.handler_times = defaultdict(list)  # handler name -> seconds
+        self.query_counts = Counter()           # handler name -> database queries
+        self.shed = 0
+        self.timeouts = 0
+        self.inline_replies = Counter()   # method -> replies returned in the webhook response
+        self._pending = {}                      # update id -> future resolved when processed
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    #-----------------------------------------------------------------------------------------------
+    # Instrumentation #
+
+    def _wrap_callback(self, callback):
+        name = callback.__name__
+
+        async def wrapped(update, context):
+            token = current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.handler_times[name].append(time.perf_counter() - started)
+                current_handler.reset(token)
+        wrapped.__name__ = name
+        return wrapped
+
+    def instrument(self, main, database):
+        """Count queries per handler and get notified when each update has been processed"""
+        from sqlalchemy import event  # pylint: disable=import-outside-toplevel
+
+        @event.listens_for(database.engine, "before_cursor_execute")
+        def count_query(*_):
+            self.query_counts[current_handler.get()] += 1
+
+        handlers = list(main.conv_handler.entry_points) + list(main.conv_handler.fallbacks)
+        for state_handlers in main.conv_handler.states.values():
+            handlers.extend(state_handlers)
+        for group in main.bot_app.handlers.values():
+            handlers.extend(group)
+        for handler in {id(h): h for h in handlers if hasattr(h, "callback")}.values():
+            handler.callback = self._wrap_callback(handler.callback)
+
+        process = main.dispatcher._process  # pylint: disable=protected-access
+
+        async def process_and_notify(update):
+            try:
+                await process(update)
+            finally:
+                future = self._pending.pop(update.update_id, None)
+                if future and not future.done():
+                    future.set_result(time.perf_counter())
+        main.dispatcher._process = process_and_notify  # pylint: disable=protected-access
+
+    #-----------------------------------------------------------------------------------------------
+    # Replay #
+
+    async def run_user(self, client, user_index: int, session_name: str, session: list, semaphore):
+        telegram_id = 10_000_000 + user_index
+        async with semaphore:
+            for step, recorded in enumerate(session):
+                update_id = next(self._update_ids)
+                update = fill_placeholders(recorded, {
+                    "user_id": telegram_id,
+                    "chat_id": telegram_id,
+                    "username": f"bench_user_{user_index}",
+                    "message_id": next(self._message_ids),
+                    "callback_id": str(update_id),
+                    "date": int(time.time()),
+                })
+                update["update_id"] = update_id
+
+                future = asyncio.get_running_loop().create_future()
+                self._pending[update_id] = future
+                started = time.perf_counter()
+                response = await client.post("/", json=update)
+                if response.status_code == 503:
+                    self.shed += 1
+                    self._pending.pop(update_id, None)
+                    continue
+                if "method" in response.json():
+                    self.inline_replies[response.json()["method"]] += 1
+                try:
+                    finished = await asyncio.wait_for(future, timeout=self.args.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    continue
+                self.latencies[f"{session_name}[{step}]"].append(finished - started)
+
+    async def replay(self, main, sessions: dict):
+        import httpx  # pylint: disable=import-outside-toplevel
+
+        names = self.args.sessions.split(",") if self.args.sessions else list(sessions)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                self.run_user(client, i, names[i % len(names)], sessions[names[i % len(names)]], semaphore)
+                for i in range(self.args.users)
+            ))
+            return time.perf_counter() - started
+
+    #-----------------------------------------------------------------------------------------------
+    # Reporting #
+
+    def report(self, wall_time: float, telegram_calls: Counter, llm_calls: dict, app_metrics: dict):
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        print(f"\nProcessed {len(all_latencies)} updates from {self.args.users} users in {wall_time:.2f}s "
+              f"({len(all_latencies) / wall_time:.1f} updates/s), shed {self.shed}, timed out {self.timeouts}")
+        if all_latencies:
+            print(f"Update latency: p50 {percentile(all_latencies, 50) * 1000:.0f} ms   "
+                  f"p95 {percentile(all_latencies, 95) * 1000:.0f} ms   "
+                  f"p99 {percentile(all_latencies, 99) * 1000:.0f} ms")
+
+        print(f"\n{'session step':<32}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for label, values in sorted(self.latencies.items()):
+            print(f"{label:<32}{len(values):>6}{percentile(values, 50) * 1000:>10.0f}"
+                  f"{percentile(values, 95) * 1000:>10.0f}{percentile(values, 99) * 1000:>10.0f}")
+
+        print(f"\n{'handler':<32}{'calls':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'q/call':>8}")
+        for name in sorted(set(self.handler_times) | set(self.query_counts)):
+            times = self.handler_times.get(name, [])
+            queries = self.query_counts.get(name, 0)
+            if times:
+                print(f"{name:<32}{len(times):>6}{percentile(times, 50) * 1000:>10.0f}"
+                      f"{percentile(times, 95) * 1000:>10.0f}{percentile(times, 99) * 1000:>10.0f}"
+                      f"{queries:>9}{queries / len(times):>8.1f}")
+            else:
+                print(f"{name:<32}{'-':>6}{'-':>10}{'-':>10}{'-':>10}{queries:>9}{'-':>8}")
+
+        print("\nTelegram API calls: " + ", ".join(f"{method} {count}" for method, count in telegram_calls.most_common()))
+        if self.inline_replies:
+            print("Inline webhook replies: " + ", ".join(
+                f"{method} {count}" for method, count in self.inline_replies.most_common()))
+        print("LLM calls: " + ", ".join(f"{name} {count}" for name, count in llm_calls.items()))
+        print("\nApp metrics: " + json.dumps(app_metrics, indent=2, default=str))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="number of virtual users")
+    parser.add_argument("--concurrency", type=int, default=10, help="virtual users active at once")
+    parser.add_argument("--sessions", default="", help="comma-separated session names (default: all)")
+    parser.add_argument("--updates", default=DEFAULT_UPDATES, help="recorded update sessions JSON")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="seconds per fake Gemini call")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="seconds per fake OpenAI call")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per fake Bot API call")
+    parser.add_argument("--database-url", default="", help="database to use (default: temporary SQLite file)")
+    parser.add_argument("--telegram-port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for an update to be processed")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+
+    from benchmarks.fakes import FakeGeminiClient, FakeAnalystLLM, FakeTelegramServer  # pylint: disable=import-outside-toplevel
+
+    telegram = FakeTelegramServer(args.telegram_port, latency=args.telegram_latency)
+    telegram.start()
+
+    workdir = tempfile.mkdtemp(prefix="expense-bot-bench-")
+    os.environ.update(DUMMY_SECRETS)
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["TELEGRAM_API_URL"] = telegram.api_url
+    os.environ["LANGSMITH_TRACING"] = "false"
+
+    # the app reads its configuration at import, so only import it once the environment is set
+    # pylint: disable=import-outside-toplevel
+    import database
+    import main as bot_main
+    from services import gemini_svc, sql_agent_svc, whitelist_svc
+
+    gemini = FakeGeminiClient(latency=args.gemini_latency)
+    analyst = FakeAnalystLLM(latency=args.openai_latency)
+    gemini_svc.get_client = lambda: gemini
+    sql_agent_svc.get_llm = lambda model=None: analyst
+
+    with open(args.updates, encoding="utf-8") as file:
+        sessions = json.load(file)["sessions"]
+
+    database.init_db()
+    for i in range(args.users):
+        whitelist_svc.add_to_whitelist(f"bench_user_{i}")
+
+    load_test = LoadTest(args)
+    load_test.instrument(bot_main, database)
+    load_test.query_counts.clear()
+
+    async with bot_main.lifespan(bot_main.app):
+        wall_time = await load_test.replay(bot_main, sessions)
+        app_metrics = bot_main.metrics.snapshot()
+
+    telegram.stop()
+    load_test.report(wall_time, telegram.calls, {"gemini": gemini.calls, "openai": analyst.calls}, app_metrics)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+"""
+Cold start benchmark.
+
+Measures, each in a fresh interpreter:
+- import time of main.py (everything that runs before uvicorn can accept a request)
+- first-use cost of the lazily created gemini client, analyst LLM and compiled analyser agent
+- time to first response: spawning uvicorn until GET / returns 200 (lifespan disabled, since
+  starting the bot needs a real Telegram token)
+- secret loading with a simulated Secret Manager round-trip, sequential vs concurrent
+
+Secrets are provided through environment variables (dummy values), so no Google Cloud access is
+needed. Run from the project root:
+
+    python -m benchmarks.startup [--runs 5] [--secret-latency 0.08]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DUMMY_ENV = {
+    "GCP_PROJECT_ID": "benchmark-project",
+    "TELE_BOT_TOKEN": "123456:benchmark-token",
+    "REGION": "europe-west2",
+    "REGION2": "europe-west2",
+    "DB_USER": "bench",
+    "DB_PASSWORD": "bench",
+    "DB_NAME": "bench",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "OPENAI_API_KEY": "sk-benchmark",
+    "LANGSMITH_API_KEY": "ls-benchmark",
+}
+
+IMPORT_SNIPPET = """
+import time
+started = time.perf_counter()
+import main
+print(time.perf_counter() - started)
+"""
+
+FIRST_USE_SNIPPET = """
+import time
+import main
+from services.gemini_svc import get_client
+from services.sql_agent_svc import get_llm, get_analyser_agent
+for fn in (get_client, get_llm, get_analyser_agent):
+    started = time.perf_counter()
+    fn()
+    print(fn.__name__, time.perf_counter() - started)
+"""
+
+SECRETS_SNIPPET = """
+import os, time, types
+import config
+latency = float(os.environ["BENCH_SECRET_LATENCY"])
+for name in config.SECRET_NAMES.values():
+    os.environ.pop(name, None)
+
+class FakeSecretClient:
+    def access_secret_version(self, request):
+        time.sleep(latency)  # simulated Secret Manager round-trip
+        return types.SimpleNamespace(payload=types.SimpleNamespace(data=b"value"))
+
+config.get_secret_client = lambda: FakeSecretClient()
+started = time.perf_counter()
+for name in config.SECRET_NAMES.values():
+    config.get_secret(name)
+print("sequential", time.perf_counter() - started)
+started = time.perf_counter()
+config.load_secrets()
+print("concurrent", time.perf_counter() - started)
+"""
+
+
+def run_snippet(snippet: str, extra_env: dict = None) -> str:
+    """Run a python snippet in a fresh interpreter from the project root and return its stdout"""
+    env = {**os.environ, **DUMMY_ENV, **(extra_env or {})}
+    result = subprocess.run([sys.executable, "-c", snippet], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def time_to_first_response(port: int) -> float:
+    """Spawn uvicorn and time how long it takes until the health check responds"""
+    env = {**os.environ, **DUMMY_ENV}
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--lifespan", "off",
+         "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("uvicorn exited before responding")
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarise(label: str, values: list):
+    """Print median/min/max of a list of durations in milliseconds"""
+    print(f"  {label:<28} median {statistics.median(values) * 1000:8.1f} ms   "
+          f"min {min(values) * 1000:8.1f} ms   max {max(values) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--secret-latency", type=float, default=0.08,
+                        help="simulated Secret Manager round-trip in seconds")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"Cold start benchmark ({args.runs} runs each)")
+
+    imports = [float(run_snippet(IMPORT_SNIPPET)) for _ in range(args.runs)]
+    summarise("import main", imports)
+
+    first_use = {}
+    for _ in range(args.runs):
+        for line in run_snippet(FIRST_USE_SNIPPET).splitlines():
+            name, value = line.split()
+            first_use.setdefault(name, []).append(float(value))
+    for name, values in first_use.items():
+        summarise(f"first {name}()", values)
+
+    ttfr = [time_to_first_response(args.port) for _ in range(args.runs)]
+    summarise("time to first response", ttfr)
+
+    secrets = {}
+    for _ in range(args.runs):
+        output = run_snippet(SECRETS_SNIPPET, {"BENCH_SECRET_LATENCY": str(args.secret_latency)})
+        for line in output.splitlines():
+            name, value = line.split()
+            secrets.setdefault(name, []).append(float(value))
+    for name, values in secrets.items():
+        summarise(f"secrets ({name})", values)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,147 @@
-from google.cloud import secretmanager
-import google.auth
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+# secrets are fetched lazily (see __getattr__ below): attribute name -> secret name
+SECRET_NAMES = {
+    "BOT_TOKEN": "TELE_BOT_TOKEN",
+    "REGION": "REGION",
+    "REGION2": "REGION2",
+    "DB_USER": "DB_USER",
+    "DB_PASSWORD": "DB_PASSWORD",
+    "DB_NAME": "DB_NAME",
+    "DB_HOST": "DB_HOST",
+    "DB_PORT": "DB_PORT",
+    "OPENAI_API_KEY": "OPENAI_API_KEY",
+    "LANGSMITH_API_KEY": "LANGSMITH_API_KEY",
+}
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
 def get_project_id():
-    """Automatically retrieves the Google Cloud Project ID."""
+    """Retrieves the Google Cloud Project ID (GCP_PROJECT_ID env var, otherwise from the default credentials)."""
+    if os.getenv("GCP_PROJECT_ID"):
+        return os.environ["GCP_PROJECT_ID"]
+    import google.auth  # pylint: disable=import-outside-toplevel
     _, project = google.auth.default()
     return project
 
-PROJECT_ID = get_project_id()
+@lru_cache(maxsize=None)
+def get_secret_client():
+    """Single secret manager client shared by all secret fetches"""
+    # imported lazily as the grpc stack is slow to import and unused when secrets come from env vars
+    from google.cloud import secretmanager  # pylint: disable=import-outside-toplevel
+    return secretmanager.SecretManagerServiceClient()
 
 def get_secret(secret_name):
-    """function to retrieve secret from google secret manager"""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(request={"name": name})
+    """function to retrieve secret from an environment variable of the same name if set, otherwise google secret manager"""
+    if os.getenv(secret_name):
+        return os.environ[secret_name].strip()
+    name = f"projects/{get_project_id()}/secrets/{secret_name}/versions/latest"
+    response = get_secret_client().access_secret_version(request={"name": name})
     return response.payload.data.decode("UTF-8").strip()
 
-BOT_TOKEN = get_secret("TELE_BOT_TOKEN")
-REGION = get_secret("REGION")
-REGION2 = get_secret("REGION2")
-DB_USER = get_secret("DB_USER")
-DB_PASSWORD = get_secret("DB_PASSWORD")
-DB_NAME = get_secret("DB_NAME")
-DB_HOST = get_secret("DB_HOST")
-DB_PORT = get_secret("DB_PORT")
-OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
-LANGSMITH_API_KEY = get_secret("LANGSMITH_API_KEY")
-
-# model config
+def load_secrets():
+    """Fetch all secrets concurrently the first time any of them is needed"""
+    with _secrets_lock:
+        if not _secrets:
+            with ThreadPoolExecutor(max_workers=len(SECRET_NAMES)) as pool:
+                values = pool.map(get_secret, SECRET_NAMES.values())
+                _secrets.update(zip(SECRET_NAMES, values))
+    return _secrets
+
+def __getattr__(name):
+    """Resolve secrets (and PROJECT_ID) on first access, e.g. `from config import BOT_TOKEN`"""
+    if name in SECRET_NAMES:
+        return load_secrets()[name]
+    if name == "PROJECT_ID":
+        return get_project_id()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# telegram bot API endpoints (override to point the bot at a local stand-in)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# model config - MODEL_NAME is the fastest model, used for tiny text expenses
 MODEL_NAME = "gemini-3.1-flash-lite-preview"
+# seconds gemini keeps the cached expense-parsing instructions (0 disables explicit context caching; the
+# instructions are below gemini's minimum cacheable size, so it's only worth enabling if they grow)
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "0"))
+# fraction of gemini requests that may be duplicated when slower than usual (0 disables hedging)
+GEMINI_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0"))
+
+# model routing (override via environment variables). The expense text and image models default to
+# MODEL_NAME, so expense routing only takes effect once they're set (see benchmarks/extraction.py)
+EXPENSE_TEXT_MODEL = os.getenv("EXPENSE_TEXT_MODEL", MODEL_NAME)               # other text expenses
+EXPENSE_IMAGE_MODEL = os.getenv("EXPENSE_IMAGE_MODEL", MODEL_NAME)             # receipts (vision)
+EXPENSE_FALLBACK_MODEL = os.getenv("EXPENSE_FALLBACK_MODEL", "gpt-5.4-mini")   # openai, when gemini fails
+ANALYST_MODEL = os.getenv("ANALYST_MODEL", "gpt-5.4-mini")                     # simple questions
+ANALYST_STRONG_MODEL = os.getenv("ANALYST_STRONG_MODEL", "gpt-5.4")            # multi-step questions
+EXPENSE_LATENCY_SLO = float(os.getenv("EXPENSE_LATENCY_SLO", "15"))   # seconds before failing over
+ANALYST_LATENCY_SLO = float(os.getenv("ANALYST_LATENCY_SLO", "60"))   # seconds per analyst turn
+
+# update dispatcher config (override via environment variables)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "8"))     # workers across all chats
+MAX_CHAT_QUEUE_DEPTH = int(os.getenv("MAX_CHAT_QUEUE_DEPTH", "20"))        # queued updates per chat
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "500"))         # queued updates in total
+
+# outbound telegram rate limits (override via environment variables); telegram allows about
+# 30 messages/second overall and 1 message/second per chat, with short bursts
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))   # requests/second across all chats
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))        # requests/second per chat
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))        # requests a chat may burst
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))      # retries after a flood wait
+# seconds the webhook waits for a command's reply so it can be returned in the webhook response
+INLINE_REPLY_TIMEOUT = float(os.getenv("INLINE_REPLY_TIMEOUT", "2"))
+
+# persistence config (override via environment variables)
+PERSISTENCE_MAX_CACHED_USERS = int(os.getenv("PERSISTENCE_MAX_CACHED_USERS", "1000"))  # users kept in memory
+PERSISTENCE_IDLE_TIMEOUT = int(os.getenv("PERSISTENCE_IDLE_TIMEOUT", "1800"))          # seconds before eviction
+
+# local sentence-transformers model for semantic expense search, e.g. "all-MiniLM-L6-v2"
+# (optional; empty disables semantic search and /search only does fuzzy matching)
+SEARCH_EMBEDDING_MODEL = os.getenv("SEARCH_EMBEDDING_MODEL", "")
+# users whose description embeddings are kept in memory between searches (least recently used are dropped)
+SEARCH_CACHE_USERS = int(os.getenv("SEARCH_CACHE_USERS", "200"))
+
+# users whose expenses are copied into local DuckDB tables for the analyser's queries
+# (least recently used are dropped; 0 disables and every query goes to the database)
+ANALYTICS_CACHE_USERS = int(os.getenv("ANALYTICS_CACHE_USERS", "200"))
+
+# rendered chart images kept in memory (charts already sent are reused by their Telegram file_id)
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "100"))
+
+# totals across currencies are kept in this currency; exchange rates are loaded at startup from a
+# CSV file of date,currency,rate rows (units of the currency per unit of BASE_CURRENCY), if set
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "GBP").upper()
+FX_RATES_FILE = os.getenv("FX_RATES_FILE", "")
+
+# share of a monthly category budget spent before confirmations start warning about it
+BUDGET_ALERT_THRESHOLD = float(os.getenv("BUDGET_ALERT_THRESHOLD", "0.8"))
+
+# scheduled spending digests: comma-separated periods to send ("weekly", sent on Mondays, and/or
+# "monthly", sent on the 1st; empty disables them), sent from this hour (server time) onwards,
+# with a short comment from this OpenAI model if set
+DIGEST_PERIODS = [period.strip() for period in os.getenv("DIGEST_PERIODS", "").split(",") if period.strip()]
+DIGEST_HOUR = int(os.getenv("DIGEST_HOUR", "3"))
+DIGEST_COMMENTARY_MODEL = os.getenv("DIGEST_COMMENTARY_MODEL", "")
+
+# per-user category classifier: fill the category without the LLM once it has learned enough
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv("CLASSIFIER_MIN_EXAMPLES", "20"))        # confirmed expenses
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.9"))  # posterior probability
+
+# database connection pool config (override via environment variables)
+# each update worker uses at most one connection at a time; the headroom covers webhook whitelist
+# checks and persistence flushes. Keep instances x (pool size + overflow + read pool size) below the
+# database's limit.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(MAX_CONCURRENT_UPDATES + 2)))  # connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "4"))         # extra connections during bursts
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))      # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "600"))       # seconds before a connection is replaced
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))    # connections for analyser queries (run in parallel)
 
 # conversation states
 WAITING_FOR_EXPENSE, AWAITING_CONFIRMATION, AWAITING_REFINEMENT, AWAITING_EDIT, \
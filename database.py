@@ -1,17 +1,81 @@
+import os
+import time
 import uuid
+import logging
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, Column, UUID, BigInteger, \
-    String, Integer, ForeignKey, Numeric, Date, DateTime, Text
-from config import DB_USER, DB_PASSWORD, DB_NAME, DB_HOST, DB_PORT
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy import create_engine, exc, inspect, insert, select, text, Index, Column, UUID, BigInteger, \
+    func, cast, String, Integer, ForeignKey, Numeric, Date, DateTime, Text, LargeBinary, Boolean
+import config
+import metrics
 
-DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-PERSISTENCE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# DATABASE_URL env var overrides the database secrets (e.g. a local Postgres or SQLite stand-in)
+DATABASE_URL = os.getenv("DATABASE_URL") or \
+    f"postgresql+psycopg2://{config.DB_USER}:{config.DB_PASSWORD}@{config.DB_HOST}:{config.DB_PORT}/{config.DB_NAME}"
 
-# create connection engine
-engine = create_engine(DATABASE_URL, pool_size=2, max_overflow=3, pool_pre_ping=True)
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that exports how long checkouts wait for a connection, timeouts and usage gauges"""
+    metrics_prefix = "db.pool"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.increment(f"{self.metrics_prefix}_timeouts")
+            logging.warning("Timed out waiting for a database connection (%s)", self.status())
+            raise
+        finally:
+            metrics.observe(f"{self.metrics_prefix}_wait", time.perf_counter() - started)
+            self._export_usage()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._export_usage()
+
+    def _export_usage(self):
+        metrics.set_gauge(f"{self.metrics_prefix}_checked_out", self.checkedout())
+        metrics.set_gauge(f"{self.metrics_prefix}_overflow", max(0, self.overflow()))
+
+
+class ReadQueuePool(InstrumentedQueuePool):
+    """Pool of the read-only engine, exported as db.read_pool_*"""
+    metrics_prefix = "db.read_pool"
+
+
+# create the connection engine shared by all services and the bot persistence
+# (connections are recycled by age instead of pinged on every checkout)
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=InstrumentedQueuePool,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_use_lifo=True,  # reuse warm connections so surplus ones go idle and get recycled
+)
 SessionLocal = sessionmaker(bind=engine)
+metrics.set_gauge("db.pool_size", config.DB_POOL_SIZE)
+metrics.set_gauge("db.pool_max_overflow", config.DB_MAX_OVERFLOW)
+
+# separate pool for the analyser agent's read-only queries, so (possibly many concurrent)
+# analytical queries can't take the connections update workers need.
+# DATABASE_READ_URL can point it at a read replica.
+read_engine = create_engine(
+    os.getenv("DATABASE_READ_URL") or DATABASE_URL,
+    poolclass=ReadQueuePool,
+    pool_size=config.DB_READ_POOL_SIZE,
+    max_overflow=0,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_use_lifo=True,
+)
+ReadSessionLocal = sessionmaker(bind=read_engine)
+metrics.set_gauge("db.read_pool_size", config.DB_READ_POOL_SIZE)
 
 # define tables (as ORM classes)
 Base = declarative_base()
@@ -33,6 +97,48 @@ class Expenses(Base):
     description = Column(String, nullable=False)
     date = Column(Date, nullable=False)
     currency = Column(String, nullable=False)
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=True)  # canonical merchant
+    base_amount = Column(Numeric(12,2), nullable=True)  # price in BASE_CURRENCY (None if no exchange rate)
+    __table_args__ = (
+        # fallback lookup of an expense from its details (see find_expense_id)
+        Index("ix_expenses_user_date_price", "user_id", "date", "price"),
+        Index("ix_expenses_user_merchant", "user_id", "merchant_id"),
+        # totals across currencies over a period, answered from the index alone
+        Index("ix_expenses_user_date_base_amount", "user_id", "date", "base_amount"),
+        # expenses without a merchant yet (see merchants_svc.backfill_merchants) - empty once it has
+        # run, so the check on every start doesn't scan the table
+        Index("ix_expenses_missing_merchant", "id", postgresql_where=merchant_id.is_(None),
+              sqlite_where=merchant_id.is_(None)),
+    )
+
+class Merchants(Base):
+    """Canonical merchants per user, which expenses with differently written descriptions share"""
+    __tablename__ = "merchants"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    name = Column(String, nullable=False)
+
+class MerchantAliases(Base):
+    """Normalised merchant names (see merchants_svc.merchant_key) mapped to a user's merchants"""
+    __tablename__ = "merchant_aliases"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    alias_key = Column(String, primary_key=True)
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=False)
+    learned = Column(Boolean, nullable=False, default=False)   # learned from a user's correction
+
+class ExpenseMessages(Base):
+    """Maps bot messages (e.g. "expense recorded" confirmations) to the expense they show"""
+    __tablename__ = "expense_messages"
+    chat_id = Column(BigInteger, primary_key=True)
+    message_id = Column(BigInteger, primary_key=True)
+    expense_id = Column(Integer, ForeignKey("expenses.id", ondelete="CASCADE"), nullable=False)
+
+class DescriptionEmbeddings(Base):
+    """Cached embeddings of expense descriptions for semantic search, per embedding model"""
+    __tablename__ = "description_embeddings"
+    model = Column(String, primary_key=True)
+    description = Column(String, primary_key=True)
+    vector = Column(LargeBinary, nullable=False)    # float32 array
 
 class CategoryRules(Base):
     """Per-user keyword-to-category mapping rules"""
@@ -42,6 +148,75 @@ class CategoryRules(Base):
     keyword = Column(String, nullable=False)
     category = Column(String, nullable=False)
 
+class UserCategories(Base):
+    """Per-user index of expense categories, maintained when expenses are recorded"""
+    __tablename__ = "user_categories"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    category = Column(String, primary_key=True)
+
+class UserClassifiers(Base):
+    """Per-user category classifier (see classifier_svc), stored as compressed token counts"""
+    __tablename__ = "user_classifiers"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class FxRates(Base):
+    """Exchange rates loaded from a local file (see fx_svc): units of the currency per unit of BASE_CURRENCY"""
+    __tablename__ = "fx_rates"
+    currency = Column(String(3), primary_key=True)
+    date = Column(Date, primary_key=True)
+    rate = Column(Numeric(18,8), nullable=False)
+
+class UserDataVersions(Base):
+    """Per-user counter bumped in the same transaction as every change to the user's expenses, so
+    copies of them (e.g. the analyser's local analytics tables) can tell when they are stale"""
+    __tablename__ = "user_data_versions"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class Budgets(Base):
+    """Per-user monthly budgets per category, in BASE_CURRENCY"""
+    __tablename__ = "budgets"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    category = Column(String, primary_key=True)
+    amount = Column(Numeric(12,2), nullable=False)
+
+class BudgetTotals(Base):
+    """Running total of base_amount per user, category and month (first day of the month),
+    maintained in the same transaction as every change to the user's expenses (see budgets_svc)"""
+    __tablename__ = "budget_totals"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    category = Column(String, primary_key=True)
+    month = Column(Date, primary_key=True)
+    spent = Column(Numeric(12,2), nullable=False, default=0)
+
+class DigestRuns(Base):
+    """Scheduled digest runs (see digest_svc), one row per period, claimed by the instance sending it"""
+    __tablename__ = "digest_runs"
+    period = Column(String, primary_key=True)     # "weekly" or "monthly"
+    start = Column(Date, primary_key=True)
+    claimed_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # renewed as digests are sent
+    completed_at = Column(DateTime, nullable=True)
+
+class DigestSends(Base):
+    """Digests already sent in a run, so a run resumed after its instance stopped skips them"""
+    __tablename__ = "digest_sends"
+    period = Column(String, primary_key=True)
+    start = Column(Date, primary_key=True)
+    telegram_id = Column(BigInteger, primary_key=True)
+    sent_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class ChartFiles(Base):
+    """Telegram file_id of the last chart image sent for each user, chart type and period (see
+    charts_svc), reused while the user's data version is unchanged"""
+    __tablename__ = "chart_files"
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    chart = Column(String, primary_key=True)
+    period = Column(String, primary_key=True)     # e.g. "2026-03" (or a day, for this month's daily chart)
+    version = Column(BigInteger, nullable=False)
+    file_id = Column(String, nullable=False)
+
 class WhitelistedUsers(Base):
     """Whitelisted users table for access control"""
     __tablename__ = "whitelisted_users"
@@ -49,3 +224,87 @@ class WhitelistedUsers(Base):
     username = Column(String, unique=True, nullable=False)
     added_date = Column(DateTime, nullable=False, default=datetime.utcnow)
     notes = Column(Text, nullable=True)
+
+class BotUserData(Base):
+    """Persisted bot user_data, one row per Telegram user"""
+    __tablename__ = "bot_user_data"
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class BotConversations(Base):
+    """Persisted ConversationHandler states, one row per conversation key"""
+    __tablename__ = "bot_conversations"
+    name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)      # JSON-encoded conversation key, e.g. "[chat_id, user_id]"
+    state = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+def dialect_insert(table):
+    """INSERT construct for the engine's dialect, supporting ON CONFLICT clauses"""
+    insert = sqlite.insert if engine.dialect.name == "sqlite" else postgresql.insert
+    return insert(table)
+
+def bump_data_version(session, user_id):
+    """Mark the user's expenses as changed (call in the same transaction as the change)"""
+    stmt = dialect_insert(UserDataVersions).values(user_id=user_id, version=1)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[UserDataVersions.user_id],
+        set_={"version": UserDataVersions.version + 1},
+    ))
+
+def get_data_version(session, user_id) -> int:
+    """The user's current data version (0 if their expenses have never changed)"""
+    version = session.execute(
+        select(UserDataVersions.version).where(UserDataVersions.user_id == user_id)
+    ).scalar_one_or_none()
+    return version or 0
+
+def init_db():
+    """Create any tables that don't exist yet (existing tables are left untouched)"""
+    backfill_categories = not inspect(engine).has_table(UserCategories.__tablename__)
+    backfill_budget_totals = not inspect(engine).has_table(BudgetTotals.__tablename__)
+    Base.metadata.create_all(engine)
+
+    # create_all skips columns and indexes added to tables that already exist
+    existing_columns = {column["name"] for column in inspect(engine).get_columns(Expenses.__tablename__)}
+    with engine.begin() as conn:
+        for column in Expenses.__table__.columns:
+            if column.name not in existing_columns:
+                conn.execute(text(f"ALTER TABLE {Expenses.__tablename__} ADD COLUMN {column.name} "
+                                  f"{column.type.compile(dialect=engine.dialect)}"))
+    for index in Expenses.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+    if engine.dialect.name == "postgresql":
+        # trigram index for fuzzy description search (search_svc falls back to scanning without it)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_description_trgm "
+                                  "ON expenses USING gin (description gin_trgm_ops)"))
+        except exc.SQLAlchemyError as e:
+            logging.warning("Could not create trigram index for expense search: %s", str(e))
+
+    if backfill_categories:
+        # first run with the category index - build it from existing expenses
+        with engine.begin() as conn:
+            conn.execute(insert(UserCategories).from_select(
+                ["user_id", "category"],
+                select(Expenses.user_id, Expenses.category).distinct(),
+            ))
+
+    if backfill_budget_totals:
+        # first run with budget totals - sum the expenses converted to the base currency so far
+        # (fx_svc adds the rest as it converts them)
+        if engine.dialect.name == "sqlite":
+            month = func.date(Expenses.date, "start of month")
+        else:
+            month = cast(func.date_trunc("month", Expenses.date), Date)
+        with engine.begin() as conn:
+            conn.execute(insert(BudgetTotals).from_select(
+                ["user_id", "category", "month", "spent"],
+                select(Expenses.user_id, Expenses.category, month, func.sum(Expenses.base_amount))
+                .where(Expenses.base_amount.isnot(None))
+                .group_by(Expenses.user_id, Expenses.category, month),
+            ))
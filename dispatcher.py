@@ -0,0 +1,118 @@
+"""In-process update dispatcher with per-chat FIFO lanes and a bounded worker pool"""
+import asyncio
+import logging
+import time
+from collections import deque
+import metrics
+
+
+class UpdateDispatcher:
+    """
+    Serialises updates per chat while processing different chats concurrently.
+
+    Each chat gets its own FIFO lane. Chats with pending updates are queued in round-robin order
+    and served by a fixed number of workers, so a chat is only ever handled by one worker at a
+    time (keeping ConversationHandler states consistent) and a busy chat can't starve the others.
+    Updates are shed once a lane or the dispatcher as a whole is full.
+    """
+
+    def __init__(self, process, max_workers: int, max_lane_depth: int, max_pending: int):
+        """
+        Args:
+            process (coroutine function) : called with each update to process it
+            max_workers (int) : maximum number of updates processed concurrently across all chats
+            max_lane_depth (int) : maximum number of queued updates per chat
+            max_pending (int) : maximum number of queued updates across all chats
+        """
+        self._process = process
+        self._max_workers = max_workers
+        self._max_lane_depth = max_lane_depth
+        self._max_pending = max_pending
+        self._lanes = {}            # chat key -> deque of (update, enqueued_at)
+        self._ready = None          # queue of chat keys with work that no worker is serving yet
+        self._workers = []
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def pending(self) -> int:
+        """Number of updates queued or being processed"""
+        return self._pending
+
+    async def start(self):
+        """Start the worker pool"""
+        self._ready = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            for i in range(self._max_workers)
+        ]
+
+    async def stop(self, timeout: float = 30.0):
+        """Wait (up to timeout seconds) for queued updates to finish, then stop the workers"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Dispatcher stopped with %d updates still pending", self._pending)
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def is_busy(self, key) -> bool:
+        """Whether the chat has an update queued or being processed"""
+        return key in self._lanes
+
+    def submit(self, key, update) -> bool:
+        """
+        Queue an update on the lane for the given chat key.
+        Returns:
+            bool : True if queued, False if the update was shed because the queue is full
+        """
+        lane = self._lanes.get(key)
+        lane_depth = len(lane) if lane else 0
+        if lane_depth >= self._max_lane_depth or self._pending >= self._max_pending:
+            metrics.increment("dispatcher.shed")
+            logging.warning("Shedding update for chat %s (lane depth %d, pending %d)",
+                            key, lane_depth, self._pending)
+            return False
+
+        if lane is None:
+            # new (or idle) chat - create its lane and schedule it for a worker
+            lane = self._lanes[key] = deque()
+            self._ready.put_nowait(key)
+        lane.append((update, time.perf_counter()))
+
+        self._pending += 1
+        self._idle.clear()
+        metrics.increment("dispatcher.submitted")
+        metrics.set_gauge("dispatcher.pending", self._pending)
+        return True
+
+    async def _worker(self):
+        """Serve one chat lane at a time, one update per turn, until cancelled"""
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            update, enqueued_at = lane.popleft()
+
+            started_at = time.perf_counter()
+            metrics.observe("dispatcher.queue_wait", started_at - enqueued_at)
+            try:
+                await self._process(update)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error("Error processing update for chat %s: %s", key, str(e))
+            finally:
+                metrics.observe("dispatcher.process_time", time.perf_counter() - started_at)
+
+                # requeue the chat behind the others if it still has work, otherwise retire its lane
+                if lane:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+
+                self._pending -= 1
+                metrics.set_gauge("dispatcher.pending", self._pending)
+                if self._pending == 0:
+                    self._idle.set()
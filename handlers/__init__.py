@@ -2,8 +2,11 @@ from .misc_handlers import start, quit_bot, reject_unexpected_messages, button_c
 from .expenses_handler import process_insert, refine_details, handle_confirmation, process_edit,\
     process_delete, delete_expense_confirmation, process_query, handle_category_rule
 from .export import export_expenses
+from .search import search
+from .budget import budget
+from .charts import chart
 
 __all__ = ["start", "quit_bot", "reject_unexpected_messages", "button_click",
            "process_insert", "refine_details", "handle_confirmation", "process_edit",
            "export_expenses", "process_delete", "delete_expense_confirmation", "process_query",
-           "handle_category_rule"]
+           "handle_category_rule", "search", "budget", "chart"]
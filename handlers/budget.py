@@ -0,0 +1,94 @@
+import re
+import html
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.expenses_svc import get_or_create_user, get_categories
+from services.budgets_svc import get_budget_status, set_budget, get_unconverted, format_unconverted_note, \
+    month_start, next_month_start
+from outbound import send_reply
+import config
+
+BUDGET_USAGE = ("💷 Send /budget to see what's left this month, /budget &lt;category&gt; &lt;amount&gt; to set a "
+                f"monthly budget in {config.BASE_CURRENCY} (e.g. /budget Food 300), or "
+                "/budget &lt;category&gt; off to remove one.")
+
+# simple "how much budget have I got left" questions, answered from the budget totals instead of the analyser
+# ("how many days are left this month" is for the analyser)
+BUDGET_QUESTION_PATTERN = re.compile(
+    r"^.{0,40}\b(?:budgets?\b.{0,30}\b(?:left|remaining|status)|(?:left|remaining)\b.{0,20}\bbudgets?)\b.{0,30}$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def is_budget_question(text: str) -> bool:
+    return bool(BUDGET_QUESTION_PATTERN.match(text or ""))
+
+
+def get_budget_unconverted(user_id) -> dict:
+    """The user's expenses this month that can't be counted towards budgets (see get_unconverted)"""
+    today = date.today()
+    return get_unconverted(user_id, month_start(today), next_month_start(today))
+
+
+def format_budget_status(statuses: list, unconverted: dict = None) -> str:
+    """HTML summary of what's left of the user's budgets this month"""
+    if not statuses:
+        return "You haven't set any budgets yet.\n\n" + BUDGET_USAGE
+    note = format_unconverted_note(unconverted)
+    lines = []
+    for status in statuses:
+        if status["remaining"] < 0:
+            left = f"<b>{-status['remaining']:.2f} over</b>"
+        else:
+            left = f"<b>{status['remaining']:.2f} left</b>"
+        lines.append(f"📂 {html.escape(status['category'])}: {left} "
+                     f"({status['spent']:.2f} of {status['budget']:.2f} spent)")
+    return (f"💷 <b>Budgets for {date.today():%B} ({config.BASE_CURRENCY}):</b>\n\n" + "\n".join(lines)
+            + (f"\n\n{html.escape(note, quote=False)}" if note else ""))
+
+
+async def budget(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """handles /budget command - shows what's left of the user's monthly budgets, or sets/removes one"""
+    user_id = context.user_data.get('user_id') or get_or_create_user(update.effective_user.id)
+    args = context.args or []
+
+    if not args:
+        await send_reply(update, format_budget_status(get_budget_status(user_id), get_budget_unconverted(user_id)),
+                         parse_mode='HTML')
+        return None     # stay in the current conversation state
+
+    if len(args) < 2:
+        await send_reply(update, BUDGET_USAGE, parse_mode='HTML')
+        return None
+
+    # use the user's spelling of an existing category, so the budget matches its expenses
+    category = " ".join(args[:-1])
+    category = next((existing for existing in get_categories(user_id)
+                     if existing.lower() == category.lower()), category.title())
+
+    if args[-1].lower() in ("off", "remove", "none"):
+        amount = None
+    else:
+        try:
+            amount = Decimal(args[-1].replace(",", ""))
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite() or amount <= 0:
+            await send_reply(update, BUDGET_USAGE, parse_mode='HTML')
+            return None
+
+    if not set_budget(user_id, category, amount):
+        await send_reply(update, "Sorry, I couldn't save your budget. Please try again later.")
+    elif amount is None:
+        await send_reply(update, f"🗑 Removed your {html.escape(category)} budget.", parse_mode='HTML')
+    else:
+        status = get_budget_status(user_id, category)[0]
+        note = format_unconverted_note(get_budget_unconverted(user_id))
+        await send_reply(update,
+                         f"✅ Your {html.escape(category)} budget is now <b>{amount:.2f} {config.BASE_CURRENCY}</b> "
+                         f"a month. {status['spent']:.2f} spent so far this month, "
+                         f"{status['remaining']:.2f} left." + (f"\n\n{html.escape(note, quote=False)}" if note else ""),
+                         parse_mode='HTML')
+    return None
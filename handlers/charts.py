@@ -0,0 +1,102 @@
+import re
+import asyncio
+import logging
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import ContextTypes
+from services.expenses_svc import get_or_create_user
+from services.charts_svc import CHART_TYPES, get_figure_class, get_chart, remember_chart_file, parse_month, \
+    add_months, chart_range
+from services.budgets_svc import get_unconverted, format_unconverted_note
+from outbound import send_reply
+
+CHART_ALIASES = {"pie": "categories", "category": "categories", "monthly": "trend", "months": "trend",
+                 "cumulative": "daily", "day": "daily"}
+CHART_USAGE = ("📊 Send /chart for this month's spending by category, /chart trend for the last 12 months, or "
+               "/chart daily for this month's running total. Add a month for an earlier one, "
+               "e.g. /chart categories 2026-01.")
+CHART_CAPTIONS = {
+    "categories": "📊 Your spending by category, {month:%B %Y}",
+    "trend": "📊 Your monthly spending up to {month:%B %Y}",
+    "daily": "📊 Your running total for {month:%B %Y}",
+}
+
+# requests for a chart in the analyser conversation ("show me a pie chart", "draw a graph of..."),
+# answered with a chart instead of the analyser; a chart word alone isn't enough ("total on graphics cards")
+CHART_QUESTION_PATTERN = re.compile(
+    r"\b(?:show|draw|make|give|send|generate|create|display|plot|see)\b.*"
+    r"\b(?:chart|graph|plot|pie chart|visuali[sz]ation)s?\b"
+    r"|^(?:please\s+)?visuali[sz]e\b",
+    re.IGNORECASE,
+)
+TREND_QUESTION_PATTERN = re.compile(r"\b(trend|monthly|over time|per month|each month|months)\b", re.IGNORECASE)
+DAILY_QUESTION_PATTERN = re.compile(r"\b(daily|cumulative|running|per day|each day|by day)\b", re.IGNORECASE)
+LAST_MONTH_PATTERN = re.compile(r"\blast month\b", re.IGNORECASE)
+
+
+def parse_chart_question(text: str):
+    """The (chart type, month) a chart request in the analyser conversation asks for, or None if it isn't one"""
+    if not CHART_QUESTION_PATTERN.search(text or ""):
+        return None
+    if TREND_QUESTION_PATTERN.search(text):
+        chart = "trend"
+    elif DAILY_QUESTION_PATTERN.search(text):
+        chart = "daily"
+    else:
+        chart = "categories"
+    month = parse_month("")
+    if LAST_MONTH_PATTERN.search(text):
+        month = add_months(month, -1)
+    return chart, month
+
+
+async def send_chart(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, chart: str, month) -> bool:
+    """Send a chart of the user's spending, reusing an earlier upload of it if the data hasn't changed.
+    Expenses without an exchange rate (which the chart leaves out) are pointed out.
+    Returns False if there's nothing to chart."""
+    chat_id = update.effective_chat.id
+    note = format_unconverted_note(await asyncio.to_thread(get_unconverted, user_id, *chart_range(chart, month)))
+    caption = CHART_CAPTIONS[chart].format(month=month) + (f"\n\n{note}" if note else "")
+    image = await asyncio.to_thread(get_chart, user_id, chart, month)
+    if image is None:
+        if note:
+            await send_reply(update, f"😔 There's nothing I can chart for {month:%B %Y} yet. {note}")
+            return True
+        return False
+
+    if "file_id" in image:
+        try:
+            await context.bot.send_photo(chat_id, photo=image["file_id"], caption=caption)
+            return True
+        except BadRequest as e:
+            # the file is no longer usable (e.g. the bot's token changed) - upload it again
+            logging.info("Could not resend chart, uploading it again: %s", str(e))
+            image = await asyncio.to_thread(get_chart, user_id, chart, month, False)
+            if image is None:
+                return False
+
+    message = await context.bot.send_photo(chat_id, photo=image["png"], caption=caption)
+    if message and message.photo:
+        await asyncio.to_thread(remember_chart_file, user_id, chart, month, image["version"],
+                                message.photo[-1].file_id)
+    return True
+
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """handles /chart command - sends a chart of the user's spending"""
+    args = context.args or []
+    chart_type = args[0].lower() if args else "categories"
+    chart_type = CHART_ALIASES.get(chart_type, chart_type)
+    month = parse_month(args[1] if len(args) > 1 else "")
+    if chart_type not in CHART_TYPES or month is None or len(args) > 2:
+        await send_reply(update, CHART_USAGE)
+        return None     # stay in the current conversation state
+
+    if get_figure_class() is None:
+        await send_reply(update, "Sorry, charts aren't available at the moment.")
+        return None
+
+    user_id = context.user_data.get('user_id') or get_or_create_user(update.effective_user.id)
+    if not await send_chart(update, context, user_id, chart_type, month):
+        await send_reply(update, f"😔 I don't have any expenses to chart for {month:%B %Y} yet.")
+    return None
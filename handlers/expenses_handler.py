@@ -1,17 +1,28 @@
 import re
 import os
 import time
+import html
 import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
-from telegram.error import TimedOut, NetworkError
+from telegram.error import TimedOut, NetworkError, BadRequest, TelegramError
 from md2tgmd import escape
 from services.gemini_svc import process_expense_text, process_expense_image, refine_expense_details
-from services.expenses_svc import insert_expense, update_expense, get_or_create_user, \
-    exact_expense_matching, delete_all_expenses, delete_specific_expense, get_categories, \
-    get_user_preferred_currency, set_user_preferred_currency, get_category_rules, insert_category_rule
-from services.sql_agent_svc import analyser_agent
-from utils import str_to_json, get_current_date
+from services.expenses_svc import record_expense, record_expense_message, get_or_create_user, \
+    find_expense_id, delete_all_expenses, delete_specific_expense, get_categories, \
+    get_user_preferred_currency, set_user_preferred_currency, get_category_rules, insert_category_rule, to_date
+from services.sql_agent_svc import get_analyser_agent, get_final_answer_call, format_query_prompt
+from services.merchants_svc import apply_merchant_preferences
+from services.classifier_svc import predict_category
+from services.corrections_svc import apply_correction
+from services.routing_svc import choose_analyst_model
+from services.budgets_svc import get_budget_alert, get_budget_status
+from services.charts_svc import get_figure_class
+from outbound import send_reply
+from utils import str_to_json
+import metrics
+from .budget import is_budget_question, format_budget_status, get_budget_unconverted
+from .charts import parse_chart_question, send_chart
 from config import WAITING_FOR_EXPENSE, AWAITING_CONFIRMATION, AWAITING_REFINEMENT, \
     AWAITING_EDIT, AWAITING_DELETE_REQUEST, AWAITING_DELETE_CONFIRMATION, AWAITING_QUERY, \
     AWAITING_CATEGORY_RULE
@@ -31,55 +42,123 @@ rule_keyboard = [
 ]
 rule_reply_markup = InlineKeyboardMarkup(rule_keyboard)
 
+# minimum seconds between edits of a progress message (Telegram rate limits message edits)
+PROGRESS_EDIT_INTERVAL = 1.5
+
+
+def budget_note(user_id, expense_id, parsed_expense) -> str:
+    """Warning for a confirmation message if the expense's category is nearly or over its budget"""
+    if not expense_id:
+        return ""
+    alert = get_budget_alert(user_id, parsed_expense['category'], to_date(parsed_expense['date']), expense_id)
+    return f"{html.escape(alert)}\n\n" if alert else ""
+
+
+def matches_category_rule(text: str, category_rules: list) -> bool:
+    """Whether any of the user's category rule keywords appears in the text"""
+    text = text.lower()
+    return any(rule['keyword'].lower() in text for rule in category_rules or [])
+
+
+def format_partial_expense(fields: dict) -> str:
+    """format the expense fields parsed so far, with placeholders for the ones still to come"""
+    price = fields.get('price')
+
+    def field(name):
+        return html.escape(str(fields.get(name, '…')))
+
+    return (
+        f"⏳ <b>Reading your expense...</b>\n"
+        f"📈 <b>Currency:</b> {field('currency')}\n"
+        f"💰 <b>Amount:</b> {f'{price:.2f}' if isinstance(price, (int, float)) else '…'}\n"
+        f"📂 <b>Category:</b> {field('category')}\n"
+        f"📝 <b>Description:</b> {field('description')}\n"
+        f"📅 <b>Date:</b> {field('date')}"
+    )
+
 
 async def process_insert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles expense text processing"""
     message = update.message
 
+    if not message.text and not message.photo:
+        await message.reply_text("⚠️ I'm sorry, I don't know what that is. Please send either a text message or photo!")
+        return WAITING_FOR_EXPENSE
+
+    # placeholder that is filled in as gemini streams the fields, so the user sees progress right away
+    placeholder = await message.reply_text(format_partial_expense({}), parse_mode="HTML")
+    last_edit_ts = time.time()
+
+    async def show_fields(fields: dict):
+        nonlocal last_edit_ts
+        now = time.time()
+        if now - last_edit_ts <= PROGRESS_EDIT_INTERVAL:
+            return
+        try:
+            await placeholder.edit_text(format_partial_expense(fields), parse_mode="HTML")
+            last_edit_ts = now
+        except TelegramError as e:
+            # progress is best effort - an error here mustn't fail the parse (and make it fail over),
+            # the final details are sent regardless
+            logging.info("Could not show parsed fields: %s", str(e))
+
     # Get user's preferred currency and existing categories
     telegram_id = update.effective_user.id
     context.user_data['telegram_id'] = telegram_id
     preferred_currency = get_user_preferred_currency(telegram_id)
     user_id = get_or_create_user(telegram_id)
     context.user_data['user_id'] = user_id
-    existing_categories = get_categories(user_id)
     category_rules = get_category_rules(user_id)
+    predicted_category = None
 
     if message.text:
         user_input = message.text
+        # the user's own classifier fills the category when it's confident, so the LLM doesn't
+        # need the list of existing categories - unless one of the user's category rules applies,
+        # which always wins
+        if not matches_category_rule(user_input, category_rules):
+            predicted_category = predict_category(user_id, user_input)
+        existing_categories = None if predicted_category else get_categories(user_id)
         logging.info('calling gemini...')
-        response = await process_expense_text(user_input, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules)
+        response = await process_expense_text(user_input, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules, known_category=predicted_category, on_fields=show_fields)
         logging.info('response generated')
 
-    elif message.photo:
+    else:
+        existing_categories = get_categories(user_id)
         image = message.photo[-1]
         image_file = await image.get_file()
         image_path = f"/tmp/{image_file.file_unique_id}.jpg"
         await image_file.download_to_drive(custom_path=image_path)
         if message.caption:
             img_caption = message.caption
-            response = await process_expense_image(image_path, caption=img_caption, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules)
+            response = await process_expense_image(image_path, caption=img_caption, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules, on_fields=show_fields)
         else:
-            response = await process_expense_image(image_path, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules)
+            response = await process_expense_image(image_path, preferred_currency=preferred_currency, existing_categories=existing_categories, category_rules=category_rules, on_fields=show_fields)
         os.remove(image_path)   # remove image after parsing completed
-    else:
-        await message.reply_text("⚠️ I'm sorry, I don't know what that is. Please send either a text message or photo!")
-        return WAITING_FOR_EXPENSE
 
     json_response = str_to_json(response)
+    if isinstance(json_response, dict):
+        if predicted_category:
+            json_response['category'] = predicted_category
+        # canonical merchant name and exact-match category rules
+        apply_merchant_preferences(user_id, json_response, category_rules)
     context.user_data['parsed_expense'] = json_response
+    context.user_data.pop('merchant_alias', None)
 
-    await update.message.reply_text(
+    details = (
         f"📌 <b>Here are the details I got from your text:</b>\n"
-        f"📈 <b>Currency:</b> {json_response['currency']}\n"
+        f"📈 <b>Currency:</b> {html.escape(str(json_response['currency']))}\n"
         f"💰 <b>Amount:</b> {json_response['price']:.2f}\n"
-        f"📂 <b>Category:</b> {json_response['category']}\n"
-        f"📝 <b>Description:</b> {json_response['description']}\n"
-        f"📅 <b>Date:</b> {json_response['date']}\n\n"
-        f"Is this correct?",
-        reply_markup=reply_markup,
-        parse_mode="HTML"
+        f"📂 <b>Category:</b> {html.escape(str(json_response['category']))}\n"
+        f"📝 <b>Description:</b> {html.escape(str(json_response['description']))}\n"
+        f"📅 <b>Date:</b> {html.escape(str(json_response['date']))}\n\n"
+        f"Is this correct?"
     )
+    # the placeholder becomes the confirmation message
+    try:
+        await placeholder.edit_text(details, reply_markup=reply_markup, parse_mode="HTML")
+    except (TimedOut, NetworkError):
+        await update.message.reply_text(details, reply_markup=reply_markup, parse_mode="HTML")
 
     return AWAITING_CONFIRMATION
 
@@ -87,12 +166,12 @@ async def process_insert(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """handle user response from inline keyboard"""
     query = update.callback_query
-    await query.answer()
+    # acknowledge with a notification rather than a separate "recording..." message
+    await query.answer("✅ Great! Let me record your expense..." if query.data == "confirmation" else None)
 
     chat_id = query.message.chat_id
 
     if query.data == "confirmation":
-        await context.bot.send_message(chat_id,"✅ Great! Let me record your expense...")
         parsed_expense = context.user_data.get('parsed_expense', '')
         telegram_id = update.effective_user.id
         # in handle_confirmation, use cached user_id if available, otherwise create new user
@@ -108,50 +187,63 @@ async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
             # update expense
             if is_editing_expense:
                 expense_id_for_edit = context.user_data.get("editing_expense_id")
-                expense_id = update_expense(
-                    expense_id=expense_id_for_edit,
+                expense_id = record_expense(
+                    user_id=user_id,
                     price=parsed_expense['price'],
                     category=parsed_expense['category'],
                     description=parsed_expense['description'],
                     date=parsed_expense['date'],
-                    currency=parsed_expense['currency']
+                    currency=parsed_expense['currency'],
+                    expense_id=expense_id_for_edit
                 )
                 context.user_data['is_editing'] = False
-                await context.bot.send_message(chat_id,
+                budget_warning = budget_note(user_id, expense_id, parsed_expense)
+                confirmation_message = await context.bot.send_message(chat_id,
                                             "<b>✅ Your expense has been updated successfully!</b>\n"
                                             f"📈 <b>Currency:</b> {parsed_expense['currency']}\n"
                                             f"💰 <b>Amount:</b> {parsed_expense['price']:.2f}\n"
                                             f"📂 <b>Category:</b> {parsed_expense['category']}\n"
                                             f"📝 <b>Description:</b> {parsed_expense['description']}\n"
                                             f"📅 <b>Date:</b> {parsed_expense['date']}\n\n"
-                                            f"<b>Expense ID:</b> {expense_id}\n",
+                                            f"{budget_warning}"
+                                            f"<b>Expense ID:</b> {expense_id}\n\n"
+                                            "Would you like to add a new expense? Type it below or send /start to go back to the main menu.",
                                             parse_mode = 'HTML')
-                await context.bot.send_message(chat_id, "Would you like to add a new expense? Type it below or send /start to go back to the main menu.")
+                if expense_id:
+                    # remember the message's expense so replies to it can be resolved directly
+                    record_expense_message(chat_id, confirmation_message.message_id, expense_id)
 
             else:
-                # insert expense into the database
-                expense_id = insert_expense(
+                # insert expense into the database (also updates preferred currency to match it)
+                expense_id = record_expense(
                     user_id=user_id,
                     price=parsed_expense['price'],
                     category=parsed_expense['category'],
                     description=parsed_expense['description'],
                     date=parsed_expense['date'],
-                    currency=parsed_expense['currency']
+                    currency=parsed_expense['currency'],
+                    merchant_alias=context.user_data.pop('merchant_alias', None)
                 )
-                # update preferred currency to match the confirmed expense
-                set_user_preferred_currency(telegram_id, parsed_expense['currency'])
-                await context.bot.send_message(chat_id,
+                # if category was corrected, ask user if they want to save as a rule (instead of
+                # prompting for the next expense, which is otherwise part of the same message)
+                ask_for_rule = context.user_data.get('category_corrected', False)
+                next_prompt = "" if ask_for_rule else \
+                    "\n\nWould you like to add another expense? Type it below or send /start to go back to the main menu."
+                budget_warning = budget_note(user_id, expense_id, parsed_expense)
+                confirmation_message = await context.bot.send_message(chat_id,
                                             "<b>✅ Your expense has been recorded successfully!</b>\n"
                                             f"📈 <b>Currency:</b> {parsed_expense['currency']}\n"
                                             f"💰 <b>Amount:</b> {parsed_expense['price']:.2f}\n"
                                             f"📂 <b>Category:</b> {parsed_expense['category']}\n"
                                             f"📝 <b>Description:</b> {parsed_expense['description']}\n"
                                             f"📅 <b>Date:</b> {parsed_expense['date']}\n\n"
-                                            f"<b>Expense ID:</b> {expense_id}\n",
+                                            f"{budget_warning}"
+                                            f"<b>Expense ID:</b> {expense_id}{next_prompt}",
                                             parse_mode = 'HTML')
+                if expense_id:
+                    record_expense_message(chat_id, confirmation_message.message_id, expense_id)
 
-                # if category was corrected, ask user if they want to save as a rule
-                if context.user_data.get('category_corrected', False):
+                if ask_for_rule:
                     description = parsed_expense['description']
                     category = parsed_expense['category']
                     context.user_data['category_corrected'] = False
@@ -166,8 +258,6 @@ async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
                     )
                     return AWAITING_CATEGORY_RULE
 
-                await context.bot.send_message(chat_id, "Would you like to add another expense? Type it below or send /start to go back to the main menu.")
-
         else:
             await context.bot.send_message(chat_id,"⚠️ There was an issue processing your request. Please try again.")
 
@@ -187,8 +277,14 @@ async def refine_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     original_currency = original_details.get('currency', '') if isinstance(original_details, dict) else ''
     original_category = original_details.get('category', '') if isinstance(original_details, dict) else ''
 
-    refined_response = await refine_expense_details(original_details, user_feedback)
-    json_refined_response = str_to_json(refined_response)
+    # simple field corrections are applied locally, anything else goes back to the LLM
+    json_refined_response = apply_correction(original_details, user_feedback)
+    if json_refined_response is not None:
+        metrics.increment("refine.local")
+    else:
+        metrics.increment("refine.llm")
+        refined_response = await refine_expense_details(original_details, user_feedback)
+        json_refined_response = str_to_json(refined_response)
 
     # Check if currency was changed during refinement
     refined_currency = json_refined_response.get('currency', '')
@@ -198,6 +294,12 @@ async def refine_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         set_user_preferred_currency(telegram_id, refined_currency)
         logging.info("Updated preferred currency for user %s to %s", telegram_id, refined_currency)
 
+    # Track if the description (merchant) was corrected, to learn it as an alias on confirmation
+    original_description = original_details.get('description', '') if isinstance(original_details, dict) else ''
+    refined_description = json_refined_response.get('description', '')
+    if original_description and refined_description and original_description != refined_description:
+        context.user_data.setdefault('merchant_alias', original_description)
+
     # Track if category was corrected by the user
     refined_category = json_refined_response.get('category', '')
     if original_category and refined_category and original_category != refined_category:
@@ -230,16 +332,12 @@ async def process_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return AWAITING_EDIT
 
     # extract expense details from the replied-to message
-    original_text = update.message.reply_to_message.text
+    replied_message = update.message.reply_to_message
+    original_text = replied_message.text
 
     await update.message.reply_text("⏱️ Trying to find the expense in the database...")
-    # try to extract expense ID for easier matching
-    match = re.search(r"Expense ID:\s*(\d+)", original_text)
-
-    if match:
-        expense_id = int(match.group(1))
-    else:
-        expense_id = exact_expense_matching(original_text)      # extract expense ID using exact details in database
+    user_id = context.user_data.get('user_id') or get_or_create_user(update.effective_user.id)
+    expense_id = find_expense_id(user_id, replied_message.chat_id, replied_message.message_id, original_text)
 
     if not expense_id:
         await update.message.reply_text("⚠️ Sorry, I couldn't find the expense in the database. Please try again.")
@@ -299,17 +397,12 @@ async def process_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return AWAITING_DELETE_REQUEST
 
     # extract expense details from the replied-to message
-    original_text = update.message.reply_to_message.text
+    replied_message = update.message.reply_to_message
+    original_text = replied_message.text
 
     await update.message.reply_text("⏱️ Trying to find the expense in the database...")
-
-    # try to extract expense ID for easier matching
-    match = re.search(r"Expense ID:\s*(\d+)", original_text)
-
-    if match:
-        expense_id = int(match.group(1))
-    else:
-        expense_id = exact_expense_matching(original_text)      # extract expense ID using exact details in database
+    user_id = context.user_data.get('user_id') or get_or_create_user(update.effective_user.id)
+    expense_id = find_expense_id(user_id, replied_message.chat_id, replied_message.message_id, original_text)
 
     if not expense_id:
         await update.message.reply_text("⚠️ Sorry, I couldn't find the expense in the database. Please try again.")
@@ -366,22 +459,25 @@ async def process_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
 
     user_query = update.message.text
+    if is_budget_question(user_query):
+        statuses = get_budget_status(user_id)
+        if statuses:
+            # answered from the running budget totals - no need for the analyser
+            await send_reply(update, format_budget_status(statuses, get_budget_unconverted(user_id)) +
+                             "\n\nAsk me anything else or type /start to return to the main menu.",
+                             parse_mode='HTML')
+            return AWAITING_QUERY
+
+    chart_request = parse_chart_question(user_query)
+    if chart_request and get_figure_class() is not None:
+        # charts are drawn from the pre-aggregated totals - no need for the analyser
+        chart, month = chart_request
+        if not await send_chart(update, context, user_id, chart, month):
+            await send_reply(update, f"😔 I don't have any expenses to chart for {month:%B %Y} yet.")
+        return AWAITING_QUERY
+
     previous_answer = context.user_data.get('expense_analysis', "")
-    today, day = get_current_date()
-    prompt = f"""
-    The user's query is: {user_query}.
-    
-    The user's UUID is {user_id}. ONLY query rows that belong to the user.
-    
-    Previous answer you provided: {previous_answer}.
-    Today's date is {today}. Today is {day}. Infer the date requested by the user based on today's date and previous answer.
-    
-    If the previous answer is outdated or does not help with getting what the user is requesting for, disregard it.
-    
-    The list of categories in the user's database is: {categories}.
-
-    
-    """
+    prompt = format_query_prompt(user_query, user_id, categories, previous_answer)
 
     # Send initial message
     processing_msg = await context.bot.send_message(
@@ -392,10 +488,25 @@ async def process_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     last_sent_ts = 0.0
     last_text = None
 
+    async def show_result(text: str, parse_mode: str = None):
+        # the progress message becomes the answer, so a query takes one message instead of three requests
+        try:
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=processing_msg.message_id,
+                                                parse_mode=parse_mode)
+        except BadRequest:
+            # e.g. the progress message was deleted - send the answer on its own
+            try:
+                await context.bot.send_message(chat_id, text, parse_mode=parse_mode)
+            except (TimedOut, NetworkError):
+                pass
+        except (TimedOut, NetworkError):
+            pass
+
     try:
         # Set up the stream handler
-        async for chunk in analyser_agent.astream(
+        async for chunk in get_analyser_agent().astream(
             {"messages": [("user", prompt)]},
+            config={"configurable": {"analyst_model": choose_analyst_model(user_query)}},
             stream_mode=["updates", "custom"]
             ):
 
@@ -404,7 +515,7 @@ async def process_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 message_to_send = chunk[1].get('custom', 'Processing...')
 
                 now = time.time()
-                if (message_to_send != last_text) and (now - last_sent_ts > 1.5):
+                if (message_to_send != last_text) and (now - last_sent_ts > PROGRESS_EDIT_INTERVAL):
                     try:
                         await context.bot.edit_message_text(
                             message_to_send,
@@ -420,62 +531,36 @@ async def process_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if isinstance(chunk, tuple) and 'analyst' in chunk[1]:
                 # extract final answer from analyst node when SubmitFinalAnswer is called
                 last_msg = chunk[1]['analyst']['messages'][-1]
-                if hasattr(last_msg, 'tool_calls') and last_msg.tool_calls and last_msg.tool_calls[0]["name"] == "SubmitFinalAnswer":
-                    final_answer = last_msg.tool_calls[0]["args"]["final_answer"]
-
-        # loop has ended, delete progress report message
-        try:
-            await context.bot.delete_message(
-                    chat_id=chat_id,
-                    message_id=processing_msg.message_id
-                )
-        except (TimedOut, NetworkError):
-            pass
+                final_call = get_final_answer_call(last_msg)
+                if final_call:
+                    final_answer = final_call["args"]["final_answer"]
 
         # check for final answer
         if final_answer:
-            # convert final answer to MarkdownV2 and send to user
+            # convert final answer to MarkdownV2 and show it in place of the progress report
             formatted_ans = escape(final_answer)
-            try:
-                await context.bot.send_message(
-                                chat_id,
-                                f"{formatted_ans}\n\nAsk me anything else or type /start to return to the main menu\\.",
-                                parse_mode='MarkdownV2'
-                )
-            except (TimedOut, NetworkError):
-                pass
+            await show_result(
+                f"{formatted_ans}\n\nAsk me anything else or type /start to return to the main menu\\.",
+                parse_mode='MarkdownV2'
+            )
             # Store answer for potential follow-up questions
             context.user_data['expense_analysis'] = final_answer
             return AWAITING_QUERY
         else:
             # if we didn't get a proper final result
-            try:
-                await context.bot.send_message(
-                    chat_id,
-                    "Sorry, I couldn't process your query properly. Please try again or type /start to return to the main menu."
-                )
-            except (TimedOut, NetworkError):
-                pass
+            await show_result(
+                "Sorry, I couldn't process your query properly. Please try again or type /start to return to the main menu."
+            )
             return AWAITING_QUERY
 
     except Exception as e: # pylint: disable=broad-except
         # probably no longer an issue now that we're using gpt-4o-mini
         if '429' in str(e):
-            try:
-                await context.bot.send_message(
-                    chat_id,
-                    "Sorry, I am unable to answer your query at this moment due to rate limits 😓... Please try again later."
-                )
-            except (TimedOut, NetworkError):
-                pass
+            await show_result(
+                "Sorry, I am unable to answer your query at this moment due to rate limits 😓... Please try again later."
+            )
         else:
-            try:
-                await context.bot.send_message(
-                    chat_id,
-                    f"Sorry, there was an error in processing your query: {str(e)}. Please try again later."
-                )
-            except (TimedOut, NetworkError):
-                pass
+            await show_result(f"Sorry, there was an error in processing your query: {str(e)}. Please try again later.")
 
     return WAITING_FOR_EXPENSE
 
@@ -1,6 +1,7 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler
 from services import get_or_create_user
+from outbound import send_reply
 from config import WAITING_FOR_EXPENSE, AWAITING_EDIT, AWAITING_DELETE_REQUEST, AWAITING_QUERY, AWAITING_EXPORT_CONFIRMATION
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -10,10 +11,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check if user has a username set
     if not tele_handle:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Sorry, you need to set a Telegram username to use this bot. "
-                 "Please set a username in your Telegram settings and try again."
+        await send_reply(
+            update,
+            "Sorry, you need to set a Telegram username to use this bot. "
+            "Please set a username in your Telegram settings and try again."
         )
         return ConversationHandler.END
 
@@ -29,20 +30,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     start_markup = InlineKeyboardMarkup(start_keyboard)
 
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"Hello {tele_handle}! What would you like to do?",
+    await send_reply(
+        update,
+        f"Hello {tele_handle}! What would you like to do?",
         reply_markup=start_markup
     )
 
 async def quit_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles /quit command and ends the conversation."""
-    await update.message.reply_text("Goodbye! Type /start if you need me again.")
+    await send_reply(update, "Goodbye! Type /start if you need me again.")
     return ConversationHandler.END
 
 async def reject_unexpected_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Rejects messages when no active conversation is happening."""
-    await update.message.reply_text("Unknown command. Please type /start to access the main menu.")
+    await send_reply(update, "Unknown command. Please type /start to access the main menu.")
 
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """handle button response from start menu"""
@@ -0,0 +1,33 @@
+import html
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.expenses_svc import get_or_create_user
+from services.search_svc import search_expenses
+from outbound import send_reply
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """handles /search command - finds the user's expenses by merchant or description"""
+    search_query = " ".join(context.args or [])
+    if not search_query:
+        await send_reply(update, "🔍 What should I look for? Send /search followed by a merchant or "
+                                 "description, e.g. /search starbucks")
+        return None     # stay in the current conversation state
+
+    user_id = context.user_data.get('user_id') or get_or_create_user(update.effective_user.id)
+    results = search_expenses(user_id, search_query)
+
+    if not results:
+        await send_reply(update, f"😔 I couldn't find any expenses matching \"{search_query}\".")
+        return None
+
+    lines = [
+        f"📅 {result['date']} · {html.escape(result['description'])} ({html.escape(result['category'])}) · "
+        f"<b>{result['price']:.2f} {result['currency']}</b> · ID {result['id']}"
+        for result in results
+    ]
+    await send_reply(
+        update,
+        f"🔍 <b>Expenses matching \"{html.escape(search_query)}\":</b>\n\n" + "\n".join(lines),
+        parse_mode='HTML'
+    )
+    return None
@@ -1,28 +1,36 @@
 import os
 import logging
 import asyncio
-import time
+from datetime import datetime
 from collections import OrderedDict
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
 from telegram.request import HTTPXRequest
 from telegram.error import TimedOut, NetworkError
 from telegram.ext import ContextTypes
-from ptbcontrib.postgres_persistence import PostgresPersistence
 from handlers import start, process_insert, process_edit, button_click, \
     reject_unexpected_messages, refine_details, handle_confirmation, quit_bot,\
     process_delete, delete_expense_confirmation, process_query, export_expenses, \
-    handle_category_rule
-from services import is_user_whitelisted
+    handle_category_rule, search, budget, chart
+from services import is_user_whitelisted, backfill_merchants, refresh_fx_rates, send_digests
 from config import BOT_TOKEN, LANGSMITH_API_KEY, WAITING_FOR_EXPENSE, AWAITING_CONFIRMATION, \
     AWAITING_REFINEMENT, AWAITING_EDIT, AWAITING_DELETE_REQUEST, AWAITING_DELETE_CONFIRMATION, \
-    AWAITING_QUERY, AWAITING_EXPORT_CONFIRMATION, AWAITING_CATEGORY_RULE
-from database import PERSISTENCE_URL
+    AWAITING_QUERY, AWAITING_EXPORT_CONFIRMATION, AWAITING_CATEGORY_RULE, \
+    MAX_CONCURRENT_UPDATES, MAX_CHAT_QUEUE_DEPTH, MAX_PENDING_UPDATES, \
+    PERSISTENCE_MAX_CACHED_USERS, PERSISTENCE_IDLE_TIMEOUT, TELEGRAM_API_URL, TELEGRAM_FILE_URL, \
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES, \
+    INLINE_REPLY_TIMEOUT, DIGEST_PERIODS, DIGEST_HOUR
+from database import init_db
+from persistence import SqlPersistence
+from dispatcher import UpdateDispatcher
+from outbound import OutboundRateLimiter, InlineReply, current_inline_reply
+import metrics
 
-# enable langsmith tracing
-os.environ["LANGSMITH_TRACING"] = "true"
+# enable langsmith tracing (unless explicitly disabled, e.g. for local benchmarks)
+os.environ.setdefault("LANGSMITH_TRACING", "true")
 os.environ["LANGSMITH_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGSMITH_PROJECT"] = "expense-bot-deployed"
 os.environ["LANGSMITH_API_KEY"] = LANGSMITH_API_KEY
@@ -33,11 +41,11 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
-# Create the bot application with PostgreSQL persistence 
+# Create the bot application with row-level database persistence (users are loaded on demand)
 # and set connect/read/write/pool timeout durations
-persistence = PostgresPersistence(
-    url=PERSISTENCE_URL,
-    on_flush=True
+persistence = SqlPersistence(
+    max_cached_users=PERSISTENCE_MAX_CACHED_USERS,
+    idle_timeout=PERSISTENCE_IDLE_TIMEOUT,
 )
 request = HTTPXRequest(
     connect_timeout=20.0,
@@ -45,21 +53,35 @@ request = HTTPXRequest(
     write_timeout=30.0,
     pool_timeout=5.0,
 )
-bot_app = Application.builder().token(BOT_TOKEN).persistence(persistence).request(request).build()
+# outbound requests are throttled to telegram's rate limits and retried after flood waits
+rate_limiter = OutboundRateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+bot_app = Application.builder().token(BOT_TOKEN).persistence(persistence).request(request) \
+    .rate_limiter(rate_limiter).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL).build()
+persistence.attach(bot_app)
 
 # Track processed update IDs to prevent duplicate processing from Telegram retries
 # OrderedDict preserves insertion order so we evict the oldest entry (not arbitrary)
 processed_updates = OrderedDict()
 MAX_PROCESSED_UPDATES = 1000  # Keep last 1000 to prevent memory issues
 
-# Track the periodic flush task and last update time
+# Track the periodic flush, merchant backfill, exchange rate and digest tasks
 flush_task = None
-last_update_time = None
-INACTIVITY_THRESHOLD = 600  # 10 minutes in seconds
+backfill_task = None
+fx_task = None
+digest_task = None
+FLUSH_INTERVAL = 30  # seconds; flushes only write changed rows, so they are cheap to run often
+DIGEST_CHECK_INTERVAL = 600  # seconds between checks for digests that are due
 
 # Define conversation handler with persistence enabled
 conv_handler = ConversationHandler(
-    entry_points=[CommandHandler("start", start), CallbackQueryHandler(button_click)],
+    entry_points=[CommandHandler("start", start), CommandHandler("search", search),
+                  CommandHandler("budget", budget), CommandHandler("chart", chart),
+                  CallbackQueryHandler(button_click)],
     states={
         WAITING_FOR_EXPENSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_insert),
                               MessageHandler(filters.PHOTO & ~filters.COMMAND, process_insert),
@@ -75,38 +97,51 @@ conv_handler = ConversationHandler(
         AWAITING_EXPORT_CONFIRMATION: [CallbackQueryHandler(export_expenses)],
         AWAITING_CATEGORY_RULE: [CallbackQueryHandler(handle_category_rule)]
     },
-    fallbacks=[CommandHandler("start", start), CommandHandler("quit", quit_bot)],
+    fallbacks=[CommandHandler("start", start), CommandHandler("quit", quit_bot),
+               CommandHandler("search", search), CommandHandler("budget", budget),
+               CommandHandler("chart", chart)],
     name="expense_conversation",  # Unique name for this conversation
     persistent=True,  # Enable persistence for this conversation
 )
 
 # Periodic flush function
 async def periodic_flush():
-    """Periodically flush persistence to database (every 60 seconds) if there's been recent activity"""
+    """Periodically hand changed user data/conversation states to the persistence and flush them.
+    Only changed rows are written, so a flush after no activity doesn't touch the database."""
     while True:
         try:
-            await asyncio.sleep(60)  # Wait 60 seconds
-            
-            if bot_app.persistence and last_update_time is not None:
-                # Check if there's been activity in the last 10 minutes
-                time_since_last_update = time.time() - last_update_time
-                
-                if time_since_last_update < INACTIVITY_THRESHOLD:
-                    # Recent activity detected, perform flush
-                    await bot_app.persistence.flush()
-                    logging.info("Persistence flushed successfully (last update %.1f seconds ago)", 
-                                time_since_last_update)
-                else:
-                    # No recent activity, skip flush to save resources
-                    logging.debug("Skipping flush due to inactivity (last update %.1f seconds ago)", 
-                                 time_since_last_update)
-                    
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+            if bot_app.persistence:
+                await bot_app.update_persistence()
+                await bot_app.persistence.flush()
+                # Everything is written now, so idle users can safely be dropped from memory
+                persistence.evict_idle_users()
+
         except asyncio.CancelledError:
             logging.info("Periodic flush task cancelled")
             break
         except Exception as e:  # pylint: disable=broad-except
             logging.error("Error during periodic flush: %s", str(e))
 
+# Scheduled digests
+async def periodic_digests():
+    """Send each configured period's digests once it has ended, from DIGEST_HOUR (off-peak) onwards.
+    Each period is claimed in the database, so only one instance sends it."""
+    while True:
+        try:
+            await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+
+            if datetime.now().hour >= DIGEST_HOUR:
+                for period in DIGEST_PERIODS:
+                    await send_digests(bot_app.bot, period)
+
+        except asyncio.CancelledError:
+            logging.info("Periodic digest task cancelled")
+            break
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error("Error sending digests: %s", str(e))
+
 # Define error handler for bot application
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Error handler for bot application"""
@@ -128,23 +163,39 @@ bot_app.add_error_handler(error_handler)
 # Define the lifespan context manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global flush_task  # pylint: disable=global-statement
+    global flush_task, backfill_task, fx_task, digest_task  # pylint: disable=global-statement
     
     # Startup: Initialize and start the bot
     try:
+        # Create any missing tables (e.g. persistence tables) before loading persisted data
+        await asyncio.to_thread(init_db)
+        # Assign merchants to expenses recorded before merchants existed (no-op once done)
+        backfill_task = asyncio.create_task(asyncio.to_thread(backfill_merchants))
+        # Load exchange rates and convert expenses that have no base currency amount yet
+        fx_task = asyncio.create_task(asyncio.to_thread(refresh_fx_rates))
+
         await bot_app.initialize()
         await bot_app.start()
         logging.info("Bot has started successfully with persistence enabled.")
 
         # Log persistence status
         if bot_app.persistence:
-            logging.info("PostgreSQL persistence is active")
+            logging.info("Database persistence is active")
         else:
             logging.warning("No persistence configured!")
 
+        # Start the update dispatcher's worker pool
+        await dispatcher.start()
+        logging.info("Update dispatcher started with %d workers", MAX_CONCURRENT_UPDATES)
+
         # Start periodic flush task
         flush_task = asyncio.create_task(periodic_flush())
-        logging.info("Periodic flush task started (flushes every 60 seconds)")
+        logging.info("Periodic flush task started (flushes every %d seconds)", FLUSH_INTERVAL)
+
+        # Start scheduled digests, if any are configured
+        if DIGEST_PERIODS:
+            digest_task = asyncio.create_task(periodic_digests())
+            logging.info("Digest task started (%s digests from %02d:00)", ", ".join(DIGEST_PERIODS), DIGEST_HOUR)
 
     except Exception as e: # pylint: disable=broad-except
         logging.error("Error starting bot: %s", str(e))
@@ -154,6 +205,10 @@ async def lifespan(app: FastAPI):
 
     # Shutdown: Stop the bot
     try:
+        # Let queued updates finish before persisting and stopping
+        await dispatcher.stop()
+        logging.info("Update dispatcher stopped")
+
         # Cancel periodic flush task
         if flush_task:
             flush_task.cancel()
@@ -163,12 +218,32 @@ async def lifespan(app: FastAPI):
                 pass
             logging.info("Periodic flush task stopped")
 
-        # Final flush before shutdown (ensure any pending data is saved)
-        if bot_app.persistence:
-            await bot_app.persistence.flush()
-            logging.info("Final persistence flush completed")
-        
+        # Cancel digest task
+        if digest_task:
+            digest_task.cancel()
+            try:
+                await digest_task
+            except asyncio.CancelledError:
+                pass
+            logging.info("Digest task stopped")
+
+        # Cancel the startup backfills if they're still running (a batch already in its worker
+        # thread finishes its transaction, the rest are picked up on the next startup)
+        for task in (backfill_task, fx_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.error("Startup backfill failed: %s", str(e))
+        logging.info("Startup backfill tasks stopped")
+
         await bot_app.stop()
+
+        # Shutting down hands over and flushes any remaining changes (ensure pending data is saved)
+        await bot_app.shutdown()
         logging.info("Bot has shut down.")
     except Exception as e: # pylint: disable=broad-except
         logging.error("Error stopping bot: %s", str(e))
@@ -182,21 +257,80 @@ async def root():
     return {"status": "Bot is running!"}
 
 
+# Metrics endpoint (dispatcher queue depth, shed counts, latencies)
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+# inline reply slots of the updates the webhook is waiting for, by update ID
+inline_replies = {}
+
+
 async def process_telegram_update(update: Update):
     """Process telegram update in background"""
+    # let the handlers reply in the webhook response if the webhook is waiting for this update
+    inline_reply = inline_replies.get(update.update_id)
+    token = current_inline_reply.set(inline_reply)
     try:
-        await bot_app.process_update(update)
+        # Load the user's data and conversation state on their first update
+        async with persistence.user_loaded(update):
+            await bot_app.process_update(update)
         logging.info("Successfully processed update %d", update.update_id)
     except Exception as e:
         logging.error("Error processing update %d: %s", update.update_id, str(e))
+    finally:
+        current_inline_reply.reset(token)
+        if inline_reply is not None:
+            inline_reply.done.set()
+
+
+# Updates are queued per chat so each user's updates are processed in order,
+# while a bounded pool of workers processes different users' updates concurrently
+dispatcher = UpdateDispatcher(
+    process_telegram_update,
+    max_workers=MAX_CONCURRENT_UPDATES,
+    max_lane_depth=MAX_CHAT_QUEUE_DEPTH,
+    max_pending=MAX_PENDING_UPDATES,
+)
+
+
+def get_dispatch_key(update: Update):
+    """Get the lane key for an update - its chat, falling back to its user (or itself if neither exists)"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return f"update-{update.update_id}"
+
+
+# commands with a cheap, single-message reply (the /start menu, /quit's goodbye); commands the bot doesn't
+# know get the one-line "Unknown command" reply. The rest (/search, /budget, /chart) query the database,
+# or reply with a photo, so they aren't worth holding the webhook for.
+INLINE_COMMANDS = {"start", "quit"}
+BOT_COMMANDS = INLINE_COMMANDS | {"search", "budget", "chart"}
+
+
+def wants_inline_reply(update: Update, key) -> bool:
+    """Whether the webhook should wait for the update's reply - cheap commands (see INLINE_COMMANDS)
+    from chats with nothing else queued"""
+    message = update.message
+    if not (message and message.text and message.text.startswith("/")):
+        return False
+    command = message.text.split()[0][1:].split("@")[0].lower()
+    return (command in INLINE_COMMANDS or command not in BOT_COMMANDS) and not dispatcher.is_busy(key)
+
+
+def telegram_method(method: str, **params) -> dict:
+    """A Bot API method call, to be returned as the webhook response instead of sent separately"""
+    metrics.increment("telegram.inline_replies")
+    return {"method": method, **params}
 
 
 # Webhook endpoint for Telegram updates
 @app.post("/")
-async def webhook(request: Request, background_tasks: BackgroundTasks):
+async def webhook(request: Request):
     """Handles webhook updates from Telegram"""
-    global last_update_time  # pylint: disable=global-statement
-    
     try:
         update_dict = await request.json()
         logging.info("Received update: %s", update_dict)
@@ -209,9 +343,8 @@ async def webhook(request: Request, background_tasks: BackgroundTasks):
             logging.warning("Duplicate update %d detected, skipping", update_id)
             return {"status": "ok"}
 
-        # Track this update and update last activity time
+        # Track this update
         processed_updates[update_id] = None
-        last_update_time = time.time()  # Record time of this update
         # Evict oldest entry to prevent unbounded growth
         if len(processed_updates) > MAX_PROCESSED_UPDATES:
             processed_updates.popitem(last=False)
@@ -222,12 +355,12 @@ async def webhook(request: Request, background_tasks: BackgroundTasks):
 
             # Check if user has no username set
             if not username:
-                await bot_app.bot.send_message(
+                return telegram_method(
+                    "sendMessage",
                     chat_id=update.effective_chat.id,
                     text="Sorry, you need to set a Telegram username to use this bot. "
                          "Please set a username in your Telegram settings and try again."
                 )
-                return {"status": "ok"}
 
             # Check if user is whitelisted (run in thread to avoid blocking event loop)
             if not await asyncio.to_thread(is_user_whitelisted, username):
@@ -236,17 +369,38 @@ async def webhook(request: Request, background_tasks: BackgroundTasks):
                     username,
                     update.effective_user.id
                 )
-                # Send rejection message
-                await bot_app.bot.send_message(
+                # Reply with the rejection message but don't process the update further
+                return telegram_method(
+                    "sendMessage",
                     chat_id=update.effective_chat.id,
                     text="Sorry, this bot is currently private and available only to whitelisted users. "
                          "Please contact the bot owner (@chrxmium) if you need access."
                 )
-                # Return ok to Telegram but don't process the update further
-                return {"status": "ok"}
 
-        # Add to background tasks and return immediately to prevent Telegram timeout retries
-        background_tasks.add_task(process_telegram_update, update)
+        key = get_dispatch_key(update)
+        inline_reply = InlineReply() if wants_inline_reply(update, key) else None
+        if inline_reply is not None:
+            inline_replies[update_id] = inline_reply
+
+        # Queue on the chat's lane and return immediately to prevent Telegram timeout retries
+        if not dispatcher.submit(key, update):
+            # Overloaded - forget the update and ask Telegram to redeliver it later
+            processed_updates.pop(update_id, None)
+            inline_replies.pop(update_id, None)
+            return JSONResponse(status_code=503, content={"status": "busy"})
+
+        if inline_reply is not None:
+            # Cheap command - wait (briefly) for its reply and return it in the response, saving
+            # the bot a separate request. Replies sent after the timeout go out normally.
+            try:
+                await asyncio.wait_for(inline_reply.done.wait(), timeout=INLINE_REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                inline_replies.pop(update_id, None)
+            payload = inline_reply.close()
+            if payload is not None:
+                return payload
         return {"status": "ok"}
 
     except (Exception) as e: # pylint: disable=broad-except
@@ -0,0 +1,70 @@
+"""Lightweight in-process metrics (counters, gauges and latency samples) exposed via /metrics"""
+import threading
+from collections import defaultdict, deque
+
+MAX_SAMPLES = 1000  # keep the most recent samples per metric to bound memory
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+
+def increment(name: str, value: int = 1):
+    """Increment a counter by the given value"""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float):
+    """Record a sample (e.g. a latency in seconds) for percentile reporting"""
+    with _lock:
+        _samples[name].append(value)
+
+
+def _pick(sorted_values: list, pct: float):
+    """nearest-rank percentile of an already sorted list"""
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def percentile(name: str, pct: float):
+    """Get the given percentile (0-100) of the recent samples for a metric, or None if no samples"""
+    with _lock:
+        values = sorted(_samples.get(name, ()))
+    if not values:
+        return None
+    return _pick(values, pct)
+
+
+def sample_count(name: str) -> int:
+    """Get the number of recent samples recorded for a metric"""
+    with _lock:
+        return len(_samples.get(name, ()))
+
+
+def snapshot() -> dict:
+    """Get a JSON-serialisable snapshot of all metrics"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        samples = {name: sorted(values) for name, values in _samples.items()}
+
+    summaries = {}
+    for name, values in samples.items():
+        if not values:
+            continue
+        summaries[name] = {
+            "count": len(values),
+            "p50": _pick(values, 50),
+            "p95": _pick(values, 95),
+            "p99": _pick(values, 99),
+            "max": values[-1],
+        }
+    return {"counters": counters, "gauges": gauges, "latencies": summaries}
@@ -0,0 +1,172 @@
+"""Outbound Telegram Bot API requests: rate limiting with retries after flood waits, and replies
+returned inline in the webhook response"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+
+GROUP_CHAT_RATE = 20 / 60     # telegram allows about 20 messages/minute in a group
+MAX_TRACKED_CHATS = 10000     # per-chat buckets kept (least recently used are dropped)
+# changes to messages the bot already sent (e.g. a progress message being filled in) have their own
+# per-chat bucket, so they don't hold up the new messages the user is waiting for; callback query
+# answers have no chat, so only the global limit applies to them
+EDIT_ENDPOINTS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia",
+                  "deleteMessage"}
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations instead of blocking, so requests are served in the
+    order they arrive. Tokens may go negative; a request then waits until its token has refilled.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def reserve(self) -> float:
+        """Take a token, returning how many seconds to wait before using it"""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate) - 1
+        self._updated = now
+        return max(0.0, -self._tokens / self.rate, self._paused_until - now)
+
+    def paused_for(self) -> float:
+        """Seconds left of a pause (0 if not paused)"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def pause(self, seconds: float):
+        """Hold all requests for the given time (e.g. after telegram asked to retry later)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Throttles requests to Telegram's rate limits - overall, and per chat - so that bursts of
+    replies are spread out instead of running into flood waits. If Telegram still answers with
+    RetryAfter, the chat (or the whole bot, for requests without a chat) is paused for the
+    requested time and the request is retried.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, max_retries: int):
+        """
+        Args:
+            global_rate (float) : requests per second across all chats
+            chat_rate (float) : requests per second to a single (private) chat
+            chat_burst (int) : requests a chat may send at once before being throttled
+            max_retries (int) : times a request is retried after RetryAfter before giving up
+        """
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._chats = OrderedDict()   # chat id -> TokenBucket, least recently used first
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id, edits: bool = False) -> TokenBucket:
+        key = (chat_id, "edits") if edits else chat_id
+        bucket = self._chats.get(key)
+        if bucket is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = TokenBucket(GROUP_CHAT_RATE if is_group else self._chat_rate, self._chat_burst)
+            self._chats[key] = bucket
+            if len(self._chats) > MAX_TRACKED_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        buckets = [self._global]
+        if chat_id is not None:
+            buckets.append(self._chat_bucket(chat_id, edits=endpoint in EDIT_ENDPOINTS))
+
+        for attempt in range(self._max_retries + 1):
+            wait = max(bucket.reserve() for bucket in buckets)
+            if wait > 0:
+                started_at = time.monotonic()
+                # a flood wait may start while this request is waiting for its turn
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = max(bucket.paused_for() for bucket in buckets)
+                metrics.observe("telegram.rate_limit_wait", time.monotonic() - started_at)
+
+            metrics.increment("telegram.requests")
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.increment("telegram.retry_after")
+                if attempt == self._max_retries:
+                    raise
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logging.warning("Telegram flood wait on %s for chat %s, retrying in %ss", endpoint, chat_id, delay)
+                # the limit applies to the chat (or the bot as a whole), so hold everything queued for it
+                buckets[-1].pause(delay)
+        return None   # not reached: the last attempt either returns or raises
+
+
+class InlineReply:
+    """
+    Slot for one reply that is returned as the webhook response (a Bot API method call) instead of
+    being sent as a separate request. The webhook opens it for an update it waits for; the first
+    eligible reply claims it, and once the webhook has answered it is closed and replies are sent
+    normally again.
+    """
+
+    def __init__(self):
+        self.payload = None
+        self.closed = False
+        self.done = asyncio.Event()   # set once the update has been processed
+
+    def claim(self, method: str, params: dict) -> bool:
+        """Take the slot for a method call, returning False if it's closed or already taken"""
+        if self.closed or self.payload is not None:
+            return False
+        self.payload = {"method": method, **params}
+        return True
+
+    def close(self) -> dict:
+        """Stop accepting replies, returning the claimed method call (or None)"""
+        self.closed = True
+        return self.payload
+
+
+# the inline reply slot (if any) of the update being processed
+current_inline_reply = contextvars.ContextVar("current_inline_reply", default=None)
+
+
+async def send_reply(update, text: str, reply_markup=None, parse_mode: str = None):
+    """
+    Send a message to the update's chat - in the webhook response if the webhook is waiting for
+    this update, otherwise as a normal request.
+    Only for a handler's final reply: nothing (None) is returned when the reply goes inline.
+    """
+    params = {"chat_id": update.effective_chat.id, "text": text}
+    if reply_markup is not None:
+        params["reply_markup"] = reply_markup.to_dict()
+    if parse_mode is not None:
+        params["parse_mode"] = parse_mode
+
+    slot = current_inline_reply.get()
+    if slot is not None and slot.claim("sendMessage", params):
+        metrics.increment("telegram.inline_replies")
+        return None
+    return await update.get_bot().send_message(
+        chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup, parse_mode=parse_mode
+    )
@@ -0,0 +1,361 @@
+"""Bot persistence storing user_data and conversation states as individual rows, loaded lazily per user"""
+import asyncio
+import copy
+import json
+import logging
+import pickle
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from sqlalchemy import select, delete
+from telegram.ext import BasePersistence, PersistenceInput
+from database import engine, dialect_insert, BotUserData, BotConversations
+import metrics
+
+MIN_IDLE_BEFORE_EVICTION = 60  # seconds; never evict a user who was active more recently than this
+
+
+def _upsert(table, rows: list, key_columns: list):
+    """Build a batched INSERT ... ON CONFLICT DO UPDATE statement for the engine's dialect"""
+    stmt = dialect_insert(table)
+    update_columns = {col: stmt.excluded[col] for col in rows[0] if col not in key_columns}
+    return stmt.on_conflict_do_update(index_elements=key_columns, set_=update_columns)
+
+
+def _encode_key(key) -> str:
+    """Encode a conversation key (tuple of ints) for storage"""
+    return json.dumps(list(key))
+
+
+class _CachedUser:
+    """Bookkeeping for a user whose data is loaded in memory"""
+    __slots__ = ("conversation_keys", "last_seen", "in_flight")
+
+    def __init__(self):
+        self.conversation_keys = set()
+        self.last_seen = time.monotonic()
+        self.in_flight = 0
+
+
+class SqlPersistence(BasePersistence):
+    """
+    Persistence backed by per-user and per-conversation rows in the bot's database.
+
+    Nothing is loaded at startup. A user's user_data and conversation states are loaded on their
+    first update (see user_loaded) and users who have gone idle are evicted from memory in LRU
+    order (see evict_idle_users), so startup time is constant and memory tracks active users.
+
+    Changes handed over by the application are kept in memory and only the keys that actually
+    changed are marked dirty. flush() then writes just those rows in one transaction using batched
+    upserts (and deletes), so the cost of a flush grows with recent activity instead of the total
+    number of users. chat_data, bot_data and callback_data are not used by the bot and aren't stored.
+    """
+
+    def __init__(self, update_interval: float = 60, max_cached_users: int = 1000,
+                 idle_timeout: float = 1800):
+        """
+        Args:
+            update_interval (float) : seconds between the application handing over changes
+            max_cached_users (int) : number of users kept in memory before the least recently
+                active ones are evicted
+            idle_timeout (float) : seconds of inactivity after which a user is evicted
+        """
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._max_cached_users = max_cached_users
+        self._idle_timeout = idle_timeout
+        self._application = None
+
+        self._user_data = {}
+        self._conversations = {}        # conversation name -> {key: state}
+        self._cached_users = OrderedDict()  # telegram user id -> _CachedUser, least recently active first
+        self._unmerged_users = set()    # loaded users whose data isn't in the application's user_data yet
+
+        self._dirty_users = set()
+        self._dropped_users = set()
+        self._dirty_conversations = set()  # (name, key) pairs
+
+        self._flush_lock = asyncio.Lock()
+
+    def attach(self, application):
+        """
+        Give the persistence access to the application's in-memory state. Required for loading
+        conversation states on demand and for evicting users, since PTB only loads persisted data
+        at startup and has no public API to add or forget entries later.
+        """
+        self._application = application
+
+    @property
+    def has_pending_writes(self) -> bool:
+        """Whether there are changes that haven't been flushed to the database yet"""
+        return bool(self._dirty_users or self._dropped_users or self._dirty_conversations)
+
+    @property
+    def cached_user_count(self) -> int:
+        """Number of users currently held in memory"""
+        return len(self._cached_users)
+
+    #-----------------------------------------------------------------------------------------------
+    # Loading #
+
+    async def get_user_data(self) -> dict:
+        # loaded lazily per user in user_loaded, and only ever handed to the application as a deep
+        # copy (see refresh_user_data) - if it shared the dicts kept here, its changes would make
+        # update_user_data's equality check pass and they'd never be written
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # loaded lazily per user in user_loaded
+        self._conversations.setdefault(name, {})
+        return {}
+
+    @staticmethod
+    def _load_user_rows(user_id: int, conversation_key: str):
+        """Load a user's user_data and their stored conversation states for the given key"""
+        with engine.connect() as conn:
+            data = conn.execute(
+                select(BotUserData.data).where(BotUserData.user_id == user_id)
+            ).scalar_one_or_none()
+            states = conn.execute(
+                select(BotConversations.name, BotConversations.state)
+                .where(BotConversations.key == conversation_key)
+            ).all() if conversation_key else []
+        return (pickle.loads(data) if data is not None else None), states
+
+    @asynccontextmanager
+    async def user_loaded(self, update):
+        """
+        Make sure the data of the update's user is in memory while the update is processed.
+        Users are pinned (never evicted) while any of their updates are being processed.
+        """
+        user = update.effective_user
+        if not user:
+            yield
+            return
+
+        cached = self._cached_users.get(user.id)
+        key = (update.effective_chat.id, user.id) if update.effective_chat else None
+
+        if cached is None or (key and key not in cached.conversation_keys):
+            metrics.increment("persistence.cache_miss")
+            cached = self._cached_users.setdefault(user.id, _CachedUser())
+            cached.in_flight += 1
+            try:
+                await self._load_user(user.id, key, cached)
+            except Exception:
+                cached.in_flight -= 1
+                raise
+        else:
+            metrics.increment("persistence.cache_hit")
+            cached.in_flight += 1
+
+        cached.last_seen = time.monotonic()
+        self._cached_users.move_to_end(user.id)
+        metrics.set_gauge("persistence.cached_users", len(self._cached_users))
+        try:
+            yield
+        finally:
+            cached.in_flight -= 1
+            cached.last_seen = time.monotonic()
+
+    async def _load_user(self, user_id: int, key, cached: _CachedUser):
+        """Load a user's persisted data and hand it to the application"""
+        started_at = time.perf_counter()
+        user_data, states = await asyncio.to_thread(
+            self._load_user_rows, user_id, _encode_key(key) if key else None
+        )
+        metrics.observe("persistence.load_time", time.perf_counter() - started_at)
+
+        if user_data is not None and user_id not in self._user_data:
+            self._user_data[user_id] = user_data
+            self._unmerged_users.add(user_id)
+
+        if key:
+            # pylint: disable=protected-access
+            handler_conversations = self._application._conversation_handler_conversations
+            for name, state in states:
+                if name in handler_conversations and key not in handler_conversations[name]:
+                    handler_conversations[name].update_no_track({key: state})
+                    self._conversations.setdefault(name, {})[key] = state
+            cached.conversation_keys.add(key)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # merge lazily loaded data into the application's user_data the first time it is used
+        if user_id in self._unmerged_users:
+            self._unmerged_users.discard(user_id)
+            for field, value in copy.deepcopy(self._user_data.get(user_id, {})).items():
+                user_data.setdefault(field, value)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    #-----------------------------------------------------------------------------------------------
+    # Eviction #
+
+    def _is_dirty(self, user_id: int, cached: _CachedUser) -> bool:
+        """Whether a user has changes that haven't been written yet"""
+        if user_id in self._dirty_users or user_id in self._dropped_users:
+            return True
+        return any((name, key) in self._dirty_conversations
+                   for name in self._conversations for key in cached.conversation_keys)
+
+    def evict_idle_users(self) -> int:
+        """
+        Forget users who have been idle for longer than idle_timeout, and the least recently
+        active users beyond max_cached_users. Users with unflushed changes or updates in progress
+        are kept, so call this right after update_persistence() and flush().
+        Returns:
+            int : number of users evicted
+        """
+        now = time.monotonic()
+        evicted = 0
+        for user_id, cached in list(self._cached_users.items()):
+            idle = now - cached.last_seen
+            over_capacity = len(self._cached_users) > self._max_cached_users
+            if idle < self._idle_timeout and not over_capacity:
+                break   # everyone after this user was active more recently
+            if cached.in_flight or idle < MIN_IDLE_BEFORE_EVICTION or self._is_dirty(user_id, cached):
+                continue
+            self._evict(user_id, cached)
+            evicted += 1
+
+        if evicted:
+            metrics.increment("persistence.evictions", evicted)
+            metrics.set_gauge("persistence.cached_users", len(self._cached_users))
+            logging.info("Evicted %d idle users from memory", evicted)
+        return evicted
+
+    def _evict(self, user_id: int, cached: _CachedUser):
+        """Drop a user's data from memory without touching what is stored"""
+        # pylint: disable=protected-access
+        self._application._user_data.pop(user_id, None)
+        for name, conversations in self._application._conversation_handler_conversations.items():
+            for key in cached.conversation_keys:
+                conversations.data.pop(key, None)   # bypass TrackingDict so this isn't seen as an ended conversation
+                self._conversations.get(name, {}).pop(key, None)
+        self._user_data.pop(user_id, None)
+        self._unmerged_users.discard(user_id)
+        del self._cached_users[user_id]
+
+    #-----------------------------------------------------------------------------------------------
+    # Tracking changes #
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if self._user_data.get(user_id, {}) == data:
+            return
+        self._user_data[user_id] = data
+        self._dirty_users.add(user_id)
+        self._dropped_users.discard(user_id)
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._dirty_conversations.add((name, key))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data.pop(user_id, None)
+        self._dirty_users.discard(user_id)
+        self._dropped_users.add(user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    #-----------------------------------------------------------------------------------------------
+    # Writing #
+
+    def _take_pending_writes(self) -> dict:
+        """Collect the rows to write for all dirty keys and reset the dirty sets"""
+        now = datetime.utcnow()
+        pending = {
+            "users": [{"user_id": user_id, "data": pickle.dumps(self._user_data[user_id]), "updated_at": now}
+                      for user_id in self._dirty_users if user_id in self._user_data],
+            "dropped_users": list(self._dropped_users),
+            "conversations": [],
+            "ended_conversations": [],
+        }
+        for name, key in self._dirty_conversations:
+            state = self._conversations.get(name, {}).get(key)
+            if state is None:
+                pending["ended_conversations"].append((name, _encode_key(key)))
+            else:
+                pending["conversations"].append(
+                    {"name": name, "key": _encode_key(key), "state": state, "updated_at": now}
+                )
+
+        self._dirty_users, self._dropped_users = set(), set()
+        self._dirty_conversations = set()
+        return pending
+
+    def _restore_pending_writes(self, pending: dict):
+        """Mark the keys of a failed write as dirty again so the next flush retries them"""
+        self._dirty_users.update(row["user_id"] for row in pending["users"])
+        self._dropped_users.update(pending["dropped_users"])
+        self._dirty_conversations.update(
+            (row["name"], tuple(json.loads(row["key"]))) for row in pending["conversations"]
+        )
+        self._dirty_conversations.update(
+            (name, tuple(json.loads(key))) for name, key in pending["ended_conversations"]
+        )
+
+    @staticmethod
+    def _write(pending: dict):
+        """Write the collected rows in a single transaction"""
+        with engine.begin() as conn:
+            if pending["users"]:
+                conn.execute(_upsert(BotUserData, pending["users"], ["user_id"]), pending["users"])
+            if pending["dropped_users"]:
+                conn.execute(delete(BotUserData).where(BotUserData.user_id.in_(pending["dropped_users"])))
+            if pending["conversations"]:
+                conn.execute(_upsert(BotConversations, pending["conversations"], ["name", "key"]),
+                             pending["conversations"])
+            for name, key in pending["ended_conversations"]:
+                conn.execute(delete(BotConversations)
+                             .where(BotConversations.name == name, BotConversations.key == key))
+
+    async def flush(self) -> None:
+        """Write all changed entries to the database (no-op if nothing changed)"""
+        async with self._flush_lock:
+            if not self.has_pending_writes:
+                return
+
+            pending = self._take_pending_writes()
+            row_count = sum(len(rows) for rows in pending.values())
+            started_at = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, pending)
+            except Exception:
+                self._restore_pending_writes(pending)
+                raise
+
+            metrics.observe("persistence.flush_time", time.perf_counter() - started_at)
+            metrics.increment("persistence.rows_written", row_count)
+            logging.info("Persistence flushed %d changed rows", row_count)
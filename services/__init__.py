@@ -1,13 +1,18 @@
 from .gemini_svc import process_expense_text, process_expense_image, refine_expense_details
-from .expenses_svc import get_or_create_user, insert_expense, update_expense, \
-    export_expenses_to_csv, exact_expense_matching, delete_all_expenses, delete_specific_expense, \
-    get_categories, get_category_rules, insert_category_rule
-from .sql_agent_svc import analyser_agent
+from .expenses_svc import get_or_create_user, record_expense, \
+    export_expenses_to_csv, find_expense_id, record_expense_message, delete_all_expenses, \
+    delete_specific_expense, get_categories, get_category_rules, insert_category_rule
+from .sql_agent_svc import get_analyser_agent
+from .search_svc import search_expenses
+from .merchants_svc import backfill_merchants
+from .fx_svc import refresh_fx_rates
+from .digest_svc import send_digests
 from .whitelist_svc import is_user_whitelisted, add_to_whitelist, remove_from_whitelist, \
     get_all_whitelisted_users
 
 __all__ = ["process_expense_text", "process_expense_image", "refine_expense_details",
-           "get_or_create_user", "insert_expense", "update_expense", "export_expenses_to_csv",
-           "exact_expense_matching", "delete_all_expenses", "delete_specific_expense",
-           "get_categories", "get_category_rules", "insert_category_rule", "analyser_agent", "is_user_whitelisted", "add_to_whitelist",
-           "remove_from_whitelist", "get_all_whitelisted_users"]
+           "get_or_create_user", "record_expense", "export_expenses_to_csv",
+           "find_expense_id", "record_expense_message", "delete_all_expenses", "delete_specific_expense",
+           "get_categories", "get_category_rules", "insert_category_rule", "get_analyser_agent", "is_user_whitelisted", "add_to_whitelist",
+           "remove_from_whitelist", "get_all_whitelisted_users", "search_expenses",
+           "backfill_merchants", "refresh_fx_rates", "send_digests"]
@@ -0,0 +1,216 @@
+"""Local columnar copies of users' expenses (in DuckDB) for the analyser's queries, so a session of
+aggregations runs in-process instead of one database round trip per query"""
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from sqlalchemy import select, text
+from sqlalchemy.exc import SQLAlchemyError
+from database import ReadSessionLocal, read_engine, get_data_version, Expenses, Merchants
+import config
+import metrics
+
+LOCAL_TABLES = {"expenses", "merchants"}   # tables copied for each user
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+# operations whose results differ between DuckDB and postgres for the same SQL (5/2 is 2.5 locally but 2
+# on postgres; date_trunc, intervals and to_* conversions return different types), so they're left to postgres
+NON_PORTABLE_FUNCTIONS = {"/", "//", "date_trunc", "age", "date_diff", "datediff", "date_sub"}
+NON_PORTABLE_PREFIX = "to_"
+
+
+@lru_cache(maxsize=None)
+def get_duckdb():
+    """Get the duckdb module, or None if the local analytics engine is disabled or unavailable"""
+    if config.ANALYTICS_CACHE_USERS <= 0:
+        return None
+    try:
+        import duckdb  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.warning("duckdb is not installed; analyser queries go to the database")
+        return None
+    return duckdb
+
+
+class UserFrame:
+    """A user's expenses and merchants in an in-memory DuckDB database, as of a data version"""
+
+    def __init__(self, connection, version: int):
+        self.connection = connection
+        self.version = version
+        self.lock = threading.Lock()
+
+
+_frames = OrderedDict()   # user id -> UserFrame, least recently used first
+_frames_lock = threading.Lock()
+_load_lock = threading.Lock()   # parallel queries of a session wait for one load instead of each loading
+
+
+def _load_frame(duckdb, session, user_id, version: int) -> UserFrame:
+    """Copy the user's rows into a new in-memory DuckDB database"""
+    started_at = time.perf_counter()
+    expenses = session.execute(
+        select(Expenses.id, Expenses.user_id, Expenses.price, Expenses.category, Expenses.description,
+               Expenses.date, Expenses.currency, Expenses.merchant_id, Expenses.base_amount)
+        .where(Expenses.user_id == user_id)
+    ).all()
+    merchants = session.execute(
+        select(Merchants.id, Merchants.user_id, Merchants.name).where(Merchants.user_id == user_id)
+    ).all()
+
+    # the analyser's SQL runs here, so it must not reach the host's files or the network
+    connection = duckdb.connect(":memory:", config={"enable_external_access": False})
+    connection.execute("CREATE TABLE expenses (id INTEGER, user_id UUID, price DECIMAL(10, 2), category VARCHAR, "
+                       "description VARCHAR, date DATE, currency VARCHAR, merchant_id INTEGER, "
+                       "base_amount DECIMAL(12, 2))")
+    connection.execute("CREATE TABLE merchants (id INTEGER, user_id UUID, name VARCHAR)")
+    if expenses:
+        connection.executemany("INSERT INTO expenses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(row[0], str(row[1]), *row[2:]) for row in expenses])
+    if merchants:
+        connection.executemany("INSERT INTO merchants VALUES (?, ?, ?)",
+                               [(row[0], str(row[1]), row[2]) for row in merchants])
+    connection.execute("SET lock_configuration = true")
+
+    metrics.increment("analytics.frame_loads")
+    metrics.observe("analytics.frame_load_time", time.perf_counter() - started_at)
+    return UserFrame(connection, version)
+
+
+def _cached_frame(user_id, version: int):
+    with _frames_lock:
+        frame = _frames.get(user_id)
+        if frame is None or frame.version < version:
+            return None
+        _frames.move_to_end(user_id)
+        return frame
+
+
+def _get_frame(duckdb, user_id) -> UserFrame:
+    """Get the user's local copy, (re)loading it if it's missing or older than their data version"""
+    session = ReadSessionLocal()
+    try:
+        if read_engine.dialect.name == "postgresql":
+            session.execute(text("SET TRANSACTION READ ONLY"))
+        # (read before the rows, so a copy is never newer than the version it's tagged with)
+        version = get_data_version(session, user_id)
+        frame = _cached_frame(user_id, version)
+        if frame is not None:
+            return frame
+
+        with _load_lock:
+            frame = _cached_frame(user_id, version)
+            if frame is not None:
+                return frame
+            frame = _load_frame(duckdb, session, user_id, version)
+            with _frames_lock:
+                _frames[user_id] = frame
+                while len(_frames) > config.ANALYTICS_CACHE_USERS:
+                    # (not closed here - queries on other threads may still hold cursors on it;
+                    # it's closed once the last of them is released)
+                    _frames.popitem(last=False)
+                metrics.set_gauge("analytics.cached_users", len(_frames))
+            return frame
+    finally:
+        session.close()
+
+
+@lru_cache(maxsize=None)
+def _get_parser(duckdb):
+    """An empty sandboxed DuckDB database, used only to parse analyser queries"""
+    return duckdb.connect(":memory:", config={"enable_external_access": False})
+
+
+_parser_lock = threading.Lock()
+
+
+def _inspect_node(node, tables: set, ctes: set) -> bool:
+    """Collect the tables and CTEs a parsed query refers to; False if it uses something that can't run locally"""
+    if isinstance(node, list):
+        return all(_inspect_node(child, tables, ctes) for child in node)
+    if not isinstance(node, dict):
+        return True
+    if node.get("type") == "TABLE_FUNCTION":
+        return False
+    if node.get("type") == "BASE_TABLE":
+        schema = node.get("schema_name") or "main"
+        name = node["table_name"].lower()
+        tables.add(name if schema.lower() == "main" and not node.get("catalog_name") else f"{schema}.{name}")
+    if node.get("class") == "FUNCTION":
+        function = node.get("function_name", "").lower()
+        if function in NON_PORTABLE_FUNCTIONS or function.startswith(NON_PORTABLE_PREFIX):
+            return False
+    if (node.get("cast_type") or {}).get("id") == "INTERVAL":
+        return False
+    if "cte_map" in node:
+        ctes.update(entry["key"].lower() for entry in node["cte_map"].get("map", []))
+    return all(_inspect_node(child, tables, ctes) for child in node.values())
+
+
+def _is_local_query(duckdb, query: str) -> bool:
+    """Whether the query is exactly one SELECT (or WITH) statement that only reads tables that are
+    copied locally, and gives the same results in DuckDB as on postgres (found with DuckDB's own
+    parser, which doesn't bind or run anything)"""
+    with _parser_lock:
+        cursor = _get_parser(duckdb).cursor()
+    try:
+        parsed = json.loads(cursor.execute("SELECT json_serialize_sql(?)", [query]).fetchone()[0])
+    except duckdb.Error:
+        return False
+    finally:
+        cursor.close()
+    # (non-SELECT statements can't be serialized, so they come back as errors)
+    if parsed.get("error") or len(parsed.get("statements", [])) != 1:
+        return False
+    tables, ctes = set(), set()
+    if not _inspect_node(parsed["statements"][0], tables, ctes):
+        return False
+    return bool(tables) and tables <= LOCAL_TABLES | ctes
+
+
+def run_local_query(query: str):
+    """
+    Run an analyser query on the local copy of the user's data, if it can be: the engine is
+    enabled, the query is a single SELECT of the expenses/merchants tables filtered by a single user's
+    UUID, it avoids arithmetic whose results differ from postgres (see NON_PORTABLE_FUNCTIONS), and
+    DuckDB accepts its SQL. The local database has no file or network access.
+    Returns:
+        str : the rows as JSON (like run_read_query), or None to run the query on the database instead
+    """
+    duckdb = get_duckdb()
+    if duckdb is None:
+        return None
+    user_ids = {match.lower() for match in UUID_PATTERN.findall(query)}
+    if len(user_ids) != 1 or not _is_local_query(duckdb, query):
+        metrics.increment("analytics.not_local")
+        return None
+
+    try:
+        frame = _get_frame(duckdb, uuid.UUID(user_ids.pop()))
+        started_at = time.perf_counter()
+        with frame.lock:
+            cursor = frame.connection.cursor()
+        try:
+            cursor.execute(query)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    except duckdb.Error as e:
+        # e.g. postgres-only syntax - the database gets to try it
+        metrics.increment("analytics.local_errors")
+        logging.info("Local analytics query failed, running it on the database: %s", str(e))
+        return None
+    except SQLAlchemyError as e:
+        metrics.increment("analytics.local_errors")
+        logging.warning("Could not load expenses for local analytics: %s", str(e))
+        return None
+
+    metrics.increment("analytics.local_queries")
+    metrics.observe("analytics.local_query_time", time.perf_counter() - started_at)
+    if rows:
+        return json.dumps([dict(zip(columns, row)) for row in rows], default=str)
+    return "Query executed successfully, but no results were returned."
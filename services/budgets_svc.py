@@ -0,0 +1,141 @@
+"""Monthly budgets per category, with running totals kept up to date as expenses change"""
+import logging
+from datetime import date as date_type, timedelta
+from decimal import Decimal
+from sqlalchemy import select, delete, and_, func
+from database import SessionLocal, dialect_insert, Budgets, BudgetTotals, Expenses
+import config
+
+
+def month_start(on_date) -> date_type:
+    return on_date.replace(day=1)
+
+
+def next_month_start(on_date) -> date_type:
+    return (month_start(on_date) + timedelta(days=32)).replace(day=1)
+
+
+def add_to_totals(session, user_id, category: str, on_date, amount):
+    """Add an expense's base currency amount to its category's total for its month (a negative
+    amount removes it). Call in the same transaction as the change to the expense."""
+    if amount is None:
+        return
+    stmt = dialect_insert(BudgetTotals).values(
+        user_id=user_id, category=category, month=month_start(on_date), spent=amount
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[BudgetTotals.user_id, BudgetTotals.category, BudgetTotals.month],
+        set_={"spent": BudgetTotals.spent + stmt.excluded.spent},
+    ))
+
+
+def set_budget(user_id, category: str, amount) -> bool:
+    """Set the user's monthly budget (in BASE_CURRENCY) for a category, or remove it if amount is None"""
+    try:
+        with SessionLocal.begin() as session:
+            if amount is None:
+                session.execute(delete(Budgets).where(Budgets.user_id == user_id, Budgets.category == category))
+            else:
+                stmt = dialect_insert(Budgets).values(user_id=user_id, category=category, amount=amount)
+                session.execute(stmt.on_conflict_do_update(
+                    index_elements=[Budgets.user_id, Budgets.category],
+                    set_={"amount": stmt.excluded.amount},
+                ))
+        return True
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error("Error setting budget: %s", str(e))
+        return False
+
+
+def get_budget_status(user_id, category: str = None, on_date=None) -> list:
+    """
+    The user's budgets with what has been spent against them in a month, read from the running
+    totals (no aggregation over expenses).
+    Args:
+        category (str) : only this category's budget
+        on_date (date) : a date in the month (defaults to this month)
+    Returns:
+        list of dicts with category, budget, spent and remaining (all in BASE_CURRENCY)
+    """
+    month = month_start(on_date or date_type.today())
+    stmt = (
+        select(Budgets.category, Budgets.amount, BudgetTotals.spent)
+        .outerjoin(BudgetTotals, and_(BudgetTotals.user_id == Budgets.user_id,
+                                      BudgetTotals.category == Budgets.category,
+                                      BudgetTotals.month == month))
+        .where(Budgets.user_id == user_id)
+        .order_by(Budgets.category)
+    )
+    if category is not None:
+        stmt = stmt.where(Budgets.category == category)
+
+    session = SessionLocal()
+    try:
+        rows = session.execute(stmt).all()
+    finally:
+        session.close()
+
+    statuses = []
+    for budget_category, amount, spent in rows:
+        spent = Decimal(spent or 0)
+        statuses.append({"category": budget_category, "budget": Decimal(amount), "spent": spent,
+                         "remaining": Decimal(amount) - spent})
+    return statuses
+
+
+def get_unconverted(user_id, start: date_type, end: date_type) -> dict:
+    """
+    The user's expenses from start up to (not including) end that have no base currency amount,
+    because there's no exchange rate for their currency - so budgets, charts and digests leave them out.
+    Returns:
+        dict : currency -> number of expenses
+    """
+    session = SessionLocal()
+    try:
+        return dict(session.execute(
+            select(Expenses.currency, func.count())
+            .where(Expenses.user_id == user_id, Expenses.date >= start, Expenses.date < end,
+                   Expenses.base_amount.is_(None))
+            .group_by(Expenses.currency)
+        ).all())
+    finally:
+        session.close()
+
+
+def format_unconverted_note(unconverted: dict) -> str:
+    """A warning that expenses without an exchange rate aren't counted, or "" if there are none"""
+    if not unconverted:
+        return ""
+    count = sum(unconverted.values())
+    return (f"⚠️ {count} expense{'' if count == 1 else 's'} in {', '.join(sorted(unconverted))} "
+            f"{'is' if count == 1 else 'are'} not included, as there's no exchange rate to "
+            f"{config.BASE_CURRENCY} for {'it' if count == 1 else 'them'} yet.")
+
+
+def get_budget_alert(user_id, category: str, on_date, expense_id: int = None) -> str:
+    """A warning for the confirmation message if the category's budget for the month of an expense
+    is nearly used up or exceeded (or the expense can't be counted towards it), otherwise None"""
+    statuses = get_budget_status(user_id, category, on_date)
+    if not statuses or statuses[0]["budget"] <= 0:
+        return None
+    status = statuses[0]
+    month_name = month_start(on_date).strftime("%B")
+    if expense_id is not None:
+        session = SessionLocal()
+        try:
+            expense = session.execute(
+                select(Expenses.currency, Expenses.base_amount).where(Expenses.id == expense_id)
+            ).one_or_none()
+        finally:
+            session.close()
+        if expense is not None and expense.base_amount is None:
+            return (f"⚠️ This expense isn't counted towards your {category} budget, as there's no exchange "
+                    f"rate from {expense.currency} to {config.BASE_CURRENCY} yet.")
+    used = status["spent"] / status["budget"]
+    if status["remaining"] < 0:
+        return (f"🚨 You're {-status['remaining']:.2f} {config.BASE_CURRENCY} over your "
+                f"{category} budget for {month_name}.")
+    if used >= config.BUDGET_ALERT_THRESHOLD:
+        return (f"⚠️ You've used {used:.0%} of your {category} budget for {month_name} - "
+                f"{status['remaining']:.2f} {config.BASE_CURRENCY} left.")
+    return None
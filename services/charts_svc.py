@@ -0,0 +1,205 @@
+"""Spending charts rendered from pre-aggregated totals, cached per user, chart, period and data version"""
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date as date_type, timedelta
+from functools import lru_cache
+from sqlalchemy import select, func
+from database import SessionLocal, ReadSessionLocal, dialect_insert, get_data_version, Expenses, BudgetTotals, \
+    ChartFiles
+from services.budgets_svc import month_start
+import config
+import metrics
+
+CHART_TYPES = ("categories", "trend", "daily")
+TREND_MONTHS = 12           # months shown in a trend chart, up to and including its period
+TOP_CATEGORIES = 7          # pie slices (the rest are summed as "Other")
+
+_pngs = OrderedDict()       # (user id, chart, period, data version) -> PNG bytes, least recently used first
+_pngs_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_figure_class():
+    """Get matplotlib's Figure (headless, no pyplot state), or None if matplotlib isn't installed"""
+    try:
+        import matplotlib  # pylint: disable=import-outside-toplevel
+        matplotlib.use("Agg")
+        from matplotlib.figure import Figure  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.warning("matplotlib is not installed; charts are unavailable")
+        return None
+    return Figure
+
+
+def add_months(month: date_type, months: int) -> date_type:
+    index = month.year * 12 + month.month - 1 + months
+    return date_type(index // 12, index % 12 + 1, 1)
+
+
+def chart_range(chart: str, month: date_type) -> tuple:
+    """The dates a chart covers: (first day, day after the last)"""
+    first_month = add_months(month, 1 - TREND_MONTHS) if chart == "trend" else month
+    return first_month, add_months(month, 1)
+
+
+def get_chart_data(session, user_id, chart: str, month: date_type) -> list:
+    """
+    The (label, amount) points of a chart, in BASE_CURRENCY. Category and trend charts read the
+    running monthly totals kept for budgets; the daily chart sums a single month of expenses.
+    """
+    if chart == "categories":
+        rows = session.execute(
+            select(BudgetTotals.category, BudgetTotals.spent)
+            .where(BudgetTotals.user_id == user_id, BudgetTotals.month == month, BudgetTotals.spent > 0)
+            .order_by(BudgetTotals.spent.desc())
+        ).all()
+        if len(rows) > TOP_CATEGORIES:
+            rows = rows[:TOP_CATEGORIES - 1] + [("Other", sum(spent for _, spent in rows[TOP_CATEGORIES - 1:]))]
+        return [(category, float(spent)) for category, spent in rows]
+
+    if chart == "trend":
+        first_month = add_months(month, 1 - TREND_MONTHS)
+        totals = dict(session.execute(
+            select(BudgetTotals.month, func.sum(BudgetTotals.spent))
+            .where(BudgetTotals.user_id == user_id, BudgetTotals.month >= first_month, BudgetTotals.month <= month)
+            .group_by(BudgetTotals.month)
+        ).all())
+        if not any(totals.values()):
+            return []
+        months = [add_months(first_month, offset) for offset in range(TREND_MONTHS)]
+        return [(f"{each:%b}", float(totals.get(each) or 0)) for each in months]
+
+    # daily: cumulative spending through the month
+    totals = dict(session.execute(
+        select(Expenses.date, func.sum(Expenses.base_amount))
+        .where(Expenses.user_id == user_id, Expenses.date >= month, Expenses.date < add_months(month, 1),
+               Expenses.base_amount.isnot(None))
+        .group_by(Expenses.date)
+    ).all())
+    if not totals:
+        return []
+    last_day = min(add_months(month, 1) - timedelta(days=1), max(date_type.today(), max(totals)))
+    points, running = [], 0.0
+    for day in range(1, last_day.day + 1):
+        running += float(totals.get(month.replace(day=day)) or 0)
+        points.append((str(day), running))
+    return points
+
+
+def render_chart(chart: str, month: date_type, points: list) -> bytes:
+    """Render a chart's points as a PNG"""
+    started_at = time.perf_counter()
+    figure = get_figure_class()(figsize=(6, 4), dpi=150)
+    axes = figure.add_subplot()
+    labels = [label for label, _ in points]
+    values = [value for _, value in points]
+
+    if chart == "categories":
+        axes.pie(values, labels=labels, autopct="%1.0f%%", startangle=90, counterclock=False)
+        axes.set_title(f"Spending by category, {month:%B %Y} ({config.BASE_CURRENCY})")
+    elif chart == "trend":
+        axes.bar(labels, values)
+        axes.set_title(f"Monthly spending to {month:%B %Y} ({config.BASE_CURRENCY})")
+    else:
+        axes.plot(labels, values, marker="o", markersize=3)
+        axes.fill_between(labels, values, alpha=0.2)
+        axes.set_title(f"Cumulative spending, {month:%B %Y} ({config.BASE_CURRENCY})")
+        axes.set_xticks(labels[::max(1, len(labels) // 10)])
+    if chart != "categories":
+        axes.spines[["top", "right"]].set_visible(False)
+        axes.set_ylim(bottom=0)
+
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    metrics.increment("charts.renders")
+    metrics.observe("charts.render_time", time.perf_counter() - started_at)
+    return buffer.getvalue()
+
+
+def chart_period(chart: str, month: date_type) -> str:
+    """The period a chart is cached under: its month, or today for this month's daily chart (which
+    runs up to today, so it changes every day even if the data doesn't)"""
+    today = date_type.today()
+    if chart == "daily" and month == month_start(today):
+        return today.isoformat()
+    return f"{month:%Y-%m}"
+
+
+def get_chart(user_id, chart: str, month: date_type, reuse_file: bool = True) -> dict:
+    """
+    Get a chart of the user's spending for a month, reusing what was sent or rendered before while
+    the user's data version is unchanged.
+    Args:
+        reuse_file (bool) : return the Telegram file_id of the last upload of this chart, if it's current
+    Returns:
+        dict : the data version with either "file_id" or "png", or None if there's nothing to chart
+    """
+    if get_figure_class() is None:
+        return None
+    period = chart_period(chart, month)
+
+    session = ReadSessionLocal()
+    try:
+        version = get_data_version(session, user_id)
+        if reuse_file:
+            file_id = session.execute(
+                select(ChartFiles.file_id)
+                .where(ChartFiles.user_id == user_id, ChartFiles.chart == chart, ChartFiles.period == period,
+                       ChartFiles.version == version)
+            ).scalar_one_or_none()
+            if file_id is not None:
+                metrics.increment("charts.file_id_hits")
+                return {"version": version, "file_id": file_id}
+
+        key = (user_id, chart, period, version)
+        with _pngs_lock:
+            png = _pngs.get(key)
+            if png is not None:
+                _pngs.move_to_end(key)
+        if png is not None:
+            metrics.increment("charts.png_hits")
+            return {"version": version, "png": png}
+
+        points = get_chart_data(session, user_id, chart, month)
+    finally:
+        session.close()
+
+    if not points:
+        return None
+    png = render_chart(chart, month, points)
+    with _pngs_lock:
+        _pngs[key] = png
+        while len(_pngs) > config.CHART_CACHE_SIZE:
+            _pngs.popitem(last=False)
+    return {"version": version, "png": png}
+
+
+def remember_chart_file(user_id, chart: str, month: date_type, version: int, file_id: str):
+    """Remember the Telegram file_id of an uploaded chart, so it can be sent again without uploading"""
+    try:
+        with SessionLocal.begin() as session:
+            stmt = dialect_insert(ChartFiles).values(
+                user_id=user_id, chart=chart, period=chart_period(chart, month), version=version, file_id=file_id
+            )
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[ChartFiles.user_id, ChartFiles.chart, ChartFiles.period],
+                set_={"version": stmt.excluded.version, "file_id": stmt.excluded.file_id},
+            ))
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning("Could not remember chart file: %s", str(e))
+
+
+def parse_month(text: str, today: date_type = None) -> date_type:
+    """The first day of a "YYYY-MM" month, or of this month if text is empty; None if it's invalid"""
+    today = today or date_type.today()
+    if not text:
+        return month_start(today)
+    try:
+        year, month = text.split("-")
+        return date_type(int(year), int(month), 1)
+    except ValueError:
+        return None
@@ -0,0 +1,197 @@
+"""Per-user naive Bayes category classifier, trained on the user's own expenses"""
+import json
+import math
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select, delete
+from database import SessionLocal, dialect_insert, Expenses, UserClassifiers
+from services.merchants_svc import merchant_key
+import config
+import metrics
+
+# words that say nothing about the category (the input text is classified, not just the description)
+STOP_WORDS = {"a", "an", "and", "at", "for", "from", "in", "of", "on", "to", "with", "my", "i",
+              "spent", "paid", "bought", "got", "today", "yesterday", "last", "this"}
+SMOOTHING = 0.1   # additive (Lidstone) smoothing of token counts
+MAX_CACHED_CLASSIFIERS = 1000
+
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens without stop words or numbers"""
+    return [token for token in merchant_key(text).split()
+            if token not in STOP_WORDS and not token.isdigit() and len(token) > 1]
+
+
+class CategoryClassifier:
+    """Multinomial naive Bayes over description tokens, updatable one example at a time"""
+
+    def __init__(self, category_counts: dict = None, token_counts: dict = None):
+        self.category_counts = category_counts or {}   # category -> number of examples
+        self.token_counts = token_counts or {}         # category -> {token -> count}
+        self._totals = {category: sum(tokens.values()) for category, tokens in self.token_counts.items()}
+        self._vocabulary = {token for tokens in self.token_counts.values() for token in tokens}
+
+    @property
+    def examples(self) -> int:
+        return sum(self.category_counts.values())
+
+    def learn(self, text: str, category: str):
+        """Add one labelled example"""
+        tokens = tokenize(text)
+        if not tokens or not category:
+            return
+        self.category_counts[category] = self.category_counts.get(category, 0) + 1
+        counts = self.token_counts.setdefault(category, {})
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        self._totals[category] = self._totals.get(category, 0) + len(tokens)
+        self._vocabulary.update(tokens)
+
+    def unlearn(self, text: str, category: str):
+        """Remove one labelled example (e.g. an expense that was re-labelled or deleted)"""
+        tokens = tokenize(text)
+        if not tokens or self.category_counts.get(category, 0) <= 0:
+            return
+        self.category_counts[category] -= 1
+        counts = self.token_counts.get(category, {})
+        for token in tokens:
+            if counts.get(token, 0) > 0:
+                counts[token] -= 1
+                self._totals[category] -= 1
+                if not counts[token]:
+                    del counts[token]
+        if not self.category_counts[category]:
+            del self.category_counts[category]
+            self.token_counts.pop(category, None)
+            self._totals.pop(category, None)
+        self._vocabulary = {token for tokens in self.token_counts.values() for token in tokens}
+
+    def predict(self, text: str):
+        """
+        Returns:
+            tuple : (most likely category, its posterior probability), or (None, 0.0) if none of
+                    the text's words have been seen before
+        """
+        tokens = [token for token in tokenize(text) if token in self._vocabulary]
+        if not tokens:
+            return None, 0.0
+
+        vocabulary_size = len(self._vocabulary)
+        examples = self.examples
+        log_probs = {}
+        for category, count in self.category_counts.items():
+            counts = self.token_counts.get(category, {})
+            denominator = self._totals.get(category, 0) + SMOOTHING * vocabulary_size
+            log_probs[category] = math.log(count / examples) + sum(
+                math.log((counts.get(token, 0) + SMOOTHING) / denominator) for token in tokens
+            )
+
+        best = max(log_probs, key=log_probs.get)
+        normaliser = sum(math.exp(value - log_probs[best]) for value in log_probs.values())
+        return best, 1.0 / normaliser
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(json.dumps([self.category_counts, self.token_counts],
+                                        separators=(",", ":")).encode())
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        category_counts, token_counts = json.loads(zlib.decompress(data))
+        return cls(category_counts, token_counts)
+
+
+_cache = OrderedDict()   # user id -> CategoryClassifier, least recently used first
+_lock = threading.Lock()
+
+
+def _load(session, user_id) -> CategoryClassifier:
+    """Get a user's classifier from the cache, the database, or (first time) their expense history"""
+    with _lock:
+        classifier = _cache.get(user_id)
+        if classifier is not None:
+            _cache.move_to_end(user_id)
+            return classifier
+
+    data = session.execute(
+        select(UserClassifiers.data).where(UserClassifiers.user_id == user_id)
+    ).scalar()
+    if data is not None:
+        classifier = CategoryClassifier.from_bytes(data)
+    else:
+        classifier = CategoryClassifier()
+        for description, category in session.execute(
+                select(Expenses.description, Expenses.category).where(Expenses.user_id == user_id)):
+            classifier.learn(description, category)
+
+    with _lock:
+        _cache[user_id] = classifier
+        while len(_cache) > MAX_CACHED_CLASSIFIERS:
+            _cache.popitem(last=False)
+    return classifier
+
+
+def predict_category(user_id, text: str):
+    """
+    Predict the category of an expense from the user's input text.
+    Returns:
+        str : the category if the classifier is confident enough to skip asking the LLM, else None
+    """
+    session = SessionLocal()
+    try:
+        classifier = _load(session, user_id)
+    finally:
+        session.close()
+
+    if classifier.examples < config.CLASSIFIER_MIN_EXAMPLES:
+        return None
+    category, confidence = classifier.predict(text)
+    if category is None or confidence < config.CLASSIFIER_MIN_CONFIDENCE:
+        metrics.increment("classifier.not_confident")
+        return None
+    metrics.increment("classifier.predicted")
+    return category
+
+
+def _store(session, user_id, classifier: CategoryClassifier):
+    stmt = dialect_insert(UserClassifiers).values(
+        user_id=user_id, data=classifier.to_bytes(), updated_at=datetime.utcnow()
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at},
+    ))
+
+
+def learn_category(session, user_id, description: str, category: str, previous: tuple = None):
+    """
+    Train the user's classifier on a confirmed expense and store it. When an expense is edited,
+    `previous` is its old (description, category), which is unlearned first.
+    Runs in the caller's session/transaction (see expenses_svc.record_expense), before the
+    expense is written; call forget_classifier if that transaction fails.
+    """
+    classifier = _load(session, user_id)
+    if previous is not None:
+        classifier.unlearn(*previous)
+    classifier.learn(description, category)
+    _store(session, user_id, classifier)
+
+
+def unlearn_category(session, user_id, description: str, category: str):
+    """Remove a deleted expense from the user's classifier (in the caller's transaction, before the
+    expense is deleted; call forget_classifier if it fails)"""
+    classifier = _load(session, user_id)
+    classifier.unlearn(description, category)
+    _store(session, user_id, classifier)
+
+
+def delete_classifier(session, user_id):
+    """Delete the user's stored classifier (in the caller's transaction; call forget_classifier after)"""
+    session.execute(delete(UserClassifiers).where(UserClassifiers.user_id == user_id))
+
+
+def forget_classifier(user_id):
+    """Drop a user's cached classifier (e.g. after a failed update), so it is reloaded from the database"""
+    with _lock:
+        _cache.pop(user_id, None)
@@ -0,0 +1,169 @@
+"""Local parsing of simple expense corrections (e.g. "it was 15 not 12", "category food"), so they don't need an LLM round-trip"""
+import re
+from datetime import date, timedelta
+from utils import title_case, get_current_date
+
+# words the user may use to name each field
+FIELD_NAMES = {
+    "price": ("amount", "price", "cost", "total", "value"),
+    "currency": ("currency",),
+    "category": ("category", "cat"),
+    "description": ("description", "desc", "merchant", "shop", "store", "name"),
+    "date": ("date", "day"),
+}
+FIELD_BY_NAME = {name: field for field, names in FIELD_NAMES.items() for name in names}
+# values that describe a problem rather than a correction (e.g. "description is wrong")
+VAGUE_VALUES = {"wrong", "incorrect", "off", "missing", "bad", "different", "not right", "wrong too"}
+# values that only say what the field isn't (e.g. "category is not food")
+NEGATED_VALUE = re.compile(r"^(?:not|no|isn'?t|wasn'?t|shouldn'?t(?:\s+be)?|should\s+not(?:\s+be)?)\b", re.IGNORECASE)
+
+# ISO 4217 currency codes, so a three-letter word (e.g. "KFC", "bus") isn't taken for a currency
+CURRENCY_CODES = frozenset({
+    "AED", "AFN", "ALL", "AMD", "ANG", "AOA", "ARS", "AUD", "AWG", "AZN", "BAM", "BBD", "BDT",
+    "BGN", "BHD", "BIF", "BMD", "BND", "BOB", "BOV", "BRL", "BSD", "BTN", "BWP", "BYN", "BZD",
+    "CAD", "CDF", "CHE", "CHF", "CHW", "CLF", "CLP", "CNY", "COP", "COU", "CRC", "CUP", "CVE",
+    "CZK", "DJF", "DKK", "DOP", "DZD", "EGP", "ERN", "ETB", "EUR", "FJD", "FKP", "GBP", "GEL",
+    "GHS", "GIP", "GMD", "GNF", "GTQ", "GYD", "HKD", "HNL", "HTG", "HUF", "IDR", "ILS", "INR",
+    "IQD", "IRR", "ISK", "JMD", "JOD", "JPY", "KES", "KGS", "KHR", "KMF", "KPW", "KRW", "KWD",
+    "KYD", "KZT", "LAK", "LBP", "LKR", "LRD", "LSL", "LYD", "MAD", "MDL", "MGA", "MKD", "MMK",
+    "MNT", "MOP", "MRU", "MUR", "MVR", "MWK", "MXN", "MXV", "MYR", "MZN", "NAD", "NGN", "NIO",
+    "NOK", "NPR", "NZD", "OMR", "PAB", "PEN", "PGK", "PHP", "PKR", "PLN", "PYG", "QAR", "RON",
+    "RSD", "RUB", "RWF", "SAR", "SBD", "SCR", "SDG", "SEK", "SGD", "SHP", "SLE", "SOS", "SRD",
+    "SSP", "STN", "SVC", "SYP", "SZL", "THB", "TJS", "TMT", "TND", "TOP", "TRY", "TTD", "TWD",
+    "TZS", "UAH", "UGX", "USD", "USN", "UYI", "UYU", "UYW", "UZS", "VED", "VES", "VND", "VUV",
+    "WST", "XAF", "XAG", "XAU", "XCD", "XCG", "XOF", "XPF", "YER", "ZAR", "ZMW", "ZWG"
+})
+# codes that are also common words, only taken as currencies when typed in capitals ("15 cup" isn't Cuban pesos)
+CURRENCY_WORDS = {"ALL", "BOB", "CUP", "GEL", "MAD", "MOP", "PEN", "SOS", "TOP", "TRY"}
+
+_NUMBER = r"[$€£¥]?\s*(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d+))?"
+_NAMES = "|".join(sorted(FIELD_BY_NAME, key=len, reverse=True))
+_FIELD_CLAUSE = re.compile(
+    rf"^(?:please\s+)?(?:(?:change|set|make|update|fix)\s+)?(?:the\s+)?(?P<name>{_NAMES})"
+    rf"(?:\s+(?:is|was|should\s+be|must\s+be|to)|\s*[:=]|\s*->)?\s+(?P<value>.+)$",
+    re.IGNORECASE,
+)
+# a bare amount, optionally with the wrong amount and/or a currency code ("it was 15 not 12", "15.50 USD")
+_AMOUNT_CLAUSE = re.compile(
+    rf"^(?:it\s+(?:was|is|should\s+be)\s+)?{_NUMBER}(?:\s+(?P<currency>[A-Z]{{3}}))?"
+    rf"(?:\s*,?\s+not\s+[$€£¥]?\s*[\d,.]+)?$",
+    re.IGNORECASE,
+)
+# a bare currency code, typed in capitals ("in USD", "it was SGD")
+_CURRENCY_CLAUSE = re.compile(r"^(?:(?:it\s+was\s+)?in\s+|it\s+was\s+)?(?P<currency>[A-Z]{3})$")
+# (never a comma between digits, which is a thousands separator or a decimal comma, nor one before the
+# wrong value in "15, not 12")
+_CLAUSE_SEPARATOR = re.compile(
+    rf"\s*(?:[;\n]|(?:,(?!\d)|(?<!\d),)(?!\s*not\b))\s*|\s+and\s+(?=(?:the\s+)?(?:{_NAMES})\b)",
+    re.IGNORECASE,
+)
+# a number after a comma ("price 15, 50", "food,12") - a decimal comma or a second amount, so left to the LLM
+_NUMBER_AFTER_COMMA = re.compile(r"(?:(?<!\d),|,\s)\s*[$€£¥]?\s*\d")
+
+
+def _parse_currency(text: str):
+    """The ISO 4217 code the text names, or None if it isn't one"""
+    text = text.strip()
+    code = text.upper()
+    if code not in CURRENCY_CODES or (code in CURRENCY_WORDS and text != code):
+        return None
+    return code
+
+
+def _parse_price(text: str):
+    match = re.fullmatch(_NUMBER, text.strip())
+    if not match:
+        return None
+    price = float(match.group(1).replace(",", "") + "." + (match.group(2) or "0"))
+    return price if price > 0 else None
+
+
+def _parse_date(text: str):
+    text = text.strip().lower()
+    today = date.fromisoformat(get_current_date()[0])
+    if text == "today":
+        return today.isoformat()
+    if text == "yesterday":
+        return (today - timedelta(days=1)).isoformat()
+    try:
+        return date.fromisoformat(text).isoformat()
+    except ValueError:
+        return None   # anything relative or written out is left to the LLM
+
+
+def _parse_value(field: str, text: str):
+    """Parse a corrected field value, or None if it isn't simple enough to apply locally"""
+    if NEGATED_VALUE.match(text.strip()):
+        return None
+    # drop the wrong value if it's given too (e.g. "food not transport")
+    text = re.sub(r"(?:\s*,\s*|\s+)not\s+.+$", "", text.strip(), flags=re.IGNORECASE).strip(".!").strip("'\"")
+    if not text or text.lower() in VAGUE_VALUES:
+        return None
+    if field == "price":
+        return _parse_price(text)
+    if field == "currency":
+        return _parse_currency(text)
+    if field == "date":
+        return _parse_date(text)
+    return title_case(text)   # category/description, formatted like str_to_json does
+
+
+def _parse_clause(clause: str):
+    """
+    Returns:
+        dict : the field values a single correction clause sets, or None if it needs the LLM
+    """
+    match = _FIELD_CLAUSE.match(clause)
+    if match:
+        field = FIELD_BY_NAME[match.group("name").lower()]
+        value = _parse_value(field, match.group("value"))
+        return None if value is None else {field: value}
+
+    match = _AMOUNT_CLAUSE.match(clause)
+    if match:
+        price = _parse_price(match.group(1) + ("." + match.group(2) if match.group(2) else ""))
+        if price is None:
+            return None
+        changes = {"price": price}
+        if match.group("currency"):
+            currency = _parse_currency(match.group("currency"))
+            if currency is None:
+                return None
+            changes["currency"] = currency
+        return changes
+
+    match = _CURRENCY_CLAUSE.match(clause)
+    if match:
+        currency = _parse_currency(match.group("currency"))
+        return None if currency is None else {"currency": currency}
+
+    date_value = _parse_date(clause)
+    if date_value:
+        return {"date": date_value}
+    return None
+
+
+def apply_correction(parsed_expense: dict, feedback: str):
+    """
+    Apply a user's correction to parsed expense details without the LLM, if every part of it is
+    a simple field change (e.g. "it was 15 not 12", "category food, date yesterday").
+    Returns:
+        dict : the corrected expense details (a copy), or None if the correction needs the LLM
+    """
+    if not isinstance(parsed_expense, dict) or not feedback:
+        return None
+    feedback = re.sub(r"^(?:no|nope|oops|sorry)\b[,.!]?\s*", "", feedback.strip(), flags=re.IGNORECASE)
+    clauses = [clause for clause in _CLAUSE_SEPARATOR.split(feedback) if clause]
+    if not clauses or _NUMBER_AFTER_COMMA.search(feedback):
+        return None
+
+    corrected = dict(parsed_expense)
+    changed = set()
+    for clause in clauses:
+        changes = _parse_clause(clause.strip())
+        # (a field set twice is ambiguous, e.g. "price 15, price 12")
+        if changes is None or changed & changes.keys():
+            return None
+        changed.update(changes)
+        corrected.update(changes)
+    return corrected
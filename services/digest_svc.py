@@ -0,0 +1,253 @@
+"""Scheduled weekly/monthly spending digests, computed for all users at once off the interactive path"""
+import asyncio
+import html
+import logging
+import time
+from collections import defaultdict
+from datetime import date as date_type, datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import select, update, func, case
+from telegram.error import TelegramError
+from database import SessionLocal, ReadSessionLocal, dialect_insert, Users, Expenses, DigestRuns, DigestSends
+from services.budgets_svc import format_unconverted_note
+import config
+import metrics
+
+COMMENTARY_CONCURRENCY = 4    # commentary requests in flight at once
+TOP_CATEGORIES = 5            # categories listed in a digest (the rest are summed as "Other")
+RUN_LEASE = timedelta(minutes=15)   # a run not renewed for this long is taken over (its instance stopped)
+
+DIGEST_TEMPLATE = (
+    "📊 <b>Your {period_name} spending summary</b> ({start:%d %b} &ndash; {last_day:%d %b %Y})\n\n"
+    "💰 <b>{total:.2f} {currency}</b> across {count} expense{plural}{change}\n\n"
+    "{categories}"
+    "{unconverted}"
+    "{commentary}"
+)
+CATEGORY_LINE = "📂 {category}: {spent:.2f} ({share:.0%})\n"
+COMMENTARY_SYSTEM = (
+    "You write one or two short, friendly sentences of commentary on a user's spending summary for a "
+    "Telegram expense tracker: point out what stands out compared to the previous period and, if it "
+    "helps, one practical tip. Plain text only, no greeting, no restating every number."
+)
+
+_handled = set()    # (period, start) of runs already completed, to skip the database check
+
+
+def get_period(period: str, today: date_type):
+    """The last completed week (Monday to Sunday) or month before today, and the one before it.
+    Returns:
+        tuple : (previous period start, period start, period end (exclusive))"""
+    if period == "weekly":
+        start = today - timedelta(days=today.weekday() + 7)
+        return start - timedelta(days=7), start, start + timedelta(days=7)
+    end = today.replace(day=1)
+    start = (end - timedelta(days=1)).replace(day=1)
+    return (start - timedelta(days=1)).replace(day=1), start, end
+
+
+def claim_run(period: str, start: date_type) -> str:
+    """Claim a period's digests for this instance, so each is only sent once across instances and restarts.
+    A run that hasn't been renewed for RUN_LEASE is taken over, so one stopped mid-batch is finished.
+    Returns:
+        str : "claimed", "completed" (already sent) or "running" (claimed by another instance)"""
+    now = datetime.utcnow()
+    with SessionLocal.begin() as session:
+        result = session.execute(dialect_insert(DigestRuns)
+                                 .values(period=period, start=start, claimed_at=now)
+                                 .on_conflict_do_nothing())
+        if result.rowcount == 1:
+            return "claimed"
+        result = session.execute(
+            update(DigestRuns)
+            .where(DigestRuns.period == period, DigestRuns.start == start, DigestRuns.completed_at.is_(None),
+                   DigestRuns.claimed_at < now - RUN_LEASE)
+            .values(claimed_at=now)
+        )
+        if result.rowcount == 1:
+            logging.info("Resuming the %s digests for the period starting %s", period, start)
+            return "claimed"
+        completed_at = session.execute(
+            select(DigestRuns.completed_at).where(DigestRuns.period == period, DigestRuns.start == start)
+        ).scalar_one_or_none()
+        return "running" if completed_at is None else "completed"
+
+
+def get_sent(period: str, start: date_type) -> set:
+    """The telegram ids a run has already sent its digest to"""
+    session = ReadSessionLocal()
+    try:
+        return set(session.execute(
+            select(DigestSends.telegram_id).where(DigestSends.period == period, DigestSends.start == start)
+        ).scalars())
+    finally:
+        session.close()
+
+
+def record_sent(period: str, start: date_type, telegram_id):
+    """Record a sent digest and renew the run's claim"""
+    now = datetime.utcnow()
+    try:
+        with SessionLocal.begin() as session:
+            session.execute(dialect_insert(DigestSends)
+                            .values(period=period, start=start, telegram_id=telegram_id, sent_at=now)
+                            .on_conflict_do_nothing())
+            session.execute(update(DigestRuns)
+                            .where(DigestRuns.period == period, DigestRuns.start == start)
+                            .values(claimed_at=now))
+    except Exception as e:  # pylint: disable=broad-except
+        # (only matters if the run is resumed, which would send this digest again)
+        logging.warning("Could not record the %s digest sent to %s: %s", period, telegram_id, str(e))
+
+
+def complete_run(period: str, start: date_type):
+    """Mark a run as complete, once every digest in it was sent (or failed)"""
+    with SessionLocal.begin() as session:
+        session.execute(update(DigestRuns)
+                        .where(DigestRuns.period == period, DigestRuns.start == start)
+                        .values(completed_at=datetime.utcnow()))
+
+
+def compute_summaries(previous_start: date_type, start: date_type, end: date_type) -> dict:
+    """
+    Every user's spending per category in a period and the period before it, in one grouped query
+    over all users (amounts in BASE_CURRENCY), and the period's expenses that can't be counted
+    because their currency has no exchange rate.
+    Returns:
+        dict : telegram id -> {"categories": {category: spent}, "count": int, "total": Decimal, "previous": Decimal,
+               "unconverted": {currency: count}}
+    """
+    in_period = Expenses.date >= start
+    stmt = (
+        select(Users.telegram_id, Expenses.category,
+               func.sum(case((in_period, Expenses.base_amount), else_=0)),
+               func.sum(case((in_period, 1), else_=0)),
+               func.sum(case((in_period, 0), else_=Expenses.base_amount)))
+        .join(Expenses, Expenses.user_id == Users.id)
+        .where(Expenses.date >= previous_start, Expenses.date < end, Expenses.base_amount.isnot(None))
+        .group_by(Users.telegram_id, Expenses.category)
+    )
+    unconverted_stmt = (
+        select(Users.telegram_id, Expenses.currency, func.count())
+        .join(Expenses, Expenses.user_id == Users.id)
+        .where(Expenses.date >= start, Expenses.date < end, Expenses.base_amount.is_(None))
+        .group_by(Users.telegram_id, Expenses.currency)
+    )
+    session = ReadSessionLocal()
+    try:
+        rows = session.execute(stmt).all()
+        unconverted_rows = session.execute(unconverted_stmt).all()
+    finally:
+        session.close()
+
+    summaries = defaultdict(lambda: {"categories": {}, "count": 0, "total": Decimal(0), "previous": Decimal(0),
+                                     "unconverted": {}})
+    for telegram_id, category, spent, count, previous in rows:
+        summary = summaries[telegram_id]
+        if count:
+            summary["categories"][category] = Decimal(spent)
+            summary["count"] += count
+            summary["total"] += Decimal(spent)
+        summary["previous"] += Decimal(previous or 0)
+    for telegram_id, currency, count in unconverted_rows:
+        summaries[telegram_id]["unconverted"][currency] = count
+    # users who spent nothing this period get no digest
+    return {telegram_id: summary for telegram_id, summary in summaries.items()
+            if summary["count"] or summary["unconverted"]}
+
+
+def render_digest(period: str, start: date_type, end: date_type, summary: dict, commentary: str = None) -> str:
+    """Render a user's digest message (HTML) from its summary"""
+    categories = sorted(summary["categories"].items(), key=lambda item: item[1], reverse=True)
+    if len(categories) > TOP_CATEGORIES:
+        other = sum(spent for _, spent in categories[TOP_CATEGORIES - 1:])
+        categories = categories[:TOP_CATEGORIES - 1] + [("Other", other)]
+
+    total = summary["total"]
+    change = ""
+    if summary["previous"] > 0:
+        ratio = total / summary["previous"] - 1
+        arrow = "▲" if ratio >= 0 else "▼"
+        change = f" ({arrow} {abs(ratio):.0%} vs the previous {'week' if period == 'weekly' else 'month'})"
+
+    return DIGEST_TEMPLATE.format(
+        period_name="weekly" if period == "weekly" else "monthly",
+        start=start,
+        last_day=end - timedelta(days=1),
+        total=total,
+        currency=config.BASE_CURRENCY,
+        count=summary["count"],
+        plural="" if summary["count"] == 1 else "s",
+        change=change,
+        categories="".join(CATEGORY_LINE.format(category=html.escape(category), spent=spent,
+                                                share=spent / total if total else 0)
+                           for category, spent in categories),
+        unconverted=f"\n{html.escape(format_unconverted_note(summary['unconverted']), quote=False)}\n"
+        if summary["unconverted"] else "",
+        commentary=f"\n💡 {html.escape(commentary)}" if commentary else "",
+    )
+
+
+async def get_commentary(digest: str) -> str:
+    """One LLM call for a short comment on a rendered digest, or None if it fails"""
+    from services.sql_agent_svc import get_llm  # pylint: disable=import-outside-toplevel
+    try:
+        response = await get_llm(config.DIGEST_COMMENTARY_MODEL).ainvoke(
+            [("system", COMMENTARY_SYSTEM), ("user", html.unescape(digest))]
+        )
+        metrics.increment("digests.commentaries")
+        return response.text.strip() or None
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning("Could not get digest commentary: %s", str(e))
+        return None
+
+
+async def send_digests(bot, period: str, today: date_type = None) -> int:
+    """
+    Send the last completed period's digest to every user who spent something in it, unless it was
+    already sent. Messages go through the bot's rate limiter, so a large batch is spread out
+    instead of hitting Telegram's limits. Each send is recorded as it happens and the run is only
+    marked complete at the end, so a run cut short (e.g. the instance was stopped) is resumed.
+    Returns:
+        int : the number of digests sent
+    """
+    previous_start, start, end = get_period(period, today or date_type.today())
+    if (period, start) in _handled:
+        return 0
+    state = await asyncio.to_thread(claim_run, period, start)
+    if state == "completed":
+        _handled.add((period, start))
+    if state != "claimed":
+        return 0
+
+    started_at = time.perf_counter()
+    summaries = await asyncio.to_thread(compute_summaries, previous_start, start, end)
+    sent_before = await asyncio.to_thread(get_sent, period, start)
+    summaries = {telegram_id: summary for telegram_id, summary in summaries.items()
+                 if telegram_id not in sent_before}
+    semaphore = asyncio.Semaphore(COMMENTARY_CONCURRENCY)
+
+    async def send(telegram_id, summary) -> bool:
+        digest = render_digest(period, start, end, summary)
+        if config.DIGEST_COMMENTARY_MODEL:
+            async with semaphore:
+                commentary = await get_commentary(digest)
+            digest = render_digest(period, start, end, summary, commentary)
+        try:
+            await bot.send_message(telegram_id, digest, parse_mode="HTML")
+        except TelegramError as e:
+            # e.g. the user blocked the bot
+            metrics.increment("digests.failed")
+            logging.warning("Could not send %s digest to %s: %s", period, telegram_id, str(e))
+            return False
+        await asyncio.to_thread(record_sent, period, start, telegram_id)
+        return True
+
+    results = await asyncio.gather(*(send(telegram_id, summary) for telegram_id, summary in summaries.items()))
+    await asyncio.to_thread(complete_run, period, start)
+    _handled.add((period, start))
+    sent = sum(results)
+    metrics.increment("digests.sent", sent)
+    metrics.observe("digests.run_time", time.perf_counter() - started_at)
+    logging.info("Sent %d %s digests for the period starting %s", sent, period, start)
+    return sent
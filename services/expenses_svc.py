@@ -2,8 +2,20 @@ import csv
 import re
 import logging
 from datetime import datetime
-from sqlalchemy import select, extract
-from database import SessionLocal, Users, Expenses, CategoryRules
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import select, insert, update, delete, extract
+from database import SessionLocal, dialect_insert, bump_data_version, Users, Expenses, ExpenseMessages, \
+    CategoryRules, UserCategories, BudgetTotals
+from services.merchants_svc import resolve_merchant, learn_merchant_alias
+from services.classifier_svc import learn_category, unlearn_category, delete_classifier, forget_classifier
+from services.fx_svc import to_base_amount
+from services.budgets_svc import add_to_totals
+
+def to_date(value):
+    """Converts an ISO date string (e.g. '2025-03-14', as returned by the LLM) to a date object"""
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    return value
 
 def get_or_create_user(telegram_id):
     """Checks if a user exists in the database; if not, creates a new one"""
@@ -59,64 +71,90 @@ def get_categories(user_id):
     """Get all expense categories used by a specific user"""
     session = SessionLocal()
     try:
-        categories = session.query(Expenses.category)\
-            .filter(Expenses.user_id == user_id)\
-            .distinct()\
+        categories = session.query(UserCategories.category)\
+            .filter(UserCategories.user_id == user_id)\
             .all()
         return [category[0] for category in categories]
     finally:
         session.close()
 
-def insert_expense(user_id, price, category, description, date, currency):
-    """Inserts a new expense record into the database"""
-    session = SessionLocal()
-
-    try:
-        new_expense = Expenses(
-            user_id=user_id,
-            price=price,
-            category=category,
-            description=description,
-            date=date,
-            currency=currency
-        )
-        session.add(new_expense)
-        session.commit()
-        session.refresh(new_expense)
-
-        return new_expense.id
-
-    except Exception as e:  # pylint: disable=broad-except
-        session.rollback()
-        print("Error inserting expense: %s", str(e))
-
-    finally:
-        session.close()
-
-def update_expense(expense_id, price, category, description, date, currency):
-    """updates an existing expense record in the database"""
-    session = SessionLocal()
-    expense = session.query(Expenses)\
-        .filter(Expenses.id == expense_id).first()
-
-    expense.price = price
-    expense.category = category
-    expense.description = description
-    expense.date = date
-    expense.currency = currency
+def remove_unused_category(session, user_id, category: str):
+    """Drop a category from the user's category index once none of their expenses use it
+    (call in the same transaction, after the expense is deleted or re-labelled)"""
+    still_used = session.execute(
+        select(Expenses.id).where(Expenses.user_id == user_id, Expenses.category == category).limit(1)
+    ).first()
+    if still_used is None:
+        session.execute(delete(UserCategories)
+                        .where(UserCategories.user_id == user_id, UserCategories.category == category))
+
+def record_expense(user_id, price, category, description, date, currency, expense_id=None, merchant_alias=None):
+    """
+    Records a confirmed expense in a single transaction: inserts it (or updates the user's
+    expense `expense_id` when editing) with its canonical merchant and its amount in the base
+    currency, sets the user's preferred currency to its currency (new expenses only), adds its
+    category to the user's category index (and drops a re-labelled expense's old category if
+    nothing else uses it), moves its amount into its category's monthly budget total and trains
+    the user's category classifier on it.
+    If the user corrected the description, `merchant_alias` is the description they corrected,
+    which is learned as an alias of the expense's merchant.
+    Returns:
+        int : the expense's ID, or None if it couldn't be recorded
+    """
+    values = {
+        "price": price,
+        "category": category,
+        "description": description,
+        "date": to_date(date),
+        "currency": currency,
+    }
 
     try:
-        session.commit()
-        session.refresh(expense)
-        return expense.id
+        with SessionLocal.begin() as session:
+            values["merchant_id"] = resolve_merchant(session, user_id, description)
+            values["base_amount"] = to_base_amount(session, price, currency, values["date"])
+            if merchant_alias:
+                learn_merchant_alias(session, user_id, merchant_alias, values["merchant_id"])
+            previous = None
+            if expense_id is not None:
+                previous = session.execute(
+                    select(Expenses.description, Expenses.category, Expenses.date, Expenses.base_amount)
+                    .where(Expenses.id == expense_id, Expenses.user_id == user_id)
+                    .with_for_update()
+                ).one_or_none()
+            # (before the write, so a classifier trained from history doesn't see this expense twice;
+            # an edited expense's old label is unlearned)
+            learn_category(session, user_id, description, category,
+                           previous=(previous.description, previous.category) if previous else None)
+
+            if expense_id is None:
+                stmt = insert(Expenses).values(user_id=user_id, **values)
+            else:
+                stmt = update(Expenses)\
+                    .where(Expenses.id == expense_id, Expenses.user_id == user_id)\
+                    .values(**values)
+            recorded_id = session.execute(stmt.returning(Expenses.id)).scalar_one_or_none()
+            if recorded_id is None:
+                raise LookupError(f"expense {expense_id} not found for user {user_id}")
+
+            if previous is not None and previous.base_amount is not None:
+                add_to_totals(session, user_id, previous.category, previous.date, -previous.base_amount)
+            add_to_totals(session, user_id, category, values["date"], values["base_amount"])
+            if expense_id is None:
+                # (editing an old expense in another currency doesn't change the user's default)
+                session.execute(update(Users).where(Users.id == user_id).values(preferred_currency=currency))
+            session.execute(dialect_insert(UserCategories)
+                            .values(user_id=user_id, category=category)
+                            .on_conflict_do_nothing())
+            if previous is not None and previous.category != category:
+                remove_unused_category(session, user_id, previous.category)
+            bump_data_version(session, user_id)
+        return recorded_id
 
     except Exception as e:  # pylint: disable=broad-except
-        session.rollback()
-        print(f"Error updating expense: {e}")
-        return False
-
-    finally:
-        session.close()
+        forget_classifier(user_id)
+        logging.error("Error recording expense: %s", str(e))
+        return None
 
 def export_expenses_to_csv(user_id, tele_handle, time_range):
     """export user's expenses to CSV"""
@@ -172,37 +210,72 @@ def export_expenses_to_csv(user_id, tele_handle, time_range):
     finally:
         session.close()
 
-def exact_expense_matching(expense_text):
-    """Find an expense in the database by matching its details."""
+def record_expense_message(chat_id, message_id, expense_id):
+    """Remembers which expense a bot message shows, so replies to it can be resolved to the expense"""
+    try:
+        with SessionLocal.begin() as session:
+            session.execute(dialect_insert(ExpenseMessages)
+                            .values(chat_id=chat_id, message_id=message_id, expense_id=expense_id)
+                            .on_conflict_do_nothing())
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error("Error recording expense message: %s", str(e))
+
+def find_expense_id(user_id, chat_id, message_id, message_text):
+    """
+    Find the user's expense shown in a bot message - by the expense recorded for that message,
+    by the "Expense ID" in its text, or failing both, by its date and amount (with the remaining
+    details having to match too).
+    Returns:
+        int : the expense's ID, or None if none of the user's expenses matches
+    """
     session = SessionLocal()
+    try:
+        expense_id = session.execute(
+            select(Expenses.id)
+            .join(ExpenseMessages, ExpenseMessages.expense_id == Expenses.id)
+            .where(ExpenseMessages.chat_id == chat_id,
+                   ExpenseMessages.message_id == message_id,
+                   Expenses.user_id == user_id)
+        ).scalar()
+        if expense_id:
+            return expense_id
+
+        match = re.search(r"Expense ID:\s*(\d+)", message_text)
+        if match:
+            return session.execute(
+                select(Expenses.id)
+                .where(Expenses.id == int(match.group(1)), Expenses.user_id == user_id)
+            ).scalar()
+
+        # older messages without an ID - extract the details from the text
+        amount = re.search(r"Amount:\s*([\d.]+)", message_text)
+        date = re.search(r"Date:\s*(\d{4}-\d{2}-\d{2})", message_text)
+        if not amount or not date:
+            return None
+        details = {
+            "currency": re.search(r"Currency:\s*(\w+)", message_text),
+            "category": re.search(r"Category:\s*(.+)", message_text),
+            "description": re.search(r"Description:\s*(.+)", message_text),
+        }
+
+        candidates = session.execute(
+            select(Expenses)
+            .where(Expenses.user_id == user_id,
+                   Expenses.date == to_date(date.group(1)),
+                   Expenses.price == Decimal(amount.group(1)).quantize(Decimal("0.01")))
+        ).scalars().all()
+        for expense in candidates:
+            if all(getattr(expense, field) == found.group(1).strip()
+                   for field, found in details.items() if found):
+                return expense.id
+        return None
 
-    # extract details from the text
-    currency_pattern = r"Currency: (\w+)"
-    amount_pattern = r"Amount: ([\d.]+)"
-    category_pattern = r"Category:\s*(.+)"
-    description_pattern = r"Description:\s*(.+)"
-    date_pattern = r"Date: (\d{4}-\d{2}-\d{2})"
-
-    currency = re.search(currency_pattern, expense_text).group(1)
-    amount = float(re.search(amount_pattern, expense_text).group(1))
-    category = re.search(category_pattern, expense_text).group(1)
-    description = re.search(description_pattern, expense_text).group(1)
-    date = re.search(date_pattern, expense_text).group(1)
-
-    date_obj = datetime.strptime(date, "%Y-%m-%d").date()  # convert string to date
-
-    # Try to find a matching expense
-    expense = session.query(Expenses).filter(
-        Expenses.price == float(amount),
-        Expenses.category == category,
-        Expenses.description == description,
-        Expenses.date == date_obj,
-        Expenses.currency == currency
-    ).first()
-
-    session.close()
+    except (InvalidOperation, ValueError) as e:
+        logging.warning("Could not parse expense details from message: %s", str(e))
+        return None
 
-    return expense.id if expense else None
+    finally:
+        session.close()
 
 def delete_all_expenses(user_id):
     """delete all expenses for a specific user"""
@@ -211,11 +284,19 @@ def delete_all_expenses(user_id):
     try:
         session.query(Expenses)\
             .filter(Expenses.user_id == user_id).delete()
+        session.query(BudgetTotals)\
+            .filter(BudgetTotals.user_id == user_id).delete()
+        session.query(UserCategories)\
+            .filter(UserCategories.user_id == user_id).delete()
+        delete_classifier(session, user_id)
+        bump_data_version(session, user_id)
         session.commit()
+        forget_classifier(user_id)
         return True
 
     except Exception as e:  # pylint: disable=broad-except
-        print("Error exporting expenses: %s", str(e))
+        session.rollback()
+        logging.error("Error deleting expenses: %s", str(e))
         return False
 
     finally:
@@ -230,14 +311,22 @@ def delete_specific_expense(user_id, expense_id):
             .filter(Expenses.user_id == user_id, Expenses.id == expense_id).first()
 
         if expense:
+            # (before the delete, so a classifier trained from history still includes this expense)
+            unlearn_category(session, user_id, expense.description, expense.category)
             session.delete(expense)
+            session.flush()
+            if expense.base_amount is not None:
+                add_to_totals(session, user_id, expense.category, expense.date, -expense.base_amount)
+            remove_unused_category(session, user_id, expense.category)
+            bump_data_version(session, user_id)
             session.commit()
             return True
         return False
 
     except Exception as e:  # pylint: disable=broad-except
         session.rollback()
-        print("Error deleting expense: %s", str(e))
+        forget_classifier(user_id)
+        logging.error("Error deleting expense: %s", str(e))
         return False
 
     finally:
@@ -0,0 +1,113 @@
+"""Exchange rates from a local file, and expense amounts converted to the base currency"""
+import csv
+import logging
+import os
+from datetime import date as date_type
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from sqlalchemy import select, update, or_
+from database import SessionLocal, dialect_insert, bump_data_version, Expenses, FxRates
+from services.budgets_svc import add_to_totals
+import config
+
+CENT = Decimal("0.01")
+
+
+def load_rates_file(path: str) -> int:
+    """
+    Load exchange rates from a CSV file with `date,currency,rate` rows, where rate is the number of
+    units of the currency per 1 unit of BASE_CURRENCY on that date (e.g. 2026-03-18,SGD,1.72 with
+    GBP as base). Rows already loaded are updated, so the file can simply be replaced with a newer
+    export and loaded again.
+    Returns:
+        int : the number of rates loaded
+    """
+    rows = []
+    with open(path, newline="", encoding="utf-8") as file:
+        for line_number, row in enumerate(csv.DictReader(file), start=2):
+            try:
+                rate = Decimal(row["rate"])
+                if rate <= 0:
+                    raise InvalidOperation
+                rows.append({
+                    "currency": row["currency"].strip().upper(),
+                    "date": date_type.fromisoformat(row["date"].strip()),
+                    "rate": rate,
+                })
+            except (KeyError, ValueError, InvalidOperation):
+                logging.warning("Skipping invalid exchange rate on line %d of %s", line_number, path)
+
+    if rows:
+        with SessionLocal.begin() as session:
+            stmt = dialect_insert(FxRates)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[FxRates.currency, FxRates.date],
+                set_={"rate": stmt.excluded.rate},
+            ), rows)
+    return len(rows)
+
+
+def get_rate(session, currency: str, on_date):
+    """Units of the currency per unit of BASE_CURRENCY on a date: the latest rate on or before it,
+    or the earliest known rate for dates before the first one. None if there's no rate at all."""
+    currency = (currency or "").upper()
+    if currency == config.BASE_CURRENCY:
+        return Decimal(1)
+    rate = session.execute(
+        select(FxRates.rate)
+        .where(FxRates.currency == currency, FxRates.date <= on_date)
+        .order_by(FxRates.date.desc()).limit(1)
+    ).scalar_one_or_none()
+    if rate is None:
+        rate = session.execute(
+            select(FxRates.rate).where(FxRates.currency == currency).order_by(FxRates.date).limit(1)
+        ).scalar_one_or_none()
+    return rate
+
+
+def to_base_amount(session, price, currency: str, on_date):
+    """Convert an amount to BASE_CURRENCY (rounded to cents), or None if its currency has no rate"""
+    rate = get_rate(session, currency, on_date)
+    if rate is None:
+        return None
+    return (Decimal(str(price)) / Decimal(rate)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def backfill_base_amounts(batch_size: int = 500):
+    """Convert expenses that don't have a base currency amount yet but now have a rate, in batches"""
+    total = 0
+    while True:
+        session = SessionLocal()
+        try:
+            with session.begin():
+                batch = session.execute(
+                    select(Expenses.id, Expenses.user_id, Expenses.price, Expenses.currency, Expenses.date,
+                           Expenses.category)
+                    .where(Expenses.base_amount.is_(None),
+                           or_(Expenses.currency == config.BASE_CURRENCY,
+                               Expenses.currency.in_(select(FxRates.currency).distinct())))
+                    .limit(batch_size)
+                ).all()
+                for expense_id, user_id, price, currency, on_date, category in batch:
+                    base_amount = to_base_amount(session, price, currency, on_date)
+                    session.execute(update(Expenses).where(Expenses.id == expense_id)
+                                    .values(base_amount=base_amount))
+                    add_to_totals(session, user_id, category, on_date, base_amount)
+                for user_id in {row.user_id for row in batch}:
+                    bump_data_version(session, user_id)
+        finally:
+            session.close()
+        total += len(batch)
+        if len(batch) < batch_size:
+            break
+    if total:
+        logging.info("Converted %d existing expenses to %s", total, config.BASE_CURRENCY)
+
+
+def refresh_fx_rates():
+    """Load the rates file (if configured) and convert any expenses that couldn't be converted before"""
+    if config.FX_RATES_FILE and os.path.exists(config.FX_RATES_FILE):
+        count = load_rates_file(config.FX_RATES_FILE)
+        logging.info("Loaded %d exchange rates from %s", count, config.FX_RATES_FILE)
+    elif config.FX_RATES_FILE:
+        logging.warning("Exchange rates file %s not found", config.FX_RATES_FILE)
+    backfill_base_amounts()
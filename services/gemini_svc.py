@@ -1,14 +1,15 @@
-from google import genai
-from google.genai import types
+import asyncio
+import base64
+import json
+import logging
+import time
+from functools import lru_cache
 from tenacity import retry, wait_random_exponential
-from config import PROJECT_ID, MODEL_NAME
-from utils import get_current_date
-
-client = genai.Client(
-    vertexai=True,
-    project=PROJECT_ID,
-    location='global',
-)
+from config import (MODEL_NAME, GEMINI_CACHE_TTL, GEMINI_HEDGE_BUDGET, EXPENSE_IMAGE_MODEL,
+                    EXPENSE_FALLBACK_MODEL, EXPENSE_LATENCY_SLO, get_project_id)
+from utils import get_current_date, parse_partial_json
+from services.routing_svc import call_with_failover, choose_expense_text_model
+import metrics
 
 expense_schema = {
     "type": "OBJECT",
@@ -21,65 +22,355 @@ expense_schema = {
     },
 }
 
-expense_config = types.GenerateContentConfig(
-    temperature=0.2,
-    response_mime_type="application/json",
-    response_schema=expense_schema,
-)
+# the same schema for the openai fallback (structured outputs need every field to be required)
+expense_json_schema = {
+    "title": "expense_details",
+    "type": "object",
+    "properties": {
+        "currency": {"type": "string"},
+        "price": {"type": "number"},
+        "category": {"type": "string"},
+        "description": {"type": "string"},
+        "date": {"type": "string"},
+    },
+    "required": ["currency", "price", "category", "description", "date"],
+    "additionalProperties": False,
+}
+
+# Instructions are kept static (sent as the system instruction, or as cached content) and
+# everything that changes per call - the date, the user's currency, categories and rules, and
+# the input itself - goes after them, so the long shared prefix can be cached by gemini.
+EXPENSE_TEXT_INSTRUCTIONS = """
+    Extract structured expense details from the user's expense text.
+
+    Important instructions for each field:
+    CURRENCY (ALWAYS use the user's currency given below unless the user explicitly specifies a different currency code or symbol in their input. Assume that $ is SGD, not USD. Make sure to return only the 3-letter symbol (example: GBP, SGD, EUR, JPY, MYR, RMB));
+    CATEGORY (follow the category guidance given below. Keep to 1 word if possible);
+    DESCRIPTION (this can just be the place or store name, if specified. If a shop name is not specified or is unclear, be more detailed in the description,
+    but make sure to only include whatever is already in the user input.);
+    DATE (infer the expense date based on today's date given below. Be extra careful if the user inputs terms like "last Tuesday" or "last Monday". Count backwards carefully to find the exact date from today's date).
+
+    If category rules are given below and the expense description matches any of their keywords, you MUST use the corresponding category.
+    """
+
+EXPENSE_IMAGE_INSTRUCTIONS = """
+    Extract structured expense details from the image and provided image caption.
+
+    Use the caption as an additional source of information when determining expense details.
+
+    Instructions:
+    - Look for the TOTAL amount (usually near the bottom, labeled as "TOTAL", "GRAND TOTAL", "AMOUNT DUE", etc.).
+    - Extrapolate the expense date based on today's date given below.
+    - Use receipt date if available; otherwise, infer a reasonable date based on context.
+    - Be extra careful if the user inputs terms like "last Tuesday" or "last Monday". Count backwards carefully to find the exact date from today's date.
+    - ALWAYS use the user's currency given below unless the user explicitly specifies a different currency code or symbol in their input, or the receipt clearly shows a different currency. Assume $ means SGD unless context suggests otherwise.
+    - Make sure to return only the 3-letter symbol (example: GBP, SGD, EUR, JPY, MYR, RMB).
+    - For description, use the store/vendor name or a summary of the main purchase.
+    - For category, follow the category guidance given below.
+    - If category rules are given below and the expense description matches any of their keywords, you MUST use the corresponding category.
+    """
+
+REFINE_INSTRUCTIONS = """
+    You will be given originally parsed expense details and the user's feedback for correction.
+    Refine the expense details accordingly while keeping other details unchanged.
+    """
+
+CACHE_REFRESH_MARGIN = 60  # seconds before a cached content expires that it is replaced
+HEDGE_PERCENTILE = 90      # a duplicate request is sent once a request is slower than this percentile
+HEDGE_MIN_SAMPLES = 50     # latency samples needed before requests are hedged
+HEDGE_MAX_BURST = 10       # hedges that can be saved up while requests are fast
+
+# the google-genai SDK is slow to import, so it (and the client) are only loaded on first use
+@lru_cache(maxsize=None)
+def get_client():
+    """Get the shared gemini client, creating it on first use"""
+    from google import genai  # pylint: disable=import-outside-toplevel
+    return genai.Client(
+        vertexai=True,
+        project=get_project_id(),
+        location='global',
+    )
+
+# (model, instructions) -> (cached content name or None if caching them failed, monotonic time to renew at)
+_instruction_caches = {}
+_cache_tasks = {}   # (model, instructions) -> task creating their cached content
+
+async def _create_cached_instructions(key: tuple):
+    """Create the cached content for a model's instructions, off the request path"""
+    from google.genai import types  # pylint: disable=import-outside-toplevel
+    model, instructions = key
+    try:
+        cache = await get_client().aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=instructions, ttl=f"{GEMINI_CACHE_TTL}s",
+            ),
+        )
+        metrics.increment("gemini.cache_created")
+        entry = (cache.name, time.monotonic() + max(GEMINI_CACHE_TTL - CACHE_REFRESH_MARGIN, 1))
+    except Exception as e:  # pylint: disable=broad-except
+        if "too small" in str(e).lower() or "min_total_token_count" in str(e):
+            # the instructions are below the model's minimum cacheable size - that won't change, so
+            # don't try again
+            logging.warning("Instructions too small for gemini context caching, sending them inline: %s", str(e))
+            entry = (None, float("inf"))
+        else:
+            # fall back to inline instructions (still a stable prefix) and try again after a TTL
+            logging.info("Gemini context caching unavailable, sending instructions inline: %s", str(e))
+            entry = (None, time.monotonic() + GEMINI_CACHE_TTL)
+    _instruction_caches[key] = entry
+
+async def get_cached_instructions(instructions: str, model: str = MODEL_NAME):
+    """Gets the name of a gemini cached content holding the instructions for the model. A missing or
+    expiring cache is (re)created in the background, so no request waits for it. Returns None if
+    explicit caching is disabled, unavailable (e.g. the instructions are below the model's minimum
+    cacheable size) or not ready yet, in which case they are sent with each request."""
+    if GEMINI_CACHE_TTL <= 0:
+        return None
+    key = (model, instructions)
+    entry = _instruction_caches.get(key)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+
+    if key not in _cache_tasks:
+        task = asyncio.create_task(_create_cached_instructions(key))
+        _cache_tasks[key] = task
+        task.add_done_callback(lambda _: _cache_tasks.pop(key, None))
+    # (a cache being renewed is still valid for CACHE_REFRESH_MARGIN seconds)
+    return entry[0] if entry else None
+
+async def get_expense_config(instructions: str, model: str = MODEL_NAME):
+    """Get the generation config for structured expense output with the given (static) instructions"""
+    from google.genai import types  # pylint: disable=import-outside-toplevel
+    cache_name = await get_cached_instructions(instructions, model)
+    if cache_name:
+        return types.GenerateContentConfig(
+            temperature=0.2,
+            response_mime_type="application/json",
+            response_schema=expense_schema,
+            cached_content=cache_name,
+        )
+    return types.GenerateContentConfig(
+        temperature=0.2,
+        response_mime_type="application/json",
+        response_schema=expense_schema,
+        system_instruction=instructions,
+    )
+
+def record_usage(usage_metadata):
+    """Export prompt token counts and how many of them were served from the (explicit or implicit) cache"""
+    if usage_metadata is None:
+        return
+    prompt_tokens = usage_metadata.prompt_token_count or 0
+    cached_tokens = usage_metadata.cached_content_token_count or 0
+    metrics.increment("gemini.prompt_tokens", prompt_tokens)
+    metrics.increment("gemini.cached_tokens", cached_tokens)
+    metrics.increment("gemini.cache_hits" if cached_tokens else "gemini.cache_misses")
+
+class HedgeBudget:
+    """Allows hedged (duplicate) requests for at most a fraction of all requests: each request earns
+    that fraction of a hedge, and a hedge is only sent once a whole one has been earned"""
+
+    def __init__(self, ratio: float, max_hedges: int):
+        self.ratio = ratio
+        self.max_hedges = max_hedges
+        self._available = 0.0
+
+    def record_request(self):
+        self._available = min(self.max_hedges, self._available + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._available < 1:
+            return False
+        self._available -= 1
+        return True
+
+_hedge_budget = HedgeBudget(GEMINI_HEDGE_BUDGET, HEDGE_MAX_BURST)
+
+async def _timed_attempt(make_call, metric: str):
+    # attempts cancelled after losing to a hedge are recorded too (as how long they had taken), so
+    # slow requests keep counting towards the percentile even when hedging cuts them short
+    started_at = time.perf_counter()
+    try:
+        return await make_call()
+    finally:
+        metrics.observe(metric, time.perf_counter() - started_at)
+
+async def hedged(make_call, metric: str):
+    """Awaits make_call(), and if it hasn't answered by the rolling p90 latency, sends a duplicate
+    request (within the hedge budget) and takes whichever succeeds first, cancelling the other.
+    Latencies of single requests are recorded as `metric` whether or not hedging is enabled, and
+    latencies seen by the caller as `metric`_hedged; their p99s with hedging disabled and enabled
+    show what it saves."""
+    if GEMINI_HEDGE_BUDGET <= 0:
+        return await _timed_attempt(make_call, metric)
+
+    started_at = time.perf_counter()
+    attempts = [asyncio.ensure_future(_timed_attempt(make_call, metric))]
+    try:
+        _hedge_budget.record_request()
+        if metrics.sample_count(metric) >= HEDGE_MIN_SAMPLES:
+            done, _ = await asyncio.wait(attempts, timeout=metrics.percentile(metric, HEDGE_PERCENTILE))
+            if not done:
+                if _hedge_budget.try_spend():
+                    metrics.increment("gemini.hedges")
+                    attempts.append(asyncio.ensure_future(_timed_attempt(make_call, metric)))
+                else:
+                    metrics.increment("gemini.hedges_over_budget")
+
+        pending = set(attempts)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                if succeeded[0] is not attempts[0]:
+                    metrics.increment("gemini.hedge_wins")
+                metrics.observe(f"{metric}_hedged", time.perf_counter() - started_at)
+                return succeeded[0].result()
+            if not pending:
+                raise done.pop().exception()
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+async def generate_expense(instructions: str, contents, on_fields=None, model: str = MODEL_NAME) -> str:
+    """Generates structured expense output, streaming it if a callback for partial results is given
+    Args:
+        instructions (str) : static instructions (cached by gemini where possible)
+        contents : per-call prompt (and image) to send to gemini
+        on_fields (async callable) : called with the fields parsed so far whenever another one is complete
+        model (str) : gemini model to use
+    Returns:
+        text (str) : the full text generated by LLM with json structure
+    """
+    expense_config = await get_expense_config(instructions, model)
+    try:
+        if on_fields is None:
+            response = await hedged(
+                lambda: get_client().aio.models.generate_content(
+                    model=model, contents=contents, config=expense_config
+                ),
+                "gemini.request_latency",
+            )
+            record_usage(response.usage_metadata)
+            return response.text
+
+        async def open_stream():
+            # a stream is hedged until its first chunk; the rest comes from the stream that won
+            stream = aiter(await get_client().aio.models.generate_content_stream(
+                model=model, contents=contents, config=expense_config))
+            return stream, await anext(stream, None)
+
+        started_at = time.perf_counter()
+        text, fields, usage_metadata = "", {}, None
+        stream, chunk = await hedged(open_stream, "gemini.first_chunk_latency")
+        while chunk is not None:
+            text += chunk.text or ""
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            partial = parse_partial_json(text)
+            if len(partial) > len(fields):
+                if not fields:
+                    metrics.observe("gemini.time_to_first_field", time.perf_counter() - started_at)
+                fields = partial
+                await on_fields(dict(fields))
+            chunk = await anext(stream, None)
+        metrics.observe("gemini.stream_time", time.perf_counter() - started_at)
+        record_usage(usage_metadata)
+        return text
+    except Exception:
+        if expense_config.cached_content:
+            # the cached content may have expired or been deleted - recreate it on the retry
+            _instruction_caches.pop((model, instructions), None)
+        raise
+
+async def generate_expense_openai(instructions: str, prompt: str, image: tuple = None) -> str:
+    """Generates structured expense output with the openai fallback model, in the same json format
+    Args:
+        instructions (str) : static instructions
+        prompt (str) : per-call prompt
+        image (tuple) : (mime type, image bytes) of a receipt, if any
+    Returns:
+        text (str) : json text with the expense details
+    """
+    from langchain_core.messages import HumanMessage, SystemMessage  # pylint: disable=import-outside-toplevel
+    from services import sql_agent_svc  # pylint: disable=import-outside-toplevel
+
+    content = [{"type": "text", "text": prompt}]
+    if image:
+        mime_type, image_bytes = image
+        data_url = f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode()}"
+        content.insert(0, {"type": "image_url", "image_url": {"url": data_url}})
+
+    llm = sql_agent_svc.get_llm(EXPENSE_FALLBACK_MODEL).with_structured_output(
+        expense_json_schema, method="json_schema", strict=True
+    )
+    result = await llm.ainvoke([SystemMessage(instructions), HumanMessage(content=content)])
+    return json.dumps(result)
+
+async def parse_expense(route: str, model: str, instructions: str, prompt: str, image: tuple = None, on_fields=None) -> str:
+    """Parses expense details with the gemini model for the route, failing over to openai if gemini
+    errors or is too slow"""
+    contents = prompt
+    if image:
+        from google.genai import types  # pylint: disable=import-outside-toplevel
+        contents = [types.Part.from_bytes(mime_type=image[0], data=image[1]), prompt]
+
+    return await call_with_failover(
+        route,
+        lambda: generate_expense(instructions, contents, on_fields, model),
+        lambda: generate_expense_openai(instructions, prompt, image),
+        EXPENSE_LATENCY_SLO,
+    )
+
+def format_category_guidance(existing_categories: list, category_rules: list, known_category: str = None) -> str:
+    """Per-user category guidance, appended after the static instructions"""
+    if known_category:
+        guidance = f'Category: always "{known_category}".'
+    elif existing_categories:
+        guidance = (
+            f"Category: the user's existing categories are: {existing_categories}. "
+            "Use one of these if applicable. Only create a new category if none of the existing ones fit."
+        )
+    else:
+        guidance = "Category: think about what it should be based on the item or place provided."
+
+    if category_rules and not known_category:
+        rules_formatted = ", ".join([f"'{r['keyword']}' -> {r['category']}" for r in category_rules])
+        guidance += f"\n    Category rules: [{rules_formatted}]"
+    return guidance
 
 # function to call gemini to process expense text
 # implement exponential backoff for load handling
 @retry(wait=wait_random_exponential(multiplier=1, max=60))
-async def process_expense_text(input_text: str, preferred_currency: str = "GBP", existing_categories: list = None, category_rules: list = None):
+async def process_expense_text(input_text: str, preferred_currency: str = "GBP", existing_categories: list = None, category_rules: list = None, known_category: str = None, on_fields=None):
     """parses expense details from plain text input
     Args:
         input_text (str) : user input
         preferred_currency (str) : user's preferred currency. Defaults to GBP
         existing_categories (list) : list of categories the user has used before
         category_rules (list) : list of keyword-to-category rules set by the user
+        known_category (str) : category already determined locally (skips category inference)
+        on_fields (async callable) : streams the response, calling this with the fields parsed so far
     Returns:
         response.text (str) : text generated by LLM with json structure
     """
 
     today, day = get_current_date()
 
-    category_instruction = "CATEGORY (think about what it should be based on the item or place provided. Keep to 1 word if possible);"
-    if existing_categories:
-        category_instruction = (
-            f"CATEGORY (the user's existing categories are: {existing_categories}. "
-            "Use one of these if applicable. Only create a new category if none of the existing ones fit. Keep to 1 word if possible);"
-        )
-
-    rule_instruction = ""
-    if category_rules:
-        rules_formatted = ", ".join([f"'{r['keyword']}' -> {r['category']}" for r in category_rules])
-        rule_instruction = (
-            f"\n    CATEGORY RULES: The user has set these category preferences: [{rules_formatted}]. "
-            "If the expense description matches any of these keywords, you MUST use the corresponding category."
-        )
-
     prompt = f"""
-    Extract structured expense details from this text: {input_text}.
-
-    Today's date is {today}. Today is {day}. Infer the expense date based on today's date.
+    Today's date is {today}. Today is {day}.
+    The user's currency is {preferred_currency}.
+    {format_category_guidance(existing_categories, category_rules, known_category)}
 
-    Important instructions for each field:
-    CURRENCY (the user's currency is {preferred_currency}. ALWAYS use this currency unless the user explicitly specifies a different currency code or symbol in their input. Assume that $ is SGD, not USD. Make sure to return only the 3-letter symbol (example: GBP, SGD, EUR, JPY, MYR, RMB));
-    {category_instruction}
-    DESCRIPTION (this can just be the place or store name, if specified. If a shop name is not specified or is unclear, be more detailed in the description,
-    but make sure to only include whatever is already in the user input.);
-    DATE (be extra careful if the user inputs terms like "last Tuesday" or "last Monday". Count backwards carefully to find the exact date from today's date).
-    {rule_instruction}
+    Expense text: {input_text}
     """
-    response = await client.aio.models.generate_content(
-        model=MODEL_NAME, contents=prompt, config=expense_config
-    )
-    return response.text
+    return await parse_expense("expense_text", choose_expense_text_model(input_text),
+                               EXPENSE_TEXT_INSTRUCTIONS, prompt, on_fields=on_fields)
 
 # function to call gemini to process expense (e.g. receipt) image
 # implement exponential backoff for load handling
 @retry(wait=wait_random_exponential(multiplier=1, max=60))
-async def process_expense_image(image_path: str, caption: str="", preferred_currency: str = "GBP", existing_categories: list = None, category_rules: list = None):
+async def process_expense_image(image_path: str, caption: str="", preferred_currency: str = "GBP", existing_categories: list = None, category_rules: list = None, on_fields=None):
     """parses expense details from image input
     Args:
         - image_path (str) : path to image sent by user
@@ -87,44 +378,19 @@ async def process_expense_image(image_path: str, caption: str="", preferred_curr
         - preferred_currency (str) : user's preferred currency. Defaults to GBP
         - existing_categories (list) : list of categories the user has used before
         - category_rules (list) : list of keyword-to-category rules set by the user
+        - on_fields (async callable) : streams the response, calling this with the fields parsed so far
     Returns:
         response.text (str): text generated by LLM with json structure
     """
 
     today, day = get_current_date()
 
-    category_instruction = "For category, determine a suitable category based on the vendor or purchased items."
-    if existing_categories:
-        category_instruction = (
-            f"For category, the user's existing categories are: {existing_categories}. "
-            "Use one of these if applicable. Only create a new category if none of the existing ones fit."
-        )
-
-    rule_instruction = ""
-    if category_rules:
-        rules_formatted = ", ".join([f"'{r['keyword']}' -> {r['category']}" for r in category_rules])
-        rule_instruction = (
-            f"\n    - CATEGORY RULES: The user has set these category preferences: [{rules_formatted}]. "
-            "If the expense description matches any of these keywords, you MUST use the corresponding category."
-        )
-
     prompt = f"""
-    Extract structured expense details from the image and provided image caption.
+    Today's date is {today}. Today is {day}.
+    The user's currency is {preferred_currency}.
+    {format_category_guidance(existing_categories, category_rules)}
 
     IMPORTANT - Image caption: {caption or "No caption provided"}
-
-    Use the caption as an additional source of information when determining expense details.
-
-    Instructions:
-    - Look for the TOTAL amount (usually near the bottom, labeled as "TOTAL", "GRAND TOTAL", "AMOUNT DUE", etc.).
-    - Today's date is {today}. Today is {day}. Extrapolate the expense date based on today's date.
-    - Use receipt date if available; otherwise, infer a reasonable date based on context.
-    - Be extra careful if the user inputs terms like "last Tuesday" or "last Monday". Count backwards carefully to find the exact date from today's date.
-    - The user's currency is {preferred_currency}. ALWAYS use this currency unless the user explicitly specifies a different currency code or symbol in their input, or the receipt clearly shows a different currency. Assume $ means SGD unless context suggests otherwise.
-    - Make sure to return only the 3-letter symbol (example: GBP, SGD, EUR, JPY, MYR, RMB).
-    - For description, use the store/vendor name or a summary of the main purchase.
-    - {category_instruction}
-    {rule_instruction}
     """
 
     with open(image_path, "rb") as img_file:
@@ -140,15 +406,8 @@ async def process_expense_image(image_path: str, caption: str="", preferred_curr
     else:
         mime_type = "image/jpeg"  # fallback — most common from Telegram
 
-    image_part = types.Part.from_bytes(
-        mime_type=mime_type,
-        data=image_bytes,
-    )
-
-    response = await client.aio.models.generate_content(
-        model=MODEL_NAME, contents=[image_part, prompt], config=expense_config
-    )
-    return response.text
+    return await parse_expense("expense_image", EXPENSE_IMAGE_MODEL, EXPENSE_IMAGE_INSTRUCTIONS, prompt,
+                               image=(mime_type, image_bytes), on_fields=on_fields)
 
 # function to refine extracted expense details
 # implement exponential backoff for load handling
@@ -164,13 +423,9 @@ async def refine_expense_details(original_details, user_feedback):
     prompt = f"""
     Here are the originally parsed expense details:
     {original_details}
-    
+
     The user has provided the following feedback for correction:
     {user_feedback}
-    
-    Please refine the expense details accordingly while keeping other details unchanged.
     """
-    response = await client.aio.models.generate_content(
-        model=MODEL_NAME, contents=prompt, config=expense_config
-    )
-    return response.text
+    return await parse_expense("expense_refine", choose_expense_text_model(user_feedback),
+                               REFINE_INSTRUCTIONS, prompt)
@@ -0,0 +1,157 @@
+"""Merchant canonicalisation - maps differently written expense descriptions to one merchant per user"""
+import logging
+import re
+import unicodedata
+from sqlalchemy import select, insert, update, delete
+from database import SessionLocal, dialect_insert, bump_data_version, Expenses, Merchants, MerchantAliases
+
+# words that don't identify a merchant (company suffixes, filler)
+NOISE_WORDS = {"the", "ltd", "limited", "inc", "plc", "llc", "co", "corp", "pte", "sdn", "bhd", "gmbh"}
+UNNAMED_KEY = "-"      # merchant for descriptions without any letters or digits
+
+
+def merchant_key(name: str) -> str:
+    """
+    Normalise a merchant name/description to a lookup key: lowercase ascii words without
+    punctuation, store numbers or company suffixes (e.g. "Starbucks Coffee Co. #1234" -> "starbucks coffee").
+    Numbers before the first word are part of the name (e.g. "7-Eleven" -> "7 eleven", "7-11" -> "7 11").
+    """
+    text = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode().lower()
+    text = text.replace("&", " and ").replace("'", "")
+    words = re.sub(r"[^a-z0-9]+", " ", text).split()
+    kept, named = [], False
+    for word in words:
+        if word in NOISE_WORDS or (named and word.isdigit()):
+            continue
+        kept.append(word)
+        named = named or not word.isdigit()
+    # fall back to all words for names made only of suffixes (e.g. "Co")
+    return " ".join(kept) or " ".join(words)
+
+
+def _match(session, user_id, key: str):
+    """Find the user's merchant with an alias (its own name's key or a learned one) equal to the key.
+    Keys sharing only a prefix are different merchants (e.g. "uber" and "uber eats")."""
+    return session.execute(
+        select(MerchantAliases.alias_key, MerchantAliases.learned, Merchants.id, Merchants.name)
+        .join(Merchants, Merchants.id == MerchantAliases.merchant_id)
+        .where(MerchantAliases.user_id == user_id, MerchantAliases.alias_key == key)
+    ).first()
+
+
+def find_merchant(user_id, description: str):
+    """
+    Look up the user's canonical merchant for a description.
+    Returns:
+        dict : merchant id and name, and whether the description is a learned alias of it
+               (i.e. the user corrected it to that merchant before), or None if it's unknown
+    """
+    key = merchant_key(description)
+    if not key:
+        return None
+    session = SessionLocal()
+    try:
+        row = _match(session, user_id, key)
+        if row is None:
+            return None
+        return {"id": row.id, "name": row.name, "learned": row.learned}
+    finally:
+        session.close()
+
+
+def resolve_merchant(session, user_id, description: str):
+    """
+    Get the ID of the user's merchant for a description, creating the merchant if it's new.
+    Descriptions match a merchant by normalised key (e.g. "STARBUCKS #1234" -> "Starbucks") or an
+    alias the user taught by correcting a description.
+    Runs in the caller's session/transaction (see expenses_svc.record_expense).
+    """
+    key = merchant_key(description) or UNNAMED_KEY
+    row = _match(session, user_id, key)
+    if row is not None:
+        return row.id
+
+    merchant_id = session.execute(
+        insert(Merchants).values(user_id=user_id, name=description or UNNAMED_KEY)
+        .returning(Merchants.id)
+    ).scalar_one()
+    result = session.execute(dialect_insert(MerchantAliases)
+                             .values(user_id=user_id, alias_key=key, merchant_id=merchant_id, learned=False)
+                             .on_conflict_do_nothing(index_elements=["user_id", "alias_key"]))
+    if result.rowcount == 1:
+        return merchant_id
+
+    # a concurrent transaction created the same merchant first (the insert waited for it to commit) -
+    # use that one instead of leaving an orphan merchant without an alias
+    session.execute(delete(Merchants).where(Merchants.id == merchant_id))
+    return _match(session, user_id, key).id
+
+
+def learn_merchant_alias(session, user_id, alias: str, merchant_id: int):
+    """
+    Remember that the user corrected `alias` to the given merchant, so it resolves there from now on.
+    A merchant's own name is never remapped, only names that aren't a merchant yet or were learned.
+    Runs in the caller's session/transaction.
+    """
+    key = merchant_key(alias)
+    if not key or merchant_id is None:
+        return
+    existing = session.execute(
+        select(MerchantAliases.learned, MerchantAliases.merchant_id)
+        .where(MerchantAliases.user_id == user_id, MerchantAliases.alias_key == key)
+    ).first()
+    if existing is not None and (not existing.learned or existing.merchant_id == merchant_id):
+        return
+
+    stmt = dialect_insert(MerchantAliases).values(
+        user_id=user_id, alias_key=key, merchant_id=merchant_id, learned=True
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "alias_key"],
+        set_={"merchant_id": merchant_id, "learned": True},
+    ))
+    logging.info("Learned merchant alias '%s' -> %s for user %s", key, merchant_id, user_id)
+
+
+def backfill_merchants(batch_size: int = 500):
+    """Assign merchants to expenses recorded before merchants existed, in batches"""
+    total = 0
+    while True:
+        session = SessionLocal()
+        try:
+            with session.begin():
+                batch = session.execute(
+                    select(Expenses.id, Expenses.user_id, Expenses.description)
+                    .where(Expenses.merchant_id.is_(None))
+                    .limit(batch_size)
+                ).all()
+                for expense_id, user_id, description in batch:
+                    merchant_id = resolve_merchant(session, user_id, description)
+                    session.execute(update(Expenses).where(Expenses.id == expense_id)
+                                    .values(merchant_id=merchant_id))
+                for user_id in {user_id for _, user_id, _ in batch}:
+                    bump_data_version(session, user_id)
+        finally:
+            session.close()
+        total += len(batch)
+        if len(batch) < batch_size:
+            break
+    if total:
+        logging.info("Assigned merchants to %d existing expenses", total)
+
+
+def apply_merchant_preferences(user_id, parsed_expense: dict, category_rules: list):
+    """
+    Apply what's known about the parsed expense's merchant in place: use the canonical name if the
+    user corrected this description to a merchant before, and the category of a rule whose keyword
+    is the same merchant (exact key match, so the LLM doesn't have to spot it)
+    """
+    merchant = find_merchant(user_id, parsed_expense["description"])
+    if merchant and merchant["learned"]:
+        parsed_expense["description"] = merchant["name"]
+
+    key = merchant_key(parsed_expense["description"])
+    for rule in category_rules or []:
+        if merchant_key(rule["keyword"]) == key:
+            parsed_expense["category"] = rule["category"]
+            break
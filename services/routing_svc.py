@@ -0,0 +1,91 @@
+"""Model routing - picks the cheapest adequate model per request, and fails over to another model
+(provider) when the primary one breaches its latency SLO or errors"""
+import asyncio
+import logging
+import re
+import time
+import config
+import metrics
+
+TINY_EXPENSE_LENGTH = 60   # characters; short single-amount texts go to the fastest model
+# analytics questions that likely need several queries or some reasoning
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"\b(compare|comparison|vs|versus|trends?|each|every|per|breakdown|average|forecast|predict|"
+    r"why|budget|sav(?:e|ing|ings)|month[- ]on[- ]month|year[- ]on[- ]year|over the (?:last|past))\b",
+    re.IGNORECASE,
+)
+COMPLEX_QUESTION_LENGTH = 150   # characters
+FAILURES_BEFORE_DEGRADED = 3    # consecutive primary failures before skipping it for a while
+DEGRADED_PERIOD = 60            # seconds requests go straight to the fallback once degraded
+
+
+def choose_expense_text_model(text: str) -> str:
+    """Fastest model for tiny expenses (e.g. "coffee 4.50"), otherwise the standard text model"""
+    if len(text) <= TINY_EXPENSE_LENGTH and len(re.findall(r"\d+(?:[.,]\d+)?", text)) <= 1:
+        return config.MODEL_NAME
+    return config.EXPENSE_TEXT_MODEL
+
+
+def choose_analyst_model(question: str) -> str:
+    """Stronger model for comparisons, trends and other multi-step questions, otherwise the default"""
+    if len(question) > COMPLEX_QUESTION_LENGTH or COMPLEX_QUESTION_PATTERN.search(question):
+        return config.ANALYST_STRONG_MODEL
+    return config.ANALYST_MODEL
+
+
+class RouteHealth:
+    """Recent health of a route's primary model"""
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.degraded_until = 0.0
+
+
+_routes = {}   # route name -> RouteHealth
+
+
+async def _timed(route: str, target: str, call):
+    """Await call(), recording its latency and errors under the route and target (primary/fallback)"""
+    started_at = time.perf_counter()
+    try:
+        return await call()
+    except Exception:
+        metrics.increment(f"llm.{route}.{target}_errors")
+        raise
+    finally:
+        metrics.observe(f"llm.{route}.{target}_latency", time.perf_counter() - started_at)
+
+
+async def call_with_failover(route: str, primary, fallback, slo: float):
+    """
+    Run a request on its primary model, failing over to the fallback if the primary errors or takes
+    longer than the latency SLO. After repeated failures the primary is skipped for a while.
+    Args:
+        route (str) : route name, used for metrics (llm.<route>.*) and logs
+        primary, fallback (coroutine functions) : make the request with each model
+        slo (float) : seconds the primary may take before failing over
+    Returns:
+        the result of whichever model answered
+    """
+    health = _routes.setdefault(route, RouteHealth())
+    if time.monotonic() < health.degraded_until:
+        metrics.increment(f"llm.{route}.primary_skipped")
+        return await _timed(route, "fallback", fallback)
+
+    try:
+        result = await asyncio.wait_for(_timed(route, "primary", primary), timeout=slo)
+        health.consecutive_failures = 0
+        return result
+    except asyncio.TimeoutError:
+        metrics.increment(f"llm.{route}.slo_breaches")
+        logging.warning("%s: primary model took longer than %ss, failing over", route, slo)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning("%s: primary model failed, failing over: %s", route, str(e))
+
+    health.consecutive_failures += 1
+    if health.consecutive_failures >= FAILURES_BEFORE_DEGRADED:
+        health.degraded_until = time.monotonic() + DEGRADED_PERIOD
+        logging.warning("%s: primary model failed %d times in a row, using the fallback for %ds",
+                        route, health.consecutive_failures, DEGRADED_PERIOD)
+    metrics.increment(f"llm.{route}.failovers")
+    return await _timed(route, "fallback", fallback)
@@ -0,0 +1,198 @@
+"""Fuzzy (trigram) and optional semantic (embedding) search over a user's expenses"""
+import difflib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from sqlalchemy import select, or_, func, literal
+from sqlalchemy.exc import SQLAlchemyError
+from database import SessionLocal, engine, dialect_insert, get_data_version, Expenses, DescriptionEmbeddings
+import config
+
+MIN_FUZZY_RATIO = 0.75        # difflib ratio threshold for fuzzy matches without pg_trgm
+MIN_SEMANTIC_SIMILARITY = 0.4  # cosine similarity threshold for semantic matches
+RANK_FUSION_K = 60            # reciprocal rank fusion constant
+
+_matrices = OrderedDict()     # (user id, model) -> (data version, descriptions, embeddings), least recently used first
+_matrices_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_embedder():
+    """Get the local embedding model for semantic search, or None if it's disabled or unavailable"""
+    if not config.SEARCH_EMBEDDING_MODEL:
+        return None
+    try:
+        # optional dependency, only needed for semantic search
+        from sentence_transformers import SentenceTransformer  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.warning("sentence-transformers is not installed; semantic search is disabled")
+        return None
+    return SentenceTransformer(config.SEARCH_EMBEDDING_MODEL)
+
+
+def _expense_to_dict(expense) -> dict:
+    return {
+        "id": expense.id,
+        "date": str(expense.date),
+        "description": expense.description,
+        "category": expense.category,
+        "price": float(expense.price),
+        "currency": expense.currency,
+    }
+
+
+def _fuzzy_search(session, user_id, query: str, limit: int) -> list:
+    """Rank the user's expenses by how closely their description matches the query"""
+    # (LIKE wildcards in the query are matched literally, so "%" or "_" doesn't match everything)
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    pattern = f"%{escaped}%"
+
+    if engine.dialect.name == "postgresql":
+        # uses the trigram index on description (both for <% and ILIKE)
+        score = func.word_similarity(query, Expenses.description)
+        try:
+            return session.execute(
+                select(Expenses)
+                .where(Expenses.user_id == user_id,
+                       or_(literal(query).op("<%")(Expenses.description),
+                           Expenses.description.ilike(pattern, escape="\\"),
+                           Expenses.category.ilike(pattern, escape="\\")))
+                .order_by(score.desc(), Expenses.date.desc())
+                .limit(limit)
+            ).scalars().all()
+        except SQLAlchemyError as e:
+            session.rollback()
+            logging.warning("Trigram search failed (is pg_trgm installed?), falling back: %s", str(e))
+
+    # no trigram support - score the user's distinct descriptions in python instead
+    descriptions = session.execute(
+        select(Expenses.description).where(Expenses.user_id == user_id).distinct()
+    ).scalars().all()
+    lowered = query.lower()
+    scored = []
+    for description in descriptions:
+        text = description.lower()
+        candidates = [text] + text.split()
+        score = 1.0 if lowered in text else \
+            max(difflib.SequenceMatcher(None, lowered, candidate).ratio() for candidate in candidates)
+        if score >= MIN_FUZZY_RATIO:
+            scored.append((score, description))
+    best = [description for _, description in sorted(scored, reverse=True)[:limit]]
+
+    expenses = session.execute(
+        select(Expenses)
+        .where(Expenses.user_id == user_id,
+               or_(Expenses.description.in_(best), Expenses.category.ilike(pattern, escape="\\")))
+        .order_by(Expenses.date.desc())
+    ).scalars().all()
+    rank = {description: i for i, description in enumerate(best)}
+    return sorted(expenses, key=lambda expense: rank.get(expense.description, len(best)))[:limit]
+
+
+def _get_embeddings(session, user_id, embedder):
+    """
+    The user's distinct descriptions and their embeddings (one row each), kept in memory while the
+    user's data version is unchanged so a search only has to embed the query.
+    Returns:
+        tuple : (descriptions, embedding matrix)
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    model = config.SEARCH_EMBEDDING_MODEL
+    key = (user_id, model)
+    version = get_data_version(session, user_id)
+    with _matrices_lock:
+        entry = _matrices.get(key)
+        if entry is not None and entry[0] == version:
+            _matrices.move_to_end(key)
+            return entry[1], entry[2]
+
+    descriptions = session.execute(
+        select(Expenses.description).where(Expenses.user_id == user_id).distinct()
+    ).scalars().all()
+    if not descriptions:
+        return [], None
+
+    # embeddings are cached per distinct description, so only new descriptions get embedded
+    cached = dict(session.execute(
+        select(DescriptionEmbeddings.description, DescriptionEmbeddings.vector)
+        .where(DescriptionEmbeddings.model == model,
+               DescriptionEmbeddings.description.in_(descriptions))
+    ).all())
+    missing = [description for description in descriptions if description not in cached]
+    if missing:
+        vectors = embedder.encode(missing, normalize_embeddings=True).astype(np.float32)
+        with engine.begin() as conn:
+            conn.execute(
+                dialect_insert(DescriptionEmbeddings).on_conflict_do_nothing(),
+                [{"model": model, "description": d, "vector": v.tobytes()} for d, v in zip(missing, vectors)],
+            )
+        cached.update({d: v.tobytes() for d, v in zip(missing, vectors)})
+
+    matrix = np.stack([np.frombuffer(cached[d], dtype=np.float32) for d in descriptions])
+    with _matrices_lock:
+        _matrices[key] = (version, descriptions, matrix)
+        _matrices.move_to_end(key)
+        while len(_matrices) > config.SEARCH_CACHE_USERS:
+            _matrices.popitem(last=False)
+    return descriptions, matrix
+
+
+def _semantic_search(session, user_id, query: str, limit: int) -> list:
+    """Rank the user's expenses by embedding similarity between the query and their descriptions"""
+    embedder = get_embedder()
+    if embedder is None:
+        return []
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    descriptions, matrix = _get_embeddings(session, user_id, embedder)
+    if not descriptions:
+        return []
+    query_vector = embedder.encode([query], normalize_embeddings=True)[0].astype(np.float32)
+    similarities = matrix @ query_vector
+    top = [descriptions[i] for i in np.argsort(-similarities)[:limit]
+           if similarities[i] >= MIN_SEMANTIC_SIMILARITY]
+    if not top:
+        return []
+
+    expenses = session.execute(
+        select(Expenses)
+        .where(Expenses.user_id == user_id, Expenses.description.in_(top))
+        .order_by(Expenses.date.desc())
+    ).scalars().all()
+    rank = {description: i for i, description in enumerate(top)}
+    return sorted(expenses, key=lambda expense: rank[expense.description])[:limit]
+
+
+def search_expenses(user_id, query: str, limit: int = 10) -> list:
+    """
+    Search a user's expenses by merchant/description, tolerating typos and partial names.
+    If a local embedding model is configured, semantically similar descriptions are found too
+    (e.g. "coffee" finding "starbucks") and both rankings are merged.
+    Returns:
+        list : matching expenses as dicts (id, date, description, category, price, currency), best first
+    """
+    query = query.strip()
+    if not query:
+        return []
+
+    session = SessionLocal()
+    try:
+        rankings = [_fuzzy_search(session, user_id, query, limit)]
+        try:
+            rankings.append(_semantic_search(session, user_id, query, limit))
+        except Exception as e:  # pylint: disable=broad-except
+            session.rollback()
+            logging.error("Semantic search failed: %s", str(e))
+
+        # reciprocal rank fusion of the fuzzy and semantic rankings
+        scores, expenses = {}, {}
+        for ranking in rankings:
+            for rank, expense in enumerate(ranking):
+                scores[expense.id] = scores.get(expense.id, 0.0) + 1.0 / (RANK_FUSION_K + rank)
+                expenses[expense.id] = expense
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [_expense_to_dict(expenses[expense_id]) for expense_id in best]
+    finally:
+        session.close()
@@ -1,28 +1,42 @@
+import asyncio
 import json
 import os
+import uuid
+from functools import lru_cache
 from typing import Annotated, Literal
 from sqlalchemy.sql import text
 from langchain_core.tools import tool
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 from langgraph.graph import END, StateGraph, START
 from langgraph.graph.message import AnyMessage, add_messages
 from langgraph.types import StreamWriter
-from database import SessionLocal
+from langchain_core.runnables import RunnableConfig
+from database import ReadSessionLocal, read_engine
+from services.search_svc import search_expenses
+from services.analytics_svc import run_local_query
+from services.routing_svc import call_with_failover
 from utils import create_tool_node_with_fallback, get_current_date
-from config import OPENAI_API_KEY
-
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-
-# Single model for both query generation and answer formulation
-llm = ChatOpenAI(
-    model="gpt-5.4-mini",
-    reasoning_effort="low",
-    use_responses_api=True,
-    max_retries=3
-)
+import config
+from config import ANALYST_MODEL, ANALYST_STRONG_MODEL, ANALYST_LATENCY_SLO, BASE_CURRENCY
+import metrics
+
+# One client per model, used for both query generation and answer formulation
+# (created on first use, as langchain_openai is slow to import and the API key is fetched lazily)
+@lru_cache(maxsize=None)
+def get_llm(model: str = ANALYST_MODEL):
+    """Get the shared openai LLM for a model, creating it on first use"""
+    from langchain_openai import ChatOpenAI  # pylint: disable=import-outside-toplevel
+    os.environ["OPENAI_API_KEY"] = config.OPENAI_API_KEY
+    return ChatOpenAI(
+        model=model,
+        reasoning_effort="low",
+        use_responses_api=True,
+        max_retries=3,
+        # all analyser requests share the system prompt and tools, so route them to the same cache
+        model_kwargs={"prompt_cache_key": "expense-analyser"},
+    )
 
 class State(TypedDict):
     """Define the state for the agent"""
@@ -31,15 +45,17 @@ class State(TypedDict):
 #---------------------------------------------------------------------------------------------------
 # Tools #
 
-@tool
-def db_query_tool(query: str) -> str:
-    """
-    Execute a SQL query against the database and get back the result.
-    If the query is not correct, an error message will be returned.
-    If an error is returned, rewrite the query, check the query, and try again.
-    """
-    session = SessionLocal()
+def run_read_query(query: str) -> str:
+    """Run a query on the local copy of the user's expenses if possible (see analytics_svc),
+    otherwise in a read-only transaction on the read pool, returning its rows as JSON"""
+    local_result = run_local_query(query)
+    if local_result is not None:
+        return local_result
+
+    session = ReadSessionLocal()
     try:
+        if read_engine.dialect.name == "postgresql":
+            session.execute(text("SET TRANSACTION READ ONLY"))
         result = session.execute(text(query))
         results_as_dict = result.mappings().all()
 
@@ -55,6 +71,31 @@ def db_query_tool(query: str) -> str:
     finally:
         session.close()
 
+# tools are async so that the tool node can run all of a turn's calls concurrently,
+# each in a worker thread with its own connection from the read pool
+@tool
+async def db_query_tool(query: str) -> str:
+    """
+    Execute a SQL query against the database and get back the result.
+    If the query is not correct, an error message will be returned.
+    If an error is returned, rewrite the query, check the query, and try again.
+    """
+    return await asyncio.to_thread(run_read_query, query)
+
+@tool
+async def search_expenses_tool(user_id: str, query: str) -> str:
+    """
+    Find the user's expenses by merchant or description, tolerating typos, partial names and
+    (when enabled) similar meanings. Returns up to 20 matching expenses, best match first.
+    """
+    try:
+        results = await asyncio.to_thread(search_expenses, uuid.UUID(user_id), query, 20)
+    except ValueError:
+        return "Invalid user_id - pass the user's UUID."
+    if results:
+        return json.dumps(results, default=str)
+    return "No matching expenses found."
+
 class SubmitFinalAnswer(BaseModel):
     """Submit the final answer to the user based on the query results."""
     final_answer: str = Field(..., description="The final answer to the user")
@@ -62,15 +103,18 @@ class SubmitFinalAnswer(BaseModel):
 #---------------------------------------------------------------------------------------------------
 # Agent #
 
-ANALYST_SYSTEM = """You are a helpful expert data analyst, SQL expert, and financial assistant.
+ANALYST_SYSTEM = f"""You are a helpful expert data analyst, SQL expert, and financial assistant.
 
-You have two tools:
+You have three tools:
 1. db_query_tool — execute a PostgreSQL query against the expenses database.
-2. SubmitFinalAnswer — submit your final answer to the user. Call this ONLY when you have all the data you need.
+2. search_expenses_tool — find the user's expenses by merchant or description (fuzzy and semantic matching, using an index). Pass the user's UUID and a short search query.
+3. SubmitFinalAnswer — submit your final answer to the user. Call this ONLY when you have all the data you need.
 
 Workflow:
 - If the user's question can be answered without expense data (general questions, greetings, follow-ups already answered by previous context), call SubmitFinalAnswer directly.
 - If the question requires expense data, generate and execute SQL queries using db_query_tool. You may call db_query_tool multiple times to gather all the data you need (e.g. totals, breakdowns, transaction lists). Once you have enough data, call SubmitFinalAnswer.
+- Tool calls made in the same turn run in parallel. When you need several independent results (e.g. totals for each category or period being compared), request them all in one turn instead of one per turn.
+- Call SubmitFinalAnswer on its own, never together with other tools.
 - NEVER call SubmitFinalAnswer with placeholder text like "preparing" or "calculating". Only submit when you have actual numbers and a complete answer.
 
 SQL generation rules:
@@ -92,8 +136,18 @@ Schema:
 - Column('description', String())
 - Column('date', Date())
 - Column('currency', String())
+- Column('merchant_id', Integer(), ForeignKey('merchants.id'))
+- Column('base_amount', Numeric())  -- price converted to {BASE_CURRENCY} at the exchange rate of the expense's date; NULL if no rate is known
+
+Table name: 'merchants' (the user's canonical merchants; differently written descriptions of the same merchant share one)
+Schema:
+- Column('id', Integer(), primary_key=True)
+- Column('user_id', UUID(), ForeignKey('users.id'))
+- Column('name', String())
 
-Today's date is {today}. Today is {day}. Infer the date requested by the user based on today's date.
+To group or compare spending by merchant/shop, join expenses to merchants on merchant_id and group by merchants.name rather than by description.
+
+Infer the dates requested by the user from today's date, which is given in the user's message.
 
 Query rules:
 - Output the query as a single line — no newlines or formatting.
@@ -102,7 +156,7 @@ Query rules:
 - Only query rows belonging to the user_id provided in the context.
 - Use user_id only in WHERE for filtering; do not SELECT user_id or id unless strictly required.
 - Use only the list of categories provided in context. Do not make up categories.
-- Use ILIKE for case-insensitive matching.
+- Use ILIKE for case-insensitive matching. To find expenses by merchant or description (especially misspelt or vague ones, e.g. "that coffee place"), use search_expenses_tool instead.
 - Always query for currency.
 - Never query all columns — only relevant ones.
 - DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.).
@@ -123,19 +177,50 @@ Safety and privacy:
 - If such fields appear in tool outputs or prior messages, ignore them and never surface them.
 
 Clarity and numerics:
-- Use the currency codes present in the data; do not convert unless the user asks.
+- For totals or comparisons across currencies, SUM(base_amount) gives the amount in {BASE_CURRENCY} - don't convert amounts yourself. Also count rows with a NULL base_amount, and report those separately per currency.
+- Otherwise use the currency codes present in the data.
 - Round monetary amounts to 2 decimal places and include the currency code.
 - If the request is ambiguous or data is insufficient, ask exactly one concise clarifying question."""
 
+# the system prompt is static (today's date etc. are in the user's message), so together with the
+# tool definitions it forms a long identical prefix that OpenAI caches across requests
 analyst_prompt = ChatPromptTemplate.from_messages([
     ("system", ANALYST_SYSTEM),
     ("placeholder", "{messages}"),
 ])
 
 
-async def analyst_node(state: State, writer: StreamWriter):
+def format_query_prompt(user_query: str, user_id, categories: list, previous_answer: str = "") -> str:
+    """Build the per-question user message for the analyser (everything that changes per call)"""
     today, day = get_current_date()
+    return f"""
+    The user's query is: {user_query}.
+    
+    The user's UUID is {user_id}. ONLY query rows that belong to the user.
+    
+    Previous answer you provided: {previous_answer}.
+    Today's date is {today}. Today is {day}. Infer the date requested by the user based on today's date and previous answer.
+    
+    If the previous answer is outdated or does not help with getting what the user is requesting for, disregard it.
+    
+    The list of categories in the user's database is: {categories}.
+
+    
+    """
+
+
+def record_usage(message):
+    """Export prompt token counts and how many of them were served from OpenAI's prompt cache"""
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return
+    cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    metrics.increment("openai.prompt_tokens", usage.get("input_tokens", 0))
+    metrics.increment("openai.cached_tokens", cached_tokens)
+    metrics.increment("openai.cache_hits" if cached_tokens else "openai.cache_misses")
 
+
+async def analyst_node(state: State, writer: StreamWriter, config: RunnableConfig):  # pylint: disable=redefined-outer-name
     # Send appropriate progress message based on whether we already have query results
     has_tool_results = any(
         getattr(msg, "type", None) == "tool" for msg in state["messages"]
@@ -145,40 +230,57 @@ async def analyst_node(state: State, writer: StreamWriter):
     else:
         writer({"custom": "📝 Analysing query..."})
 
-    prompt = analyst_prompt.partial(today=today, day=day)
-    chain = prompt | llm.bind_tools([db_query_tool, SubmitFinalAnswer])
-    message = await chain.ainvoke(state)
+    # the model is picked per question by the caller; the other tier is the fallback
+    model = config.get("configurable", {}).get("analyst_model", ANALYST_MODEL)
+    fallback_model = ANALYST_STRONG_MODEL if model == ANALYST_MODEL else ANALYST_MODEL
+    tools = [db_query_tool, search_expenses_tool, SubmitFinalAnswer]
+    message = await call_with_failover(
+        "analyst",
+        lambda: (analyst_prompt | get_llm(model).bind_tools(tools)).ainvoke(state),
+        lambda: (analyst_prompt | get_llm(fallback_model).bind_tools(tools)).ainvoke(state),
+        ANALYST_LATENCY_SLO,
+    )
+    record_usage(message)
 
     # Strip trailing newline from final answer if present
-    if message.tool_calls and message.tool_calls[0]["name"] == "SubmitFinalAnswer":
-        message.tool_calls[0]["args"]["final_answer"] = (
-            message.tool_calls[0]["args"]["final_answer"].rstrip('\n')
-        )
+    final_call = get_final_answer_call(message)
+    if final_call:
+        final_call["args"]["final_answer"] = final_call["args"]["final_answer"].rstrip('\n')
 
     return {"messages": [message]}
 
+
+def get_final_answer_call(message):
+    """Get the SubmitFinalAnswer call among a message's tool calls (in any position), or None"""
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        if tool_call["name"] == "SubmitFinalAnswer":
+            return tool_call
+    return None
+
 #---------------------------------------------------------------------------------------------------
 # Conditional Edges #
 
 def route_after_analyst(state: State) -> Literal["tools", "__end__"]:
-    """Route to tools if db_query_tool was called, otherwise end (SubmitFinalAnswer or plain text)."""
+    """Route to tools if query/search tools were called, otherwise end (SubmitFinalAnswer or plain text).
+    A final answer wins over other calls made alongside it - the model considered itself done."""
     last_message = state["messages"][-1]
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        if last_message.tool_calls[0]["name"] == "SubmitFinalAnswer":
-            return "__end__"
+    if getattr(last_message, "tool_calls", None) and get_final_answer_call(last_message) is None:
         return "tools"
     return "__end__"
 
 #---------------------------------------------------------------------------------------------------
 # Building Workflow #
 
-workflow = StateGraph(State)
+@lru_cache(maxsize=None)
+def get_analyser_agent():
+    """Get the compiled analyser agent, building the workflow on first use"""
+    workflow = StateGraph(State)
 
-workflow.add_node("analyst", analyst_node)
-workflow.add_node("tools", create_tool_node_with_fallback([db_query_tool]))
+    workflow.add_node("analyst", analyst_node)
+    workflow.add_node("tools", create_tool_node_with_fallback([db_query_tool, search_expenses_tool]))
 
-workflow.add_edge(START, "analyst")
-workflow.add_conditional_edges("analyst", route_after_analyst)
-workflow.add_edge("tools", "analyst")
+    workflow.add_edge(START, "analyst")
+    workflow.add_conditional_edges("analyst", route_after_analyst)
+    workflow.add_edge("tools", "analyst")
 
-analyser_agent = workflow.compile()
+    return workflow.compile()
@@ -29,6 +29,45 @@ def str_to_json(text: str) -> dict:
     except json.JSONDecodeError:
         return "error: Failed to parse response as JSON"
 
+def parse_partial_json(text: str) -> dict:
+    """
+    Extracts the complete top-level fields from the start of a JSON object that is still being
+    streamed, e.g. '{"currency": "GBP", "price": 4.' -> {"currency": "GBP"}.
+    Args:
+        text (str): The JSON received so far.
+    Returns:
+        dict: The fields whose values have been fully received.
+    """
+    decoder = json.JSONDecoder()
+    fields = {}
+    i = text.find("{") + 1
+    if i == 0:
+        return fields
+
+    def skip_whitespace(j):
+        while j < len(text) and text[j].isspace():
+            j += 1
+        return j
+
+    while True:
+        try:
+            i = skip_whitespace(i)
+            key, i = decoder.raw_decode(text, i)
+            i = skip_whitespace(i)
+            if text[i] != ":":
+                return fields
+            value, i = decoder.raw_decode(text, skip_whitespace(i + 1))
+            i = skip_whitespace(i)
+            # a value is only complete once what follows it has arrived (e.g. "4." may become "4.50")
+            if i >= len(text) or text[i] not in ",}":
+                return fields
+        except (ValueError, IndexError):
+            return fields
+        fields[key] = value
+        if text[i] == "}":
+            return fields
+        i += 1
+
 def get_current_date():
     """Get current date for LLM to infer actual expense date from relative date provided by user
     Returns: